@@ -1,4 +1,3 @@
-import base64
 import logging
 import os
 import sys
@@ -82,6 +81,51 @@ class CovictoryWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.slowdownPath.currentPath = '/Users/pieper/covictory/slowdown-covid19'
     parametersFormLayout.addRow("Slowdown Path", self.slowdownPath)
 
+    self.workerCount = qt.QSpinBox()
+    self.workerCount.minimum = 0
+    self.workerCount.maximum = 256
+    self.workerCount.value = 0
+    self.workerCount.specialValueText = "One per core"
+    self.workerCount.toolTip = "Number of processes used to decode and equalize images"
+    parametersFormLayout.addRow("Workers", self.workerCount)
+
+    self.inMemory = qt.QCheckBox()
+    self.inMemory.checked = True
+    self.inMemory.toolTip = "Create volumes directly from the equalized arrays instead of reloading temporary PNG files"
+    parametersFormLayout.addRow("Keep in memory", self.inMemory)
+
+    self.useCache = qt.QCheckBox()
+    self.useCache.toolTip = "Reuse equalized images of unchanged input files"
+    parametersFormLayout.addRow("Cache equalized images", self.useCache)
+
+    self.cacheSize = qt.QSpinBox()
+    self.cacheSize.minimum = 1
+    self.cacheSize.maximum = 1024
+    self.cacheSize.value = 4
+    self.cacheSize.suffix = " GB"
+    self.cacheSize.toolTip = "Least recently used equalized images are removed above this size"
+    parametersFormLayout.addRow("Cache size", self.cacheSize)
+
+    self.lazyLoading = qt.QCheckBox()
+    self.lazyLoading.toolTip = "Add thumbnails only and load the full images when they are shown or predicted"
+    parametersFormLayout.addRow("Load volumes lazily", self.lazyLoading)
+
+    self.lazyMemoryBudget = qt.QSpinBox()
+    self.lazyMemoryBudget.minimum = 1
+    self.lazyMemoryBudget.maximum = 1024
+    self.lazyMemoryBudget.value = 2
+    self.lazyMemoryBudget.suffix = " GB"
+    self.lazyMemoryBudget.toolTip = "Least recently used images that are not shown go back to thumbnails above this size"
+    parametersFormLayout.addRow("Loaded images memory", self.lazyMemoryBudget)
+
+    self.buildPyramids = qt.QCheckBox()
+    self.buildPyramids.toolTip = "Store downsampled previews of every image for the mosaic review"
+    parametersFormLayout.addRow("Build review previews", self.buildPyramids)
+
+    self.bulkImport = qt.QCheckBox()
+    self.bulkImport.toolTip = "Add volumes to the scene in batches, updating the views and trees once per batch"
+    parametersFormLayout.addRow("Bulk import", self.bulkImport)
+
 
     #
     # equalizing parameters
@@ -101,6 +145,50 @@ class CovictoryWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.dataPath.setToolTip("Loads the images and applies the equalize algorithm")
     equalizingFormLayout.addWidget(self.loadAndEqualize)
 
+    progressLayout = qt.QHBoxLayout()
+    self.loadProgress = qt.QProgressBar()
+    self.loadProgress.toolTip = "Images equalized and added to the scene"
+    self.cancelLoad = qt.QPushButton("Cancel")
+    self.cancelLoad.toolTip = "Stop loading after the images that are being equalized"
+    self.cancelLoad.enabled = False
+    progressLayout.addWidget(self.loadProgress)
+    progressLayout.addWidget(self.cancelLoad)
+    equalizingFormLayout.addRow(progressLayout)
+    self.loadStatus = qt.QLabel()
+    equalizingFormLayout.addRow(self.loadStatus)
+
+    self.watchFolder = qt.QPushButton("Watch Folder")
+    self.watchFolder.checkable = True
+    self.watchFolder.toolTip = "Keep processing new or changed images as they arrive in the data path"
+    equalizingFormLayout.addWidget(self.watchFolder)
+
+    timingsLayout = qt.QHBoxLayout()
+    self.recordTimings = qt.QCheckBox("Record timings")
+    self.recordTimings.toolTip = "Time every processing stage of every image and list the timings in the Covictory Timings table"
+    timingsLayout.addWidget(self.recordTimings)
+    self.traceMemory = qt.QCheckBox("Trace memory")
+    self.traceMemory.toolTip = "Also record the peak Python memory of the process during every stage, which includes other threads (slows processing down)"
+    timingsLayout.addWidget(self.traceMemory)
+    equalizingFormLayout.addRow(timingsLayout)
+
+    self.profilePath = ctk.ctkPathLineEdit()
+    self.profilePath.filters = ctk.ctkPathLineEdit.Files | ctk.ctkPathLineEdit.Writable
+    self.profilePath.nameFilters = ["Profiles (*.prof)"]
+    self.profilePath.toolTip = "If set, loads are profiled with cProfile and the statistics written to this file (e.g. for snakeviz)"
+    equalizingFormLayout.addRow("Profile", self.profilePath)
+
+    reviewLayout = qt.QHBoxLayout()
+    self.reviewMosaic = qt.QPushButton("Review Mosaic")
+    self.reviewMosaic.toolTip = "Show the previews of the processed images, click one to see it at full resolution"
+    self.previousPage = qt.QPushButton("<")
+    self.previousPage.toolTip = "Previous page of previews"
+    self.nextPage = qt.QPushButton(">")
+    self.nextPage.toolTip = "Next page of previews"
+    reviewLayout.addWidget(self.reviewMosaic)
+    reviewLayout.addWidget(self.previousPage)
+    reviewLayout.addWidget(self.nextPage)
+    equalizingFormLayout.addRow(reviewLayout)
+
     #
     # verification parameters
     #
@@ -114,6 +202,29 @@ class CovictoryWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.useLocalServer.checked = True
     verificationFormLayout.addWidget(self.useLocalServer)
 
+    self.binaryTransfer = qt.QCheckBox("Binary transfer")
+    self.binaryTransfer.toolTip = "Send pixels to the page in binary chunks instead of base64 text"
+    verificationFormLayout.addWidget(self.binaryTransfer)
+
+    self.predictorBackend = qt.QComboBox()
+    self.predictorBackend.addItem("Covictory page", "web")
+    self.predictorBackend.addItem("Local model", "local")
+    self.predictorBackend.toolTip = "Predict in the Covictory web page, or with an exported model in Slicer"
+    verificationFormLayout.addRow("Predictor", self.predictorBackend)
+
+    self.modelPath = ctk.ctkPathLineEdit()
+    self.modelPath.filters = ctk.ctkPathLineEdit.Files | ctk.ctkPathLineEdit.Readable
+    self.modelPath.nameFilters = ["Exported models (*.onnx *.tflite)"]
+    self.modelPath.toolTip = "ONNX or TF-Lite model used by the local predictor"
+    verificationFormLayout.addRow("Model", self.modelPath)
+
+    self.inferenceBatchSize = qt.QSpinBox()
+    self.inferenceBatchSize.minimum = 1
+    self.inferenceBatchSize.maximum = 256
+    self.inferenceBatchSize.value = 8
+    self.inferenceBatchSize.toolTip = "Images predicted together by the local model"
+    verificationFormLayout.addRow("Batch size", self.inferenceBatchSize)
+
     self.launchCovictory = qt.QPushButton("Launch Covictory")
     self.dataPath.setToolTip("Load the site")
     verificationFormLayout.addWidget(self.launchCovictory)
@@ -138,7 +249,12 @@ class CovictoryWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.dataPath.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
 
     self.loadAndEqualize.connect("clicked()", self.onLoadAndEqualize)
+    self.cancelLoad.connect("clicked()", self.onCancelLoad)
     self.launchCovictory.connect("clicked()", self.onLaunchCovictory)
+    self.watchFolder.connect("toggled(bool)", self.onWatchFolder)
+    self.reviewMosaic.connect("clicked()", self.onReviewMosaic)
+    self.previousPage.connect("clicked()", lambda: self.logic.mosaicReview and self.logic.mosaicReview.previousPage())
+    self.nextPage.connect("clicked()", lambda: self.logic.mosaicReview and self.logic.mosaicReview.nextPage())
 
     # Initial GUI update
     self.updateGUIFromParameterNode()
@@ -148,6 +264,15 @@ class CovictoryWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     Called when the application closes and the module widget is destroyed.
     """
     self.removeObservers()
+    if self.logic:
+      self.logic.cancelLoad()
+      self.logic.stopWatching()
+      if self.logic.lazyVolumes:
+        self.logic.lazyVolumes.stopObserving()
+      if self.logic.mosaicReview:
+        self.logic.mosaicReview.stopObserving()
+      if self.logic.localPredictor:
+        self.logic.localPredictor.stop()
 
   def setParameterNode(self, inputParameterNode):
     """
@@ -243,14 +368,94 @@ class CovictoryWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
   def onLoadAndEqualize(self):
     try:
-      if not self.logic.webWidget:
+      self.updateLogicFromGUI()
+      if self.logic.predictorBackend == "web" and not self.logic.webWidget:
         self.onLaunchCovictory()
-      self.logic.loadAndEqualize(self.slowdownPath.currentPath, self.dataPath.currentPath)
+      self.logic.startLoadAndEqualize(self.slowdownPath.currentPath, self.dataPath.currentPath,
+        self.onLoadProgress, self.onLoadDone)
+      self.loadAndEqualize.enabled = False
+      self.cancelLoad.enabled = True
+      self.loadProgress.value = 0
+      self.loadStatus.text = "Listing files"
     except Exception as e:
       slicer.util.errorDisplay("Failed to compute results: "+str(e))
       import traceback
       traceback.print_exc()
 
+  def onLoadProgress(self, task):
+    if task.total:
+      self.loadProgress.maximum = task.total
+      self.loadProgress.value = task.completed
+    eta = f", {task.eta:.0f} s left" if task.eta is not None else ""
+    self.loadStatus.text = f"{task.completed} of {task.total} images, {task.throughput:.1f} images/s{eta}"
+
+  def onLoadDone(self, task):
+    self.loadAndEqualize.enabled = True
+    self.cancelLoad.enabled = False
+    if task.error:
+      self.loadStatus.text = "Failed"
+      slicer.util.errorDisplay("Failed to compute results: "+str(task.error))
+    elif task.cancelled:
+      self.loadStatus.text = f"Cancelled after {task.completed} images"
+    else:
+      self.loadProgress.value = self.loadProgress.maximum
+      self.loadStatus.text = f"{task.completed} images in {task.elapsed:.1f} s, {task.throughput:.1f} images/s"
+    if self.logic.recorder.enabled:
+      self.logic.exportTimings()
+
+  def onCancelLoad(self):
+    self.logic.cancelLoad()
+    self.cancelLoad.enabled = False
+    self.loadStatus.text = "Cancelling"
+
+  def updateLogicFromGUI(self):
+    self.logic.workerCount = self.workerCount.value if self.workerCount.value > 0 else None
+    self.logic.inMemory = self.inMemory.checked
+    self.logic.useCache = self.useCache.checked
+    self.logic.cacheSizeBytes = self.cacheSize.value << 30
+    self.logic.lazyLoading = self.lazyLoading.checked
+    self.logic.lazyMemoryBudgetBytes = self.lazyMemoryBudget.value << 30
+    self.logic.buildPyramids = self.buildPyramids.checked
+    self.logic.bulkImport = self.bulkImport.checked
+    self.logic.binaryTransfer = self.binaryTransfer.checked
+    self.logic.predictorBackend = self.predictorBackend.currentData
+    self.logic.modelPath = self.modelPath.currentPath
+    self.logic.inferenceBatchSize = self.inferenceBatchSize.value
+    self.logic.recorder.enabled = self.recordTimings.checked or self.traceMemory.checked
+    self.logic.recorder.traceMemory = self.traceMemory.checked
+    self.logic.profilePath = self.profilePath.currentPath or None
+
+  def onWatchFolder(self, watch):
+    try:
+      if not watch:
+        self.logic.stopWatching()
+        return
+      self.updateLogicFromGUI()
+      if self.logic.predictorBackend == "web" and not self.logic.webWidget:
+        self.onLaunchCovictory()
+      self.logic.startWatching(self.slowdownPath.currentPath, self.dataPath.currentPath)
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to watch folder: "+str(e))
+      import traceback
+      traceback.print_exc()
+      self.watchFolder.checked = False
+
+  def onReviewMosaic(self):
+    try:
+      entries = None
+      if not self.logic.reviewEntries:
+        # previews of an earlier session
+        from CovictoryLib.Review import reviewEntriesInFolder
+        entries = reviewEntriesInFolder(self.logic.defaultPyramidPath(self.dataPath.currentPath))
+        if not entries:
+          slicer.util.errorDisplay("No previews found, enable 'Build review previews' and load the images")
+          return
+      self.logic.review(entries)
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to show the review mosaic: "+str(e))
+      import traceback
+      traceback.print_exc()
+
   def onLaunchCovictory(self):
     if self.useLocalServer.checked:
         url = "http://localhost:8080"
@@ -278,6 +483,62 @@ class CovictoryLogic(ScriptedLoadableModuleLogic):
     """
     ScriptedLoadableModuleLogic.__init__(self, parent)
     self.webWidget = None
+    # number of equalization worker processes, None for one per core
+    self.workerCount = None
+    # skip progress delays (for batch and scripted use)
+    self.headless = False
+    # create volumes directly from the equalization arrays instead of temporary PNG files,
+    # so that every file is decoded only once
+    self.inMemory = True
+    # reuse equalized images of unchanged inputs from a cache in the application cache folder
+    self.useCache = False
+    self.cacheSizeBytes = 4 << 30
+    # send pixels to the page as binary chunks instead of base64 inside evalJS source
+    self.binaryTransfer = False
+    # images sent to the page at the same time, and seconds to wait for each prediction
+    self.maxInFlight = 2
+    self.predictionTimeout = 120
+    self.pixelBridge = None
+    self.predictorTimer = None
+    self.predictionQueue = None
+    # "web" sends images to the Covictory page, "local" runs the exported model at
+    # modelPath (ONNX Runtime or TF-Lite) in process on batches of equalized images
+    self.predictorBackend = "web"
+    self.modelPath = None
+    self.modelLabels = None
+    self.inferenceBatchSize = 8
+    # threads used by the model for each batch, None for one per core
+    self.inferenceThreads = None
+    self.localPredictor = None
+    # per image, per stage timing (disabled by default), see exportTimings
+    import CovictoryLib
+    self.recorder = CovictoryLib.StageRecorder()
+    # if set, the next load (loadAndEqualize, startLoadAndEqualize or an ingest of
+    # the watched folder) is profiled and the stats written to this path
+    self.profilePath = None
+    # lazy loading: volumes are placeholders with a thumbnail until they are shown
+    # or predicted, least recently used pixels are dropped above the budget
+    self.lazyLoading = False
+    self.lazyMemoryBudgetBytes = 2 << 30
+    self.lazyVolumes = None
+    # multi-resolution previews for the mosaic review, see CovictoryLib.Pyramid
+    self.buildPyramids = False
+    self.reviewEntries = []
+    self.mosaicReview = None
+    # streaming ingest: files must be unchanged this long before they are processed
+    self.settleSeconds = 2.
+    self.folderWatcher = None
+    # bulk import: volumes are added to the scene in batches of this many images,
+    # with scene events and rendering held back until each batch is complete
+    self.bulkImport = False
+    self.bulkImportBatchSize = 50
+    # cost of adding volumes to the scene as it grows, see addVolumes
+    self.importCosts = []
+    # background load of the module panel or of the watched folder, see startLoadAndEqualize
+    self.loadTask = None
+    self.taskTimer = None
+    # the watched folder changed while a task was running, see startWatching
+    self.ingestRerun = False
 
   def setDefaultParameters(self, parameterNode):
     """
@@ -288,60 +549,499 @@ class CovictoryLogic(ScriptedLoadableModuleLogic):
     if not parameterNode.GetParameter("Invert"):
       parameterNode.SetParameter("Invert", "false")
 
+  def delayDisplay(self, message, msec=1000):
+    """Show a progress message, skipping the delay when running headless or
+    during a background load (which reports its progress in the module panel).
+    The delay is recorded as its own stage so that it can be told apart
+    from the processing time.
+    """
+    if self.headless or (self.loadTask and not self.loadTask.done):
+      logging.info(message)
+    else:
+      with self.recorder.stage("", "delayDisplay"):
+        slicer.util.delayDisplay(message, msec)
+
   def loadAndEqualize(self, slowdownPath, dataPath):
+    """Equalize all images in dataPath and add the original and equalized volumes to the scene.
+    Decoding and equalization run in self.workerCount processes (one per core by default),
+    files that cannot be read are skipped.
+    """
 
-    codePath = slowdownPath+"/equalization"
-    if codePath not in sys.path:
-      sys.path.append(codePath)
+    import contextlib
+    self.recorder.clear()
+    self.importCosts = []
+    profilePath, self.profilePath = self.profilePath, None
+    with self.recorder.profile(profilePath) if profilePath else contextlib.nullcontext():
+      self._loadAndEqualize(slowdownPath, dataPath)
 
-    import equlize_cxr as eq
-    import skimage.color
+  def _loadAndEqualize(self, slowdownPath, dataPath):
+    import CovictoryLib
+    eq = CovictoryLib.importEqualization(slowdownPath)
 
-    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    origID = shNode.CreateFolderItem(shNode.GetSceneItemID(), "Original")
-    equalID = shNode.CreateFolderItem(shNode.GetSceneItemID(), "Equalized")
+    with self.recorder.stage("", "listdir"):
+      cxr_files = eq.listdir(dataPath)
+
+    self.delayDisplay(f"Python processing", 500)
+    origNodes = [origNode for cxr_file, origNode in self.equalizeFiles(slowdownPath, dataPath, cxr_files) if origNode]
+
+    if not self.canPredict():
+      logging.info('Processing completed (no Covictory page or model for predictions)')
+      return
 
-    cxr_files = eq.listdir(dataPath)
+    self.delayDisplay(f"JavaScript processing" if self.predictorBackend == "web" else "Local predictions", 500)
+    self.predict(origNodes)
 
-    cxr_files[1:]
+    logging.info('Processing completed')
 
+  def startLoadAndEqualize(self, slowdownPath, dataPath, onProgress=None, onDone=None):
+    """Like loadAndEqualize, without blocking the application.  Files are listed,
+    decoded and equalized by a BackgroundTask (in its thread and the worker
+    processes) and the volumes are added to the scene from the main thread as the
+    results arrive, so the views stay interactive.  onProgress(task) is called
+    for every image, onDone(task) at the end, after the images were sent for
+    prediction unless the task failed or was cancelled (see cancelLoad).
+    Returns the BackgroundTask.
+    """
+    if self.loadTask and not self.loadTask.done:
+      raise RuntimeError("Images are already being loaded")
+    self.recorder.clear()
+    self.importCosts = []
+    return self._startEqualizeTask(slowdownPath, dataPath, lambda eq: eq.listdir(dataPath), None,
+      onProgress, onDone, "CovictoryLoad")
+
+  def _startEqualizeTask(self, slowdownPath, dataPath, listFiles, onFile, onProgress, onDone, name):
+    """Background equalization of the files listFiles(equalizationModule) returns,
+    called in the task's thread, see startLoadAndEqualize.  onFile(fileName, originalNode)
+    is called on the main thread once the volumes of a file were added.
+    """
+    import contextlib
+    import CovictoryLib
+    from CovictoryLib.BackgroundTasks import BackgroundTask
+    if self.loadTask and not self.loadTask.done:
+      raise RuntimeError("Images are already being loaded")
+    eq = CovictoryLib.importEqualization(slowdownPath)
+    origID = self.folderItem("Original")
+    equalID = self.folderItem("Equalized")
+    equalizer, cache = self.batchEqualizer(slowdownPath, dataPath)
+    pending = []
     origNodes = []
 
-    self.delayDisplay(f"Python processing", 500)
-    for cxr_file in cxr_files:
-      self.delayDisplay(f"Processing {cxr_file}", 200)
-      path = eq.join(dataPath, cxr_file)
-      name = os.path.splitext(cxr_file)[0]
+    # cProfile only sees the thread it is enabled in, so the work itself is profiled
+    profilePath, self.profilePath = self.profilePath, None
+
+    def work(task):
+      with self.recorder.profile(profilePath) if profilePath else contextlib.nullcontext():
+        with self.recorder.stage("", "listdir"):
+          cxr_files = listFiles(eq)
+        task.total = len(cxr_files)
+        yield from equalizer.equalize(dataPath, cxr_files)
+
+    def addPending():
+      # taken first, so a failure does not leave the same pairs for the next call
+      results = pending[:]
+      pending.clear()
+      for cxr_file, origNode in self.addVolumes(slowdownPath, dataPath, results, cache, origID, equalID):
+        if origNode:
+          origNodes.append(origNode)
+        if onFile:
+          onFile(cxr_file, origNode)
+
+    def onResult(pair):
+      pending.append(pair)
+      if not self.bulkImport or len(pending) >= self.bulkImportBatchSize:
+        addPending()
+      if onProgress:
+        onProgress(task)
+
+    def onTaskDone(task):
       try:
-        img = eq.image.imread(path)
-      except Exception:
-        logging.info(f"skipping {cxr_file}")
-        continue
-
-      imggray = skimage.color.rgb2gray(img).astype('float32')
-      imgeq = eq.equalize(imggray)
-      eqPath = eq.join(slicer.app.temporaryPath, name+".png")
-      eq.io.imsave(eqPath, imgeq)
-
-      loadProperties = {'singleFile': True}
-      loader = lambda path: slicer.util.loadVolume(path, properties=loadProperties)
-      origNode = loader(path)
-      equalNode = loader(eqPath)
-      shNode.SetItemParent(shNode.GetItemByDataNode(origNode), origID)
-      shNode.SetItemParent(shNode.GetItemByDataNode(equalNode), equalID)
-      origNodes.append(origNode)
+        addPending()
+        self.logImportStatistics(equalizer, len(origNodes))
+        if task.error is None and not task.cancelled and origNodes and self.canPredict():
+          self.predict(origNodes)
+        if task.total:
+          logging.info(f"Loading {'cancelled' if task.cancelled else 'completed'}: {len(origNodes)} images "
+                       f"in {task.elapsed:.1f} s")
+      finally:
+        if onDone:
+          onDone(task)
+
+    task = BackgroundTask(work, onResult=onResult, onDone=onTaskDone, name=name)
+    self.loadTask = task.start()
+    self.startTaskTimer()
+    return task
+
+  def cancelLoad(self):
+    """Stop the background load after the images being equalized, see BackgroundTask.cancel.
+    """
+    if self.loadTask:
+      self.loadTask.cancel()
 
-    self.delayDisplay(f"JavaScript processing {cxr_file}", 500)
-    for origNode in origNodes:
-      imageArray = slicer.util.arrayFromVolume(origNode) 
-      rows = imageArray.shape[1]
-      columns = imageArray.shape[2]
-      imageString = str(base64.b64encode(imageArray))[2:-1]
-      self.webWidget.evalJS(f"""
-        predictFromBase64Image(`{origNode.GetName()}`, {rows}, {columns}, `{imageString}`);
-      """)
+  def startTaskTimer(self):
+    """Poll the background load from the main thread, where its callbacks run.
+    """
+    if not self.taskTimer:
+      self.taskTimer = qt.QTimer()
+      self.taskTimer.setInterval(20)
+      self.taskTimer.connect('timeout()', self.pollTasks)
+    self.taskTimer.start()
+
+  def pollTasks(self):
+    if self.loadTask and not self.loadTask.done:
+      self.loadTask.poll()
+    # the callbacks of a finished task may have started the next one
+    if self.loadTask and not self.loadTask.done:
+      return
+    self.taskTimer.stop()
+    if self.ingestRerun and self.folderWatcher:
+      # the folder changed while it was busy
+      self.folderWatcher.onChange()
+
+  def exportTimings(self, jsonPath=None, csvPath=None):
+    """Put the recorded stage timings in the "Covictory Timings" table node
+    and optionally write them as JSON (with per stage summary and profile) or CSV.
+    The peak memory is that of the whole process during the stage, which includes
+    the other thread while a background load runs (see StageRecorder).
+    """
+    tableNode = slicer.mrmlScene.GetFirstNodeByName("Covictory Timings")
+    if not tableNode:
+      tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", "Covictory Timings")
+    tableNode.RemoveAllColumns()
+    for columnName in ["Image", "Stage", "Process", "Wall (ms)", "CPU (ms)", "Process peak memory (KB)"]:
+      tableNode.AddColumn().SetName(columnName)
+    for record in self.recorder.records:
+      row = tableNode.AddEmptyRow()
+      tableNode.SetCellText(row, 0, record["image"])
+      tableNode.SetCellText(row, 1, record["stage"])
+      tableNode.SetCellText(row, 2, str(record["process"]))
+      tableNode.SetCellText(row, 3, f"{record['wall'] * 1000:.3f}")
+      tableNode.SetCellText(row, 4, f"{record['cpu'] * 1000:.3f}")
+      tableNode.SetCellText(row, 5, "" if record["peakBytes"] is None else f"{record['peakBytes'] / 1024:.1f}")
+    if jsonPath:
+      self.recorder.writeJSON(jsonPath)
+    if csvPath:
+      self.recorder.writeCSV(csvPath)
+    return tableNode
+
+  def folderItem(self, name):
+    """Subject hierarchy folder of the given name under the scene, created if needed.
+    """
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    folderID = shNode.GetItemChildWithName(shNode.GetSceneItemID(), name)
+    if not folderID:
+      folderID = shNode.CreateFolderItem(shNode.GetSceneItemID(), name)
+    return folderID
+
+  def equalizeFiles(self, slowdownPath, dataPath, fileNames):
+    """Generator equalizing fileNames in dataPath and adding the volumes to the
+    "Original" and "Equalized" folders.  Yields (fileName, originalNode) as the
+    files are done, with None as node for files that could not be read.
+    """
+    origID = self.folderItem("Original")
+    equalID = self.folderItem("Equalized")
+
+    equalizer, cache = self.batchEqualizer(slowdownPath, dataPath)
+    imageCount = 0
+    pending = []
+    for cxr_file, result in equalizer.equalize(dataPath, fileNames):
+      pending.append((cxr_file, result))
+      if not self.bulkImport or len(pending) >= self.bulkImportBatchSize:
+        for cxr_file, origNode in self.addVolumes(slowdownPath, dataPath, pending, cache, origID, equalID):
+          imageCount += 1 if origNode else 0
+          yield cxr_file, origNode
+        pending = []
+    for cxr_file, origNode in self.addVolumes(slowdownPath, dataPath, pending, cache, origID, equalID):
+      imageCount += 1 if origNode else 0
+      yield cxr_file, origNode
+    self.logImportStatistics(equalizer, imageCount)
+
+  def batchEqualizer(self, slowdownPath, dataPath):
+    """BatchEqualizer for the current settings and the EqualizationCache it uses (or None).
+    """
+    import CovictoryLib
+    outputPath = None if self.inMemory or self.lazyLoading else slicer.app.temporaryPath
+    cache = None
+    # lazy volumes load their equalized pixels from the cache
+    if self.useCache or self.lazyLoading:
+      cache = CovictoryLib.EqualizationCache(os.path.join(slicer.app.cachePath, "Covictory", "Equalized"),
+        self.cacheSizeBytes, CovictoryLib.equalizationCodeVersion(slowdownPath))
+    pyramidPath = self.defaultPyramidPath(dataPath) if self.buildPyramids else None
+    equalizer = CovictoryLib.BatchEqualizer(slowdownPath, outputPath, self.workerCount, cache, self.recorder, pyramidPath)
+    # placeholders only need thumbnails, the images stay in the workers and the cache
+    equalizer.thumbnailsOnly = self.lazyLoading
+    return equalizer, cache
+
+  def logImportStatistics(self, equalizer, imageCount):
+    if self.importCosts:
+      first, last = self.importCosts[0], self.importCosts[-1]
+      logging.info(f"Scene import cost {first['msPerNode']:.2f} ms per node at {first['sceneNodes']} nodes, "
+                   f"{last['msPerNode']:.2f} ms per node at {last['sceneNodes']} nodes")
+    handoff = equalizer.handoffStatistics()
+    if handoff["arrays"] and imageCount:
+      logging.info(f"Received {handoff['arrays']} arrays ({handoff['bytes'] / 1e6:.0f} MB) through shared memory, "
+                   f"{handoff['copiesAvoided'] / imageCount:.1f} copies ({handoff['bytesNotCopied'] / imageCount / 1e6:.0f} MB) "
+                   f"avoided per image")
+
+  def addVolumes(self, slowdownPath, dataPath, results, cache, origID, equalID):
+    """Generator adding the original and equalized volumes of (fileName, EqualizationResult)
+    pairs to the scene and yielding (fileName, originalNode), None for unreadable files
+    and files whose volumes could not be created.
+    In bulk import mode all of them are added in one scene batch (see SceneBatch) and
+    yielded once the scene is updated.  The cost of every batch, or every image without
+    bulk import, is appended to self.importCosts.
+    """
+    import time
+    from CovictoryLib.SceneBatch import SceneBatch
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    if not results:
+      return
+    if self.bulkImport:
+      with SceneBatch() as batch:
+        added = [(cxr_file, self._addVolumePair(slowdownPath, dataPath, cxr_file, result, cache, shNode, origID, equalID))
+                 for cxr_file, result in results]
+      self.recorder.add("", "sceneBatch", batch.seconds - batch.flushSeconds)
+      self.recorder.add("", "sceneFlush", batch.flushSeconds)
+      if batch.addedNodeCount:
+        self.importCosts.append(batch.cost())
+      self.delayDisplay(f"Imported {sum(1 for cxr_file, origNode in added if origNode)} images", 200)
+      yield from added
+      return
+    for cxr_file, result in results:
+      if result is not None:
+        self.delayDisplay(f"Processed {cxr_file}", 200)
+      nodeCount = slicer.mrmlScene.GetNumberOfNodes()
+      startTime = time.perf_counter()
+      origNode = self._addVolumePair(slowdownPath, dataPath, cxr_file, result, cache, shNode, origID, equalID)
+      seconds = time.perf_counter() - startTime
+      addedCount = slicer.mrmlScene.GetNumberOfNodes() - nodeCount
+      if addedCount:
+        self.importCosts.append({"sceneNodes": nodeCount, "addedNodes": addedCount, "seconds": seconds,
+                                 "flushSeconds": 0., "msPerNode": seconds / addedCount * 1000})
+      yield cxr_file, origNode
+
+  def _addVolumePair(self, slowdownPath, dataPath, cxr_file, result, cache, shNode, origID, equalID):
+    import CovictoryLib
+    from CovictoryLib import Volumes
+    from CovictoryLib.Predictions import EQUALIZED_REFERENCE
+    from CovictoryLib.SceneBatch import parentItem
+    if result is None:
+      logging.info(f"skipping {cxr_file}")
+      return None
+    origNode = equalNode = None
+    try:
+      if self.lazyLoading:
+        with self.recorder.stage(cxr_file, "createPlaceholders"):
+          origNode, equalNode = self.addPlaceholders(slowdownPath, dataPath, result, cache)
+      elif self.inMemory:
+        with self.recorder.stage(cxr_file, "createVolumes"):
+          origNode = Volumes.volumeNodeFromImageArray(result.image, result.name)
+          equalNode = Volumes.volumeNodeFromImageArray(CovictoryLib.equalizedArray(result), result.name)
+      else:
+        loadProperties = {'singleFile': True}
+        loader = lambda path: slicer.util.loadVolume(path, properties=loadProperties)
+        with self.recorder.stage(cxr_file, "loadVolume"):
+          origNode = loader(result.path)
+          equalNode = loader(result.equalizedPath)
+    except Exception as e:
+      # skipped like unreadable files, without the half added pair
+      logging.error(f"Failed to add {cxr_file}: {e}")
+      for node in (origNode, equalNode):
+        if node:
+          slicer.mrmlScene.RemoveNode(node)
+      return None
+    with self.recorder.stage(cxr_file, "reparent"):
+      parentItem(origNode, origID, shNode)
+      parentItem(equalNode, equalID, shNode)
+    origNode.SetNodeReferenceID(EQUALIZED_REFERENCE, equalNode.GetID())
+    if result.pyramidPath:
+      self.reviewEntries.append({"name": result.name, "pyramidPath": result.pyramidPath,
+                                 "source": result.path, "volumeID": equalNode.GetID()})
+    return origNode
+
+  @staticmethod
+  def _folderKey(dataPath):
+    import hashlib
+    return hashlib.sha1(os.path.abspath(dataPath).encode("utf-8")).hexdigest()[:16]
+
+  def defaultManifestPath(self, dataPath):
+    """Manifest location for a data folder, in the application cache.
+    """
+    return os.path.join(slicer.app.cachePath, "Covictory", f"manifest-{self._folderKey(dataPath)}.json")
 
-    logging.info('Processing completed')
+  def defaultPyramidPath(self, dataPath):
+    """Folder of the review pyramids of a data folder, in the application cache,
+    so that a batch can be reviewed again in a later session.
+    """
+    return os.path.join(slicer.app.cachePath, "Covictory", f"pyramids-{self._folderKey(dataPath)}")
+
+  def review(self, entries=None, page=0):
+    """Show the previews of the processed images (or of the given review entries,
+    see Review.reviewEntriesInFolder) as a mosaic in the red view.  Clicking a
+    preview shows the image at full resolution in the yellow view.
+    """
+    from CovictoryLib.Review import MosaicReview
+    if self.mosaicReview:
+      self.mosaicReview.stopObserving()
+    slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutSideBySideView)
+    self.mosaicReview = MosaicReview(entries if entries is not None else self.reviewEntries, self.showFullResolution)
+    self.mosaicReview.show(page)
+    self.mosaicReview.startObserving()
+    return self.mosaicReview
+
+  def showFullResolution(self, entry, viewName="Yellow"):
+    """Show the image of a review entry in a slice view.  Volumes of this session
+    are shown directly (lazy volumes are loaded now), others are loaded from the source file.
+    """
+    volumeNode = slicer.mrmlScene.GetNodeByID(entry["volumeID"]) if entry.get("volumeID") else None
+    if not volumeNode:
+      import CovictoryLib
+      source = entry.get("source") or CovictoryLib.readPyramid(entry["pyramidPath"])[1]
+      volumeNode = slicer.util.loadVolume(source, properties={'singleFile': True})
+      entry["volumeID"] = volumeNode.GetID()
+    sliceWidget = slicer.app.layoutManager().sliceWidget(viewName)
+    sliceWidget.mrmlSliceCompositeNode().SetBackgroundVolumeID(volumeNode.GetID())
+    sliceWidget.mrmlSliceNode().SetOrientationToAxial()
+    sliceWidget.sliceLogic().FitSliceToAll()
+    return volumeNode
+
+  def setupLazyVolumes(self):
+    from CovictoryLib.LazyVolumes import LazyVolumes
+    if not self.lazyVolumes:
+      self.lazyVolumes = LazyVolumes(self.lazyMemoryBudgetBytes)
+      self.lazyVolumes.startObserving()
+    self.lazyVolumes.memoryBudgetBytes = self.lazyMemoryBudgetBytes
+    self.lazyVolumes.recorder = self.recorder
+    return self.lazyVolumes
+
+  def addPlaceholders(self, slowdownPath, dataPath, result, cache):
+    """Original and equalized placeholder volumes (see LazyVolumes) for an
+    EqualizationResult with thumbnails (see BatchEqualizer.thumbnailsOnly).  The
+    original is decoded again from its file when needed, the equalized image comes
+    from the cache, or is equalized again if it was evicted.
+    """
+    import CovictoryLib
+    lazyVolumes = self.setupLazyVolumes()
+    def loadOriginal(path=result.path):
+      return CovictoryLib.decodeImage(path)
+
+    def loadEqualized(fileName=result.fileName, cachedPath=result.equalizedCachePath):
+      if cachedPath:
+        try:
+          return CovictoryLib.EqualizationCache.loadArray(cachedPath)
+        except OSError:
+          pass
+      equalized = CovictoryLib.equalizeFile(slowdownPath, dataPath, fileName, None, cache)
+      if equalized is None:
+        raise ValueError(f"{fileName} can no longer be read")
+      return CovictoryLib.equalizedArray(equalized)
+
+    origNode = lazyVolumes.addPlaceholder(result.name, *result.thumbnails["original"], loadOriginal, result.path)
+    equalNode = lazyVolumes.addPlaceholder(result.name, *result.thumbnails["equalized"],
+      loadEqualized, result.equalizedCachePath)
+    return origNode, equalNode
+
+  def startIngest(self, slowdownPath, dataPath, manifest):
+    """Equalize the files of dataPath that the manifest does not list as done in
+    the background, like startLoadAndEqualize, recording each of them once its
+    volumes were added.  The files are compared with the manifest (hashed if
+    needed) in the background too.  New volumes are sent for prediction if a
+    predictor is available.  Returns the BackgroundTask.
+    """
+    def listFiles(eq):
+      fileNames = manifest.changedFiles(dataPath, eq.listdir(dataPath), minimumAge=self.settleSeconds)
+      if fileNames:
+        logging.info(f"Ingesting {len(fileNames)} new or changed files from {dataPath}")
+      return fileNames
+
+    def onFile(fileName, origNode):
+      manifest.record(dataPath, fileName, "processed" if origNode else "skipped")
+
+    return self._startEqualizeTask(slowdownPath, dataPath, listFiles, onFile, None,
+      lambda task: manifest.save(), "CovictoryIngest")
+
+  def startWatching(self, slowdownPath, dataPath, manifestPath=None):
+    """Process the files already in dataPath that are not in the manifest and
+    then keep processing new or changed files as they arrive.
+    The manifest is kept at manifestPath (by default in the application cache),
+    so a restarted session only processes what it has not seen.
+    Only one ingest (or load) runs at a time; changes that arrive meanwhile are
+    looked at when it is done, once its files are recorded.
+    """
+    import CovictoryLib
+    from CovictoryLib.FolderWatcher import FolderWatcher
+    self.stopWatching()
+    manifest = CovictoryLib.IngestManifest(manifestPath if manifestPath else self.defaultManifestPath(dataPath))
+
+    def onChange():
+      if self.loadTask and not self.loadTask.done:
+        self.ingestRerun = True
+        return
+      self.ingestRerun = False
+      try:
+        self.startIngest(slowdownPath, dataPath, manifest)
+      except Exception as e:
+        logging.error(f"Ingest of {dataPath} failed: {e}")
+
+    self.folderWatcher = FolderWatcher(dataPath, onChange, settleMsec=int(self.settleSeconds * 1000))
+    onChange()
+
+  def stopWatching(self):
+    self.ingestRerun = False
+    if self.loadTask and self.loadTask.name == "CovictoryIngest":
+      self.loadTask.cancel()
+    if self.folderWatcher:
+      self.folderWatcher.stop()
+      self.folderWatcher = None
+
+  def canPredict(self):
+    """True if the selected prediction backend is available.
+    """
+    return bool(self.modelPath) if self.predictorBackend == "local" else bool(self.webWidget)
+
+  def predictor(self):
+    """The prediction backend: the PixelBridge to the Covictory page, or the
+    LocalPredictor for modelPath (created when the settings changed).
+    """
+    if self.predictorBackend != "local":
+      return self.pixelBridge
+    return self.setupLocalPredictor()
+
+  def setupLocalPredictor(self):
+    """Load the model at modelPath for in process predictions.
+    """
+    from CovictoryLib.Predictors import LocalPredictor, loadModel
+    settings = (self.modelPath, self.inferenceThreads, self.inferenceBatchSize, self.modelLabels)
+    if not self.localPredictor or self.localPredictor.settings != settings:
+      if not self.modelPath:
+        raise ValueError("No model selected for local predictions")
+      if self.localPredictor:
+        self.localPredictor.stop()
+      self.localPredictor = LocalPredictor(loadModel(self.modelPath, self.inferenceThreads),
+        self.inferenceBatchSize, self.modelLabels)
+      self.localPredictor.settings = settings
+      logging.info(f"Loaded {self.modelPath} for local predictions")
+    self.localPredictor.recorder = self.recorder
+    self.startPredictorTimer()
+    return self.localPredictor
+
+  def predict(self, volumeNodes):
+    """Queue volume nodes for prediction by the Covictory page or the local model.
+    Results arrive asynchronously and are stored by the PredictionQueue
+    (node attribute and "Covictory Predictions" table).  The local model gets
+    the equalized volumes of the original volumes.
+    """
+    from CovictoryLib.Predictions import EQUALIZED_REFERENCE, PredictionQueue
+    encoding = "binary" if self.binaryTransfer else "base64"
+    predictor = self.predictor()
+    if not self.predictionQueue or self.predictionQueue.predictor != predictor:
+      self.predictionQueue = PredictionQueue(predictor, encoding)
+    self.predictionQueue.encoding = encoding
+    self.predictionQueue.inputReference = EQUALIZED_REFERENCE if self.predictorBackend == "local" else None
+    self.predictionQueue.recorder = self.recorder
+    self.predictionQueue.prepare = self.lazyVolumes.materialize if self.lazyVolumes else None
+    for volumeNode in volumeNodes:
+      self.predictionQueue.submit(volumeNode)
+    return self.predictionQueue
 
   def launchCovictory(self, url):
     lm = slicer.app.layoutManager()
@@ -355,6 +1055,40 @@ class CovictoryLogic(ScriptedLoadableModuleLogic):
     lm.threeDWidget(0).hide()
     sizes = [int(splitter.height*.67), 0, int(splitter.height*.33)]
     splitter.setSizes(sizes)
+    self.setupPixelBridge()
+
+  def openPredictor(self, url, timeout=60.):
+    """Load the prediction page without showing it or changing the layout,
+    for batch use.  Waits until the page is loaded.
+    """
+    from CovictoryLib import WebPage
+    self.webWidget = WebPage.openWebWidget(url, timeout)
+    self.setupPixelBridge()
+
+  def setupPixelBridge(self):
+    """Create the binary pixel transfer channel to the current web widget.
+    """
+    from CovictoryLib.PixelBridge import PixelBridge, pageOrigin
+    if self.pixelBridge:
+      self.pixelBridge.stop()
+    self.pixelBridge = PixelBridge(self.webWidget.evalJS, pageOrigin(self.webWidget.url),
+      maxInFlight=self.maxInFlight, timeout=self.predictionTimeout)
+    self.pixelBridge.recorder = self.recorder
+    self.startPredictorTimer()
+
+  def startPredictorTimer(self):
+    """Poll the prediction backends from the main thread, where their callbacks run.
+    """
+    if not self.predictorTimer:
+      self.predictorTimer = qt.QTimer()
+      self.predictorTimer.setInterval(20)
+      self.predictorTimer.connect('timeout()', self.pollPredictors)
+      self.predictorTimer.start()
+
+  def pollPredictors(self):
+    for predictor in [self.pixelBridge, self.localPredictor]:
+      if predictor:
+        predictor.poll()
 
 
 #
@@ -377,53 +1111,358 @@ class CovictoryTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
-    self.test_Covictory1()
+    self.test_BenchmarkSuite()
+    self.setUp()
+    self.test_VolumeFromImageArray()
+    self.setUp()
+    self.test_LazyVolumes()
+    self.setUp()
+    self.test_MosaicReview()
+    self.setUp()
+    self.test_SharedArrays()
+    self.setUp()
+    self.test_ImageHeaders()
+    self.setUp()
+    self.test_SceneBatch()
+    self.setUp()
+    self.test_LocalPredictor()
+    self.setUp()
+    self.test_BackgroundTask()
 
-  def test_Covictory1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
+  def test_BenchmarkSuite(self):
+    """ Run the benchmark suite on small synthetic data, without network access,
+    and check the comparison of its results with a baseline.
     """
+    from CovictoryLib import BenchmarkSuite
 
     self.delayDisplay("Starting the test")
 
-    # Get/create input data
+    results = BenchmarkSuite.runSuite(["volumeFromArray", "volumeLoading", "sliceTiles"], ["small"], repeat=1)
+    entry = results["results"]["volumeFromArray/small"]
+    self.assertEqual(entry["status"], "ok")
+    self.assertEqual(entry["items"], BenchmarkSuite.SIZES["small"]["imageCount"])
+    self.assertGreater(entry["seconds"], 0)
+    self.assertEqual(results["results"]["volumeLoading/small"]["status"], "ok")
+    self.assertIn(results["results"]["sliceTiles/small"]["status"], ["ok", "skipped"])
+    self.delayDisplay('Finished benchmarks')
+
+    import copy
+    slower = copy.deepcopy(results)
+    slower["results"]["volumeFromArray/small"]["seconds"] *= 2
+    comparison = BenchmarkSuite.compareToBaseline(slower, results, tolerance=0.5)
+    self.assertEqual([change["benchmark"] for change in comparison["regressions"]], ["volumeFromArray/small"])
+    self.assertEqual(comparison["improvements"], [])
+    self.assertEqual(comparison["environmentChanges"], {})
+
+    comparison = BenchmarkSuite.compareToBaseline(results, slower, tolerance=0.5)
+    self.assertEqual(comparison["regressions"], [])
+    self.assertEqual([change["benchmark"] for change in comparison["improvements"]], ["volumeFromArray/small"])
+
+    del slower["results"]["volumeLoading/small"]
+    comparison = BenchmarkSuite.compareToBaseline(slower, results)
+    self.assertEqual(comparison["missing"], ["volumeLoading/small"])
+
+    self.delayDisplay('Test passed')
+
+  def test_VolumeFromImageArray(self):
+    """ Volumes created from arrays share the pixel values of the arrays.
+    """
+    import numpy
+    from CovictoryLib import Volumes
+
+    gray = numpy.random.default_rng(0).random((30, 40), dtype='float32')
+    grayNode = Volumes.volumeNodeFromImageArray(gray, "gray")
+    self.assertEqual(grayNode.GetClassName(), "vtkMRMLScalarVolumeNode")
+    grayArray = slicer.util.arrayFromVolume(grayNode)
+    self.assertEqual(grayArray.shape, (1, 30, 40))
+    self.assertTrue(numpy.array_equal(grayArray[0], gray))
+    self.assertTrue(numpy.shares_memory(grayArray, gray))
+
+    rgb = numpy.zeros((30, 40, 3), dtype='uint8')
+    rgb[10, 20] = [1, 2, 3]
+    rgbNode = Volumes.volumeNodeFromImageArray(rgb, "rgb")
+    self.assertEqual(rgbNode.GetClassName(), "vtkMRMLVectorVolumeNode")
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(rgbNode)[0], rgb))
 
-    import SampleData
-    inputVolume = SampleData.downloadFromURL(
-      nodeNames='MRHead',
-      fileNames='MR-Head.nrrd',
-      uris='https://github.com/Slicer/SlicerTestingData/releases/download/MD5/39b01631b7b38232a220007230624c8e',
-      checksums='MD5:39b01631b7b38232a220007230624c8e')[0]
-    self.delayDisplay('Finished with download and loading')
+    self.delayDisplay('Test passed')
 
-    inputScalarRange = inputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(inputScalarRange[0], 0)
-    self.assertEqual(inputScalarRange[1], 279)
+  def test_LazyVolumes(self):
+    """ Placeholders hold a thumbnail until they are shown or materialized,
+    and loaded pixels are evicted under the memory budget.
+    """
+    import numpy
+    from CovictoryLib.LazyVolumes import LazyVolumes, thumbnailOf
 
-    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
-    threshold = 50
+    images = [numpy.random.default_rng(index).random((300, 200), dtype='float32') for index in range(3)]
+    lazyVolumes = LazyVolumes(memoryBudgetBytes=2 * images[0].nbytes)
+    lazyVolumes.startObserving()
+    try:
+      nodes = [lazyVolumes.addPlaceholder(f"image{index}", image.shape, *thumbnailOf(image, 64),
+                                          lambda image=image: image)
+               for index, image in enumerate(images)]
+      self.assertTrue(all(lazyVolumes.isPlaceholder(node) for node in nodes))
+      self.assertEqual(slicer.util.arrayFromVolume(nodes[0]).shape, (1, 60, 40))
+      self.assertEqual(nodes[0].GetSpacing(), (5., 5., 1.))
+      self.assertEqual(lazyVolumes.loadedBytes, 0)
+
+      lazyVolumes.materialize(nodes[0])
+      self.assertFalse(lazyVolumes.isPlaceholder(nodes[0]))
+      self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(nodes[0])[0], images[0]))
+      self.assertEqual(nodes[0].GetSpacing(), (1., 1., 1.))
+
+      # showing a placeholder loads it
+      compositeNode = slicer.app.layoutManager().sliceWidget('Red').mrmlSliceCompositeNode()
+      compositeNode.SetBackgroundVolumeID(nodes[1].GetID())
+      self.assertFalse(lazyVolumes.isPlaceholder(nodes[1]))
+
+      # over the budget the least recently used volume that is not shown is evicted
+      compositeNode.SetBackgroundVolumeID(nodes[0].GetID())
+      lazyVolumes.materialize(nodes[2])
+      self.assertEqual(lazyVolumes.loadCount, 3)
+      self.assertFalse(lazyVolumes.isPlaceholder(nodes[0]))
+      self.assertTrue(lazyVolumes.isPlaceholder(nodes[1]))
+      self.assertEqual(slicer.util.arrayFromVolume(nodes[1]).shape, (1, 60, 40))
+      self.assertLessEqual(lazyVolumes.loadedBytes, lazyVolumes.memoryBudgetBytes)
+    finally:
+      lazyVolumes.stopObserving()
 
-    # Test the module logic
+    self.delayDisplay('Test passed')
 
-    logic = CovictoryLogic()
+  def test_MosaicReview(self):
+    """ Previews are read from the pyramid files and laid out as a mosaic,
+    and positions in the mosaic map back to their images.
+    """
+    import tempfile
+    import numpy
+    from CovictoryLib import Pyramid, SyntheticData
+    from CovictoryLib.Review import MosaicReview, reviewEntriesInFolder
+
+    pyramidFolder = tempfile.mkdtemp(prefix="CovictoryReview-")
+    for index in range(5):
+      gray = SyntheticData.syntheticRadiograph(600, 400, channels=1, seed=index)
+      Pyramid.writePyramid(os.path.join(pyramidFolder, f"image{index}" + Pyramid.PYRAMID_SUFFIX),
+                           {"original": gray, "equalized": gray}, source=f"image{index}.png")
+    entries = reviewEntriesInFolder(pyramidFolder)
+    self.assertEqual([entry["name"] for entry in entries], [f"image{index}" for index in range(5)])
+    preview, source = Pyramid.readPyramid(entries[0]["pyramidPath"], "equalized", 200)
+    self.assertEqual(preview.shape, (150, 100))
+    self.assertEqual(source, "image0.png")
+
+    selected = []
+    review = MosaicReview(entries, selected.append, rows=1, columns=3, tileSize=200)
+    self.assertEqual(review.pageCount, 2)
+    mosaic = review.mosaic(0)
+    self.assertEqual(mosaic.shape, (200, 600))
+    self.assertTrue(numpy.array_equal(mosaic[25:175, 50:150], preview))
+
+    volumeNode = review.show(1)
+    self.assertEqual(slicer.util.arrayFromVolume(volumeNode).shape, (1, 200, 600))
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    tileCenter = lambda column: ijkToRAS.MultiplyPoint([column * 200 + 100, 100, 0, 1])[:3]
+    self.assertEqual(review.entryAt(tileCenter(0))["name"], "image3")
+    self.assertEqual(review.entryAt(tileCenter(1))["name"], "image4")
+    self.assertIsNone(review.entryAt(tileCenter(2)))
 
-    # Test algorithm with non-inverted threshold
-    logic.run(inputVolume, outputVolume, threshold, True)
-    outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-    self.assertEqual(outputScalarRange[1], threshold)
+    self.delayDisplay('Test passed')
 
-    # Test algorithm with inverted threshold
-    logic.run(inputVolume, outputVolume, threshold, False)
-    outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-    self.assertEqual(outputScalarRange[1], inputScalarRange[1])
+  def test_SharedArrays(self):
+    """ Arrays handed over in shared memory become volume pixels without a copy,
+    and their memory is released once the volume is gone.
+    """
+    import gc
+    import numpy
+    from CovictoryLib import Volumes
+    from CovictoryLib.SharedArrays import SharedArray, SharedArrayReceiver, shareArray
+
+    image = numpy.random.default_rng(0).random((300, 200), dtype='float32')
+    shared = shareArray(image)
+    self.assertIsInstance(shared, SharedArray)
+    receiver = SharedArrayReceiver()
+    received = receiver.attach(shared)
+    self.assertTrue(numpy.array_equal(received, image))
+    self.assertEqual(receiver.statistics()["copiesAvoided"], 2)
+    self.assertIs(receiver.attach(image), image)
+
+    volumeNode = Volumes.volumeNodeFromImageArray(received, "shared")
+    self.assertTrue(numpy.shares_memory(slicer.util.arrayFromVolume(volumeNode), received))
+    del received
+    gc.collect()
+    receiver.collect()
+    self.assertEqual(receiver.liveCount, 1)
+
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    del volumeNode
+    gc.collect()
+    self.assertEqual(receiver.collect(), 1)
+    self.assertEqual(receiver.liveCount, 0)
+
+    self.delayDisplay('Test passed')
+
+  def test_ImageHeaders(self):
+    """ Files are recognized from their headers only, non-images are rejected
+    before decoding, and the gray conversion matches rgb2gray.
+    """
+    import os
+    import numpy
+    import skimage.color
+    import skimage.io
+    from CovictoryLib.ImageHeaders import decodeImage, readHeader, scanFiles, toGray
+
+    folder = os.path.join(slicer.app.temporaryPath, "CovictoryImageHeaders")
+    os.makedirs(folder, exist_ok=True)
+    image = numpy.random.default_rng(0).integers(0, 256, (300, 200, 3), dtype=numpy.uint8)
+    skimage.io.imsave(os.path.join(folder, "color.png"), image, check_contrast=False)
+    skimage.io.imsave(os.path.join(folder, "gray.png"), image[..., 0], check_contrast=False)
+    with open(os.path.join(folder, "notes.txt"), "w") as fp:
+      fp.write("not an image")
+
+    header = readHeader(os.path.join(folder, "color.png"))
+    self.assertEqual((header.format, header.rows, header.columns, header.channels), ("png", 300, 200, 3))
+    scanned = {fileName: header for fileName, header, reason in scanFiles(folder, sorted(os.listdir(folder)))}
+    self.assertIsNone(scanned["notes.txt"])
+    self.assertEqual(scanned["gray.png"].channels, 1)
+
+    decoded = decodeImage(os.path.join(folder, "color.png"), header)
+    self.assertTrue(numpy.array_equal(decoded, image))
+    gray = toGray(decoded)
+    self.assertEqual(gray.dtype, numpy.float32)
+    self.assertTrue(numpy.allclose(gray, skimage.color.rgb2gray(image), atol=1e-6))
+    self.assertTrue(numpy.array_equal(toGray(numpy.dstack([image[..., 0]] * 3)), toGray(image[..., 0])))
+
+    self.delayDisplay('Test passed')
+
+  def test_SceneBatch(self):
+    """ Volumes added in a scene batch are parented in the subject hierarchy
+    and the scene is back to normal afterwards.
+    """
+    import numpy
+    from CovictoryLib import Volumes
+    from CovictoryLib.SceneBatch import SceneBatch, parentItem
+
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    folderID = shNode.CreateFolderItem(shNode.GetSceneItemID(), "Batch")
+    image = numpy.zeros((64, 48), dtype='float32')
+    with SceneBatch() as batch:
+      self.assertTrue(slicer.mrmlScene.IsBatchProcessing())
+      volumeNodes = [Volumes.volumeNodeFromImageArray(image, f"batch{index}") for index in range(20)]
+      for volumeNode in volumeNodes:
+        parentItem(volumeNode, folderID, shNode)
+    self.assertFalse(slicer.mrmlScene.IsBatchProcessing())
+    self.assertGreaterEqual(batch.addedNodeCount, 20)
+    self.assertGreater(batch.cost()["msPerNode"], 0)
+    for volumeNode in volumeNodes:
+      self.assertEqual(shNode.GetItemParent(shNode.GetItemByDataNode(volumeNode)), folderID)
+
+    self.delayDisplay('Test passed')
+
+  def test_LocalPredictor(self):
+    """ A model run in process predicts the equalized volume of an original
+    volume through the PredictionQueue, in batches.
+    """
+    try:
+      import onnx
+      import onnxruntime
+    except ImportError:
+      self.delayDisplay('onnx or onnxruntime not installed, local predictions not tested')
+      return
+    import json
+    import os
+    import numpy
+    from CovictoryLib import Volumes
+    from CovictoryLib.Predictions import EQUALIZED_REFERENCE, PREDICTION_ATTRIBUTE, PredictionQueue
+    from CovictoryLib.Predictors import LocalPredictor, loadModel
+    from CovictoryLib.SyntheticData import syntheticRadiograph, writeClassifierModel
+    from CovictoryLib.WebPage import waitFor
+
+    modelPath = writeClassifierModel(os.path.join(slicer.app.temporaryPath, "CovictoryClassifier.onnx"), size=64)
+    predictor = LocalPredictor(loadModel(modelPath), batchSize=4, labels=["normal", "covid"])
+    self.assertEqual((predictor.channels, predictor.rows, predictor.columns), (1, 64, 64))
+
+    origNodes = []
+    for index in range(6):
+      image = syntheticRadiograph(300, 200, seed=index)
+      origNode = Volumes.volumeNodeFromImageArray(image, f"original{index}")
+      equalNode = Volumes.volumeNodeFromImageArray(image[..., 0] / numpy.float32(255), f"equalized{index}")
+      origNode.SetNodeReferenceID(EQUALIZED_REFERENCE, equalNode.GetID())
+      origNodes.append(origNode)
+
+    predictionQueue = PredictionQueue(predictor)
+    predictionQueue.inputReference = EQUALIZED_REFERENCE
+    for origNode in origNodes:
+      predictionQueue.submit(origNode)
+    def done():
+      predictor.poll()
+      return predictionQueue.pendingCount == 0
+    waitFor(done, timeout=60)
+    predictor.stop()
+
+    self.assertEqual(predictionQueue.statistics()["completed"], len(origNodes))
+    self.assertLessEqual(predictor.batchCount, len(origNodes))
+    for origNode in origNodes:
+      prediction = json.loads(origNode.GetAttribute(PREDICTION_ATTRIBUTE))
+      self.assertAlmostEqual(prediction["normal"] + prediction["covid"], 1, places=5)
+
+    self.delayDisplay('Test passed')
+
+  def test_BackgroundTask(self):
+    """ Items computed in a background thread are added to the scene on the
+    main thread, in order, and a cancelled task closes its generator.
+    """
+    import threading
+    import time
+    import numpy
+    from CovictoryLib import Volumes
+    from CovictoryLib.BackgroundTasks import BackgroundTask
+    from CovictoryLib.WebPage import waitFor
+
+    mainThread = threading.current_thread()
+    def images(task):
+      task.total = 10
+      for index in range(10):
+        time.sleep(0.01)
+        yield index, numpy.full((32, 32), index, dtype='float32')
+    volumeNodes = []
+    def addVolume(item):
+      self.assertIs(threading.current_thread(), mainThread)
+      index, image = item
+      volumeNodes.append(Volumes.volumeNodeFromImageArray(image, f"background{index}"))
+    finished = []
+    task = BackgroundTask(images, onResult=addVolume, onDone=finished.append).start()
+    waitFor(lambda: not task.poll(), timeout=30)
+    self.assertEqual(finished, [task])
+    self.assertIsNone(task.error)
+    self.assertEqual(task.completed, 10)
+    self.assertGreater(task.throughput, 0)
+    self.assertEqual(task.eta, 0)
+    self.assertEqual([volumeNode.GetName() for volumeNode in volumeNodes], [f"background{index}" for index in range(10)])
+
+    closed = []
+    def endless(task):
+      try:
+        while True:
+          time.sleep(0.01)
+          yield None
+      finally:
+        closed.append(threading.current_thread() is not mainThread)
+    task = BackgroundTask(endless, maxQueued=4).start()
+    waitFor(lambda: task.poll() and task.completed >= 3, timeout=30)
+    task.cancel()
+    self.assertTrue(task.wait(timeout=30))
+    self.assertTrue(task.cancelled)
+    self.assertEqual(closed, [True])
+
+    # a failing callback ends the task with its error instead of being retried
+    delivered = []
+    def failOnSecond(item):
+      delivered.append(item)
+      if len(delivered) == 2:
+        raise RuntimeError("cannot add")
+    finished = []
+    task = BackgroundTask(images, onResult=failOnSecond, onDone=finished.append).start()
+    self.assertTrue(task.wait(timeout=30))
+    self.assertEqual(finished, [task])
+    self.assertIsInstance(task.error, RuntimeError)
+    self.assertEqual(len(delivered), 2)
 
     self.delayDisplay('Test passed')
@@ -0,0 +1,180 @@
+import logging
+import queue
+import threading
+import time
+
+#
+# Long running jobs off the main thread
+#
+# A BackgroundTask runs a generator in a thread and hands what it yields to
+# poll(), which is called on the main thread (e.g. from a QTimer) and runs
+# the callbacks there, like the prediction backends do.  Work that needs the
+# scene stays in the callbacks, the thread only does the waiting and the
+# computing.
+#
+# No slicer imports here, so tasks can also be run with plain python.
+#
+
+__all__ = ['BackgroundTask']
+
+
+class BackgroundTask:
+  """Runs work(task), a generator function, in a background thread.
+
+  Every item it yields is passed to onResult(item) by poll() on the main
+  thread, for at most pollSeconds per call, so that the application stays
+  responsive however fast items arrive.  At most maxQueued items wait for
+  poll(), the thread is held back beyond that.  onDone(task) is called by
+  the poll() that delivered the last item; error then holds the exception
+  the work raised, if any.  An exception of onResult is stored in error
+  too and cancels the task, the items after it are dropped; onDone is
+  still called.
+
+  cancel() stops the work after the item it is working on: the generator is
+  closed in the thread, so its finally blocks and context managers release
+  what it uses (e.g. worker processes).  Items yielded before are still
+  delivered.
+
+  completed counts the delivered items.  If total is known (the work may
+  also set task.total once it knows it), throughput and eta tell how the
+  task is progressing.
+  """
+
+  def __init__(self, work, total=None, onResult=None, onDone=None, name="BackgroundTask", maxQueued=64, pollSeconds=0.05):
+    self.work = work
+    self.total = total
+    self.onResult = onResult
+    self.onDone = onDone
+    self.name = name
+    self.pollSeconds = pollSeconds
+    self.completed = 0
+    self.error = None
+    self.startTime = None
+    self.endTime = None
+    self._items = queue.Queue(maxQueued)
+    self._cancelled = threading.Event()
+    self._finished = threading.Event()
+    self._done = False
+    self._callbackFailed = False
+    self._thread = None
+
+  def start(self):
+    if self._thread is None:
+      self.startTime = time.perf_counter()
+      self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+      self._thread.start()
+    return self
+
+  def cancel(self):
+    self._cancelled.set()
+
+  @property
+  def cancelled(self):
+    return self._cancelled.is_set()
+
+  @property
+  def done(self):
+    """True once onDone was called."""
+    return self._done
+
+  @property
+  def elapsed(self):
+    if self.startTime is None:
+      return 0.
+    return (self.endTime if self.endTime else time.perf_counter()) - self.startTime
+
+  @property
+  def throughput(self):
+    """Items delivered per second."""
+    elapsed = self.elapsed
+    return self.completed / elapsed if elapsed > 0 else 0.
+
+  @property
+  def eta(self):
+    """Estimated seconds until all items are delivered, None if unknown."""
+    throughput = self.throughput
+    if self.total is None or not throughput:
+      return None
+    return max(0, self.total - self.completed) / throughput
+
+  def _put(self, item):
+    # waits for room, but not once the task is cancelled
+    while not self._cancelled.is_set():
+      try:
+        self._items.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def _run(self):
+    try:
+      items = iter(self.work(self))
+      try:
+        for item in items:
+          if not self._put(item) or self._cancelled.is_set():
+            break
+      finally:
+        if hasattr(items, "close"):
+          items.close()
+    except Exception as e:
+      logging.error(f"{self.name} failed: {e}")
+      self.error = e
+    finally:
+      self._finished.set()
+
+  def poll(self):
+    """Deliver the items that arrived and finish the task when there are no
+    more.  Main thread only.  Returns True while the task is not done.
+    """
+    if self._done or self._thread is None:
+      return not self._done
+    endTime = time.perf_counter() + self.pollSeconds
+    while time.perf_counter() < endTime:
+      # checked before taking an item, so no item is left behind once finished
+      finished = self._finished.is_set()
+      try:
+        item = self._items.get_nowait()
+      except queue.Empty:
+        if finished:
+          self._finish()
+          return False
+        break
+      if self._callbackFailed:
+        continue
+      self.completed += 1
+      if self.onResult:
+        try:
+          self.onResult(item)
+        except Exception as e:
+          self._failed(e)
+    return True
+
+  def _failed(self, e):
+    # a callback failed on the main thread: the task ends with the error
+    logging.error(f"{self.name} callback failed: {e}")
+    if self.error is None:
+      self.error = e
+    self._callbackFailed = True
+    self.cancel()
+
+  def _finish(self):
+    self._done = True
+    self.endTime = time.perf_counter()
+    self._thread.join()
+    if self.onDone:
+      try:
+        self.onDone(self)
+      except Exception as e:
+        self._failed(e)
+
+  def wait(self, timeout=None, interval=0.01):
+    """Poll until the task is done, for scripts and tests without an event
+    loop.  Returns False if it is still running after timeout seconds.
+    """
+    endTime = None if timeout is None else time.perf_counter() + timeout
+    while self.poll():
+      if endTime is not None and time.perf_counter() > endTime:
+        return False
+      time.sleep(interval)
+    return True
@@ -0,0 +1,167 @@
+"""Headless batch processing of a folder of chest X rays with the Covictory logic.
+
+Run with Slicer's python script mode, without main window:
+
+  Slicer --no-main-window --python-script .../CovictoryLib/BatchRunner.py \\
+    --slowdown /path/to/slowdown-covid19 --data /path/to/images --report report.json [--predict]
+
+All progress delays and layout changes are skipped.  The report is JSON with
+the per file results, the prediction statistics and the time spent in each
+stage.  --timings adds a per image, per stage breakdown (see Instrumentation),
+--trace-memory the peak Python memory of each stage to it.
+--model predicts with an exported model in process instead of the page
+(--predict is implied).
+--bulk N adds the volumes to the scene in batches of N images, importCosts
+in the report follows the cost per added node as the scene grows.
+The exit status is one of the EXIT_* values below.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+EXIT_OK = 0
+EXIT_ERROR = 1  # bad arguments or a failure that stopped the run
+EXIT_PARTIAL = 2  # some files could not be read or were not predicted
+EXIT_NO_INPUT = 3  # the data folder has no files to process
+
+
+def parseArguments(argv):
+  parser = argparse.ArgumentParser(description="Equalize (and optionally predict) a folder of chest X rays")
+  parser.add_argument("--slowdown", required=True, help="slowdown-covid19 checkout")
+  parser.add_argument("--data", required=True, help="folder with the input images")
+  parser.add_argument("--report", help="JSON report path (default: print to stdout)")
+  parser.add_argument("--workers", type=int, default=0, help="equalization processes, 0 for one per core")
+  parser.add_argument("--png", action="store_true", help="round trip through temporary PNG files instead of creating volumes in memory")
+  parser.add_argument("--cache", action="store_true", help="reuse cached equalized images")
+  parser.add_argument("--predict", action="store_true", help="run predictions with the predictor page")
+  parser.add_argument("--predictor-url", help="predictor page (default: the local stand-in page)")
+  parser.add_argument("--model", help="predict with this exported .onnx or .tflite model in process instead of a page (implies --predict)")
+  parser.add_argument("--inference-batch", type=int, default=8, help="images per model run with --model")
+  parser.add_argument("--timeout", type=float, default=120., help="seconds to wait for each prediction")
+  parser.add_argument("--timings", help="CSV path for the per image, per stage timings (also summarized in the report)")
+  parser.add_argument("--bulk", type=int, default=0, metavar="N",
+                      help="add volumes to the scene in batches of N images (default: one at a time)")
+  parser.add_argument("--trace-memory", action="store_true",
+                      help="record the peak Python memory of the process during every stage in the timings (slower)")
+  parser.add_argument("--profile", help="path for the cProfile statistics of the equalization")
+  args = parser.parse_args(argv)
+  # --model implies --predict
+  args.predict = args.predict or bool(args.model)
+  return args
+
+
+def run(args):
+  """Process the folder and return (report, exit status).
+  """
+  from Covictory import CovictoryLogic
+  from CovictoryLib import WebPage
+
+  stages = {}
+  def stage(name, startTime):
+    stages[name] = stages.get(name, 0.) + time.perf_counter() - startTime
+
+  logic = CovictoryLogic()
+  logic.headless = True
+  logic.inMemory = not args.png
+  logic.useCache = args.cache
+  logic.bulkImport = args.bulk > 0
+  logic.bulkImportBatchSize = max(1, args.bulk)
+  logic.workerCount = args.workers if args.workers > 0 else None
+  logic.predictionTimeout = args.timeout
+  logic.recorder.enabled = bool(args.timings) or args.trace_memory
+  logic.recorder.traceMemory = args.trace_memory
+
+  startTime = time.perf_counter()
+  import CovictoryLib
+  eq = CovictoryLib.importEqualization(args.slowdown)
+  fileNames = eq.listdir(args.data)
+  stage("scan", startTime)
+  if not fileNames:
+    return {"data": args.data, "files": [], "stages": stages}, EXIT_NO_INPUT
+
+  files = {}
+  origNodes = []
+  import contextlib
+  startTime = time.perf_counter()
+  with logic.recorder.profile(args.profile) if args.profile else contextlib.nullcontext():
+    for fileName, origNode in logic.equalizeFiles(args.slowdown, args.data, fileNames):
+      files[fileName] = {"file": fileName, "status": "equalized" if origNode else "skipped"}
+      if origNode:
+        files[fileName]["volume"] = origNode.GetName()
+        origNodes.append((fileName, origNode))
+  stage("equalize", startTime)
+
+  predictionStatistics = None
+  if args.predict and origNodes:
+    startTime = time.perf_counter()
+    if args.model:
+      logic.predictorBackend = "local"
+      logic.modelPath = args.model
+      logic.inferenceBatchSize = args.inference_batch
+      logic.setupLocalPredictor()
+    else:
+      logic.openPredictor(args.predictor_url if args.predictor_url else WebPage.standInPageURL())
+    stage("openPredictor", startTime)
+
+    startTime = time.perf_counter()
+    predictionQueue = logic.predict([origNode for fileName, origNode in origNodes])
+    WebPage.waitFor(lambda: predictionQueue.pendingCount == 0, timeout=args.timeout * (len(origNodes) + 1))
+    stage("predict", startTime)
+    predictionStatistics = predictionQueue.statistics()
+    from CovictoryLib.Predictions import PREDICTION_ATTRIBUTE
+    for fileName, origNode in origNodes:
+      prediction = origNode.GetAttribute(PREDICTION_ATTRIBUTE)
+      files[fileName]["status"] = "predicted" if prediction is not None else "predictionFailed"
+      files[fileName]["prediction"] = json.loads(prediction) if prediction is not None else None
+
+  report = {
+    "data": args.data,
+    "files": list(files.values()),
+    "predictions": predictionStatistics,
+    "stages": stages,
+    "importCosts": logic.importCosts,
+  }
+  if logic.recorder.enabled:
+    report["stageSummary"] = logic.recorder.summary()
+    if args.timings:
+      logic.recorder.writeCSV(args.timings)
+  complete = all(entry["status"] in ("equalized", "predicted") for entry in report["files"])
+  return report, EXIT_OK if complete else EXIT_PARTIAL
+
+
+def main(argv):
+  logging.getLogger().setLevel(logging.INFO)
+  try:
+    args = parseArguments(argv)
+  except SystemExit as e:
+    return EXIT_ERROR if e.code else EXIT_OK
+  startTime = time.perf_counter()
+  try:
+    report, status = run(args)
+  except Exception as e:
+    import traceback
+    traceback.print_exc()
+    report, status = {"data": args.data, "error": str(e)}, EXIT_ERROR
+  report["status"] = status
+  report["seconds"] = time.perf_counter() - startTime
+
+  reportText = json.dumps(report, indent=2)
+  if args.report:
+    with open(args.report, "w") as fp:
+      fp.write(reportText)
+  else:
+    print(reportText)
+  return status
+
+
+if __name__ == "__main__":
+  # make CovictoryLib and the Covictory module importable when run as a script
+  modulePath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  if modulePath not in sys.path:
+    sys.path.insert(0, modulePath)
+  import slicer
+  slicer.util.exit(main(sys.argv[1:]))
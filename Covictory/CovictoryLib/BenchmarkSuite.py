@@ -0,0 +1,508 @@
+"""Reproducible benchmarks of the SlicerML pipelines on synthetic data.
+
+Everything runs on locally generated images and volumes (see SyntheticData),
+so no network access is needed.  Benchmarks that need the application
+(volume loading, pixel transfer) are skipped when run with plain python:
+
+  Slicer --no-main-window --python-script .../CovictoryLib/BenchmarkSuite.py \\
+    --slowdown /path/to/slowdown-covid19 --sizes small medium --output results.json \\
+    --baseline baseline.json
+
+  python .../CovictoryLib/BenchmarkSuite.py --only sliceTiles randomSlices --sizes small large
+
+Results are JSON: the environment and, for every benchmark and data size,
+the best and median seconds of the repeated runs and the items per second.
+With --baseline the results are compared to an earlier results file and the
+exit status is EXIT_REGRESSION if any benchmark got slower than the
+tolerance allows.  --save-baseline writes the results as the new baseline.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy
+
+EXIT_OK = 0
+EXIT_ERROR = 1  # bad arguments or a benchmark failed
+EXIT_REGRESSION = 2  # slower than the baseline
+
+# data sizes: radiograph rows and columns, images per run,
+# volume shape for the cvae experiment, and random slices per run
+SIZES = {
+  "small": {"image": (512, 512), "imageCount": 4, "volume": (32, 128, 128), "sliceCount": 2000},
+  "medium": {"image": (2048, 2048), "imageCount": 8, "volume": (130, 256, 256), "sliceCount": 20000},
+  "large": {"image": (3000, 3000), "imageCount": 16, "volume": (256, 512, 512), "sliceCount": 70000},
+}
+
+
+class BenchmarkSkipped(Exception):
+  """Raised by a benchmark that cannot run in this environment."""
+
+
+def _requireSlicer():
+  try:
+    import slicer
+    slicer.app
+  except (ImportError, AttributeError):
+    raise BenchmarkSkipped("needs the Slicer application")
+
+
+def _importExperiment(name):
+  """Import a module of the Experiments folder of the source tree."""
+  experimentsPath = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "Experiments")
+  if not os.path.exists(os.path.join(experimentsPath, name + ".py")):
+    raise BenchmarkSkipped(f"Experiments/{name}.py not found")
+  if experimentsPath not in sys.path:
+    sys.path.append(experimentsPath)
+  import importlib
+  return importlib.import_module(name)
+
+
+#
+# Benchmarks
+#
+# Each benchmark is a context manager that prepares the data of a size and
+# yields a function doing one timed run and returning the number of items
+# processed.  Preparation and cleanup are not timed.
+#
+
+@contextlib.contextmanager
+def equalization(size, options):
+  """Decode, convert and equalize radiograph files with the BatchEqualizer, in memory."""
+  if not options.get("slowdownPath"):
+    raise BenchmarkSkipped("needs --slowdown")
+  from CovictoryLib.Equalization import BatchEqualizer
+  from CovictoryLib.SyntheticData import writeRadiographs
+  folder = tempfile.mkdtemp(prefix="CovictoryBenchmark-")
+  try:
+    fileNames = writeRadiographs(folder, size["imageCount"], *size["image"])
+    equalizer = BatchEqualizer(options["slowdownPath"], None, options.get("workers"))
+    yield lambda: sum(result is not None for fileName, result in equalizer.equalize(folder, fileNames))
+  finally:
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def volumeLoading(size, options):
+  """Load radiograph PNG files as volume nodes."""
+  _requireSlicer()
+  import slicer
+  from CovictoryLib.SyntheticData import writeRadiographs
+  folder = tempfile.mkdtemp(prefix="CovictoryBenchmark-")
+  try:
+    fileNames = writeRadiographs(folder, size["imageCount"], *size["image"])
+    def run():
+      for fileName in fileNames:
+        node = slicer.util.loadVolume(os.path.join(folder, fileName), properties={'singleFile': True})
+        slicer.mrmlScene.RemoveNode(node)
+      return len(fileNames)
+    yield run
+  finally:
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def volumeFromArray(size, options):
+  """Create volume nodes from decoded radiograph arrays."""
+  _requireSlicer()
+  import slicer
+  from CovictoryLib import Volumes
+  from CovictoryLib.SyntheticData import syntheticRadiograph
+  images = [syntheticRadiograph(*size["image"], seed=index) for index in range(size["imageCount"])]
+  def run():
+    for image in images:
+      slicer.mrmlScene.RemoveNode(Volumes.volumeNodeFromImageArray(image, "Benchmark"))
+    return len(images)
+  yield run
+
+
+def _sceneImport(size, batched):
+  _requireSlicer()
+  import numpy
+  import slicer
+  from CovictoryLib import Volumes
+  from CovictoryLib.SceneBatch import SceneBatch, parentItem
+  # small images, the pixels are not what is measured, in a scene that
+  # already holds several times as many volumes
+  image = numpy.zeros((64, 64), dtype=numpy.float32)
+  nodeCount = size["imageCount"] * 25
+  shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+  folderID = shNode.CreateFolderItem(shNode.GetSceneItemID(), "Benchmark")
+  with SceneBatch():
+    existing = [Volumes.volumeNodeFromImageArray(image, "Existing") for index in range(nodeCount * 4)]
+  def add():
+    added = []
+    for index in range(nodeCount):
+      volumeNode = Volumes.volumeNodeFromImageArray(image, "Benchmark")
+      parentItem(volumeNode, folderID, shNode)
+      added.append(volumeNode)
+    return added
+  def run():
+    if batched:
+      with SceneBatch():
+        added = add()
+    else:
+      added = add()
+    with SceneBatch():
+      for volumeNode in added:
+        slicer.mrmlScene.RemoveNode(volumeNode)
+    return nodeCount
+  try:
+    yield run
+  finally:
+    with SceneBatch():
+      for volumeNode in existing:
+        slicer.mrmlScene.RemoveNode(volumeNode)
+      shNode.RemoveItem(folderID)
+
+
+@contextlib.contextmanager
+def sceneImport(size, options):
+  """Add volume nodes one at a time to a scene that already has many, parenting each in the subject hierarchy.
+  Each run also removes the added nodes again, in one batch.
+  """
+  yield from _sceneImport(size, False)
+
+
+@contextlib.contextmanager
+def sceneImportBatched(size, options):
+  """Add the same volume nodes in one scene batch (see SceneBatch)."""
+  yield from _sceneImport(size, True)
+
+
+def _predictAll(predictor, imageArrays, wait):
+  """Send images to a prediction backend (see Predictors) and wait until all are done."""
+  completed = []
+  for index, imageArray in enumerate(imageArrays):
+    predictor.send(f"image{index}", imageArray, completed.append)
+  def done():
+    predictor.poll()
+    return len(completed) == len(imageArrays)
+  wait(done)
+  return len(imageArrays)
+
+
+def _pixelTransfer(size, method):
+  _requireSlicer()
+  import base64
+  from CovictoryLib.PixelBridge import PixelBridge, pageOrigin
+  from CovictoryLib.SyntheticData import syntheticRadiograph
+  from CovictoryLib.WebPage import openStandInPage, waitFor
+  webWidget = openStandInPage()
+  # the stand-in page notifies the bridge of every prediction, whichever way the image came
+  notified = []
+  bridge = PixelBridge(webWidget.evalJS, pageOrigin(webWidget.url),
+    onEvent=lambda kind, tag, body: notified.append(tag))
+  bridge.start()
+  webWidget.evalJS(bridge.shimScript())
+  rows, columns = size["image"]
+  imageArrays = [syntheticRadiograph(rows, columns, channels=1, seed=index)[numpy.newaxis]
+                 for index in range(size["imageCount"])]
+
+  def runEvalJS():
+    notified.clear()
+    for index, imageArray in enumerate(imageArrays):
+      imageString = str(base64.b64encode(imageArray))[2:-1]
+      webWidget.evalJS(f"""
+        predictFromBase64Image({json.dumps(f"image{index}")}, {rows}, {columns}, "{imageString}");
+      """)
+    def done():
+      bridge.poll()
+      return len(notified) == len(imageArrays)
+    waitFor(done, timeout=600)
+    return len(imageArrays)
+
+  try:
+    if method == "evalJS":
+      yield runEvalJS
+    else:
+      yield lambda: _predictAll(bridge, imageArrays, lambda done: waitFor(done, timeout=600))
+  finally:
+    bridge.stop()
+    webWidget.deleteLater()
+
+
+@contextlib.contextmanager
+def pixelTransfer(size, options):
+  """Send gray radiographs to the stand-in predictor page through the PixelBridge."""
+  yield from _pixelTransfer(size, "bridge")
+
+
+@contextlib.contextmanager
+def pixelTransferEvalJS(size, options):
+  """Send the same radiographs as base64 inside evalJS source, the way without the PixelBridge."""
+  yield from _pixelTransfer(size, "evalJS")
+
+
+@contextlib.contextmanager
+def localPrediction(size, options):
+  """Predict the same gray radiographs as pixelTransfer with an exported model in process (LocalPredictor).
+  Uses --model, or a small synthetic ONNX classifier without it.
+  """
+  from CovictoryLib.Predictors import LocalPredictor, loadModel
+  from CovictoryLib.SyntheticData import syntheticRadiograph, writeClassifierModel
+  folder = tempfile.mkdtemp(prefix="CovictoryBenchmark-")
+  try:
+    modelPath = options.get("modelPath")
+    try:
+      if not modelPath:
+        modelPath = writeClassifierModel(os.path.join(folder, "classifier.onnx"))
+      predictor = LocalPredictor(loadModel(modelPath), batchSize=8)
+    except ImportError as e:
+      raise BenchmarkSkipped(str(e))
+    imageArrays = [syntheticRadiograph(*size["image"], channels=1, seed=index)[numpy.newaxis]
+                   for index in range(size["imageCount"])]
+    def wait(done):
+      while not done():
+        time.sleep(0.001)
+    try:
+      yield lambda: _predictAll(predictor, imageArrays, wait)
+    finally:
+      predictor.stop()
+  finally:
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def sliceTiles(size, options):
+  """Tile all slices of a volume into 32x32 tiles (cvae experiment)."""
+  from CovictoryLib.SyntheticData import syntheticVolume
+  tiles = _importExperiment("tiles")
+  volume = syntheticVolume(size["volume"])
+  yield lambda: len(tiles.sliceTiles(volume, 32)[0])
+
+
+@contextlib.contextmanager
+def randomSlices(size, options):
+  """Sample random oblique 32x32 slices from a volume (cvae experiment)."""
+  from CovictoryLib.SyntheticData import syntheticVolume
+  sampling = _importExperiment("sampling")
+  volume = syntheticVolume(size["volume"])
+  bounds = [0, volume.shape[2] - 1, 0, volume.shape[1] - 1, 0, volume.shape[0] - 1]
+  yield lambda: len(sampling.randomObliqueSlices(volume, numpy.eye(4), bounds, size["sliceCount"], [32, 32],
+                                                 seed=1, workers=options.get("workers")))
+
+
+_workerImages = {}
+
+
+def _workerImage(arguments):
+  """Equalized image sized float32 array made in a worker process, returned
+  by pickling or through shared memory.  Arrays are made once per worker, so
+  repeated runs time the hand-off only.
+  """
+  rows, columns, seed, share = arguments
+  from CovictoryLib.SharedArrays import shareArray
+  from CovictoryLib.SyntheticData import syntheticRadiograph
+  if (rows, columns, seed) not in _workerImages:
+    _workerImages[(rows, columns, seed)] = syntheticRadiograph(rows, columns, channels=1, seed=seed).astype(numpy.float32) / 255
+  image = _workerImages[(rows, columns, seed)]
+  return shareArray(image) if share else image
+
+
+@contextlib.contextmanager
+def _handoff(size, options, share):
+  import multiprocessing
+  from CovictoryLib.Equalization import pythonExecutable
+  from CovictoryLib.SharedArrays import SharedArrayReceiver
+  workerCount = options.get("workers") or min(4, os.cpu_count() or 1)
+  context = multiprocessing.get_context("spawn")
+  context.set_executable(pythonExecutable())
+  receiver = SharedArrayReceiver()
+  tasks = [(*size["image"], index, share) for index in range(size["imageCount"])]
+  with context.Pool(workerCount) as pool:
+    # warm up, so that the workers mostly have the images when the timed runs start
+    for result in pool.imap(_workerImage, tasks * workerCount, chunksize=1):
+      receiver.attach(result)
+    def run():
+      arrays = [receiver.attach(result) for result in pool.imap(_workerImage, tasks)]
+      # touch the pixels like a volume node would
+      checksum = sum(float(array[::64, ::64].sum()) for array in arrays)
+      return len(arrays) if checksum >= 0 else 0
+    yield run
+  receiver.collect()
+
+
+@contextlib.contextmanager
+def handoffPickle(size, options):
+  """Return float32 radiograph arrays from worker processes by pickling."""
+  with _handoff(size, options, False) as run:
+    yield run
+
+
+@contextlib.contextmanager
+def handoffShared(size, options):
+  """Return float32 radiograph arrays from worker processes through shared memory."""
+  with _handoff(size, options, True) as run:
+    yield run
+
+
+BENCHMARKS = {
+  "equalization": equalization,
+  "handoffPickle": handoffPickle,
+  "handoffShared": handoffShared,
+  "volumeLoading": volumeLoading,
+  "volumeFromArray": volumeFromArray,
+  "sceneImport": sceneImport,
+  "sceneImportBatched": sceneImportBatched,
+  "pixelTransfer": pixelTransfer,
+  "pixelTransferEvalJS": pixelTransferEvalJS,
+  "localPrediction": localPrediction,
+  "sliceTiles": sliceTiles,
+  "randomSlices": randomSlices,
+}
+
+
+def environment():
+  """Description of the machine and software the results were measured with."""
+  info = {
+    "platform": platform.platform(),
+    "machine": platform.machine(),
+    "processor": platform.processor(),
+    "cpuCount": os.cpu_count(),
+    "python": platform.python_version(),
+    "numpy": numpy.__version__,
+  }
+  if "slicer" in sys.modules:
+    import slicer
+    info["slicer"] = slicer.app.applicationVersion
+  return info
+
+
+def runBenchmark(name, sizeName, repeat=3, options=None):
+  """Run one benchmark repeat times on one data size.
+  Returns its result entry; status is "ok", "skipped" or "failed".
+  """
+  size = SIZES[sizeName]
+  entry = {"benchmark": name, "size": sizeName, "repeat": repeat}
+  try:
+    with BENCHMARKS[name](size, options or {}) as run:
+      times = []
+      for _ in range(repeat):
+        startTime = time.perf_counter()
+        items = run()
+        times.append(time.perf_counter() - startTime)
+  except BenchmarkSkipped as e:
+    entry.update(status="skipped", reason=str(e))
+    return entry
+  except Exception as e:
+    logging.exception(f"Benchmark {name} ({sizeName}) failed")
+    entry.update(status="failed", reason=str(e))
+    return entry
+  entry.update(status="ok", items=items, seconds=min(times), medianSeconds=statistics.median(times),
+               itemsPerSecond=items / min(times) if min(times) > 0 else None)
+  return entry
+
+
+def runSuite(names=None, sizes=("small", "medium"), repeat=3, options=None):
+  """Run the benchmarks (default all) at the given data sizes.
+  Returns the results, keyed "benchmark/size", with the environment.
+  """
+  results = {}
+  for name in names if names else BENCHMARKS:
+    for sizeName in sizes:
+      entry = runBenchmark(name, sizeName, repeat, options)
+      results[f"{name}/{sizeName}"] = entry
+      logging.info(f"{name}/{sizeName}: {entry['status']} " +
+                   (f"{entry['seconds']:.3f} s" if entry["status"] == "ok" else entry["reason"]))
+  return {"environment": environment(), "results": results}
+
+
+def compareToBaseline(results, baseline, tolerance=0.2):
+  """Compare the best times of results with those of a baseline results dictionary.
+  A benchmark is a regression if it takes more than (1 + tolerance) times
+  the baseline time, an improvement if it takes less than (1 - tolerance).
+  Returns a dictionary of "regressions", "improvements" and "missing" entries
+  (benchmark/size keys measured in the baseline but not now) and
+  "environmentChanges", since times of different machines are not comparable.
+  """
+  comparison = {"regressions": [], "improvements": [], "missing": [], "environmentChanges": {}}
+  for key, reference in baseline["results"].items():
+    if reference.get("status") != "ok":
+      continue
+    current = results["results"].get(key)
+    if not current or current.get("status") != "ok":
+      comparison["missing"].append(key)
+      continue
+    ratio = current["seconds"] / reference["seconds"] if reference["seconds"] > 0 else 1.
+    change = {"benchmark": key, "baselineSeconds": reference["seconds"], "seconds": current["seconds"], "ratio": ratio}
+    if ratio > 1 + tolerance:
+      comparison["regressions"].append(change)
+    elif ratio < 1 - tolerance:
+      comparison["improvements"].append(change)
+  for key, value in baseline.get("environment", {}).items():
+    if results["environment"].get(key) != value:
+      comparison["environmentChanges"][key] = [value, results["environment"].get(key)]
+  return comparison
+
+
+def parseArguments(argv):
+  parser = argparse.ArgumentParser(description="Benchmark the SlicerML pipelines on synthetic data")
+  parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="benchmarks to run (default: all)")
+  parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["small", "medium"], help="data sizes")
+  parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark, the best one counts")
+  parser.add_argument("--workers", type=int, default=0, help="processes for equalization and sampling, 0 for one per core")
+  parser.add_argument("--slowdown", help="slowdown-covid19 checkout (the equalization benchmark is skipped without it)")
+  parser.add_argument("--model", help="exported .onnx or .tflite model for localPrediction (default: a synthetic one)")
+  parser.add_argument("--output", help="JSON results path (default: print to stdout)")
+  parser.add_argument("--baseline", help="results of an earlier run to compare with")
+  parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown relative to the baseline")
+  parser.add_argument("--save-baseline", help="also write the results to this path, as baseline for later runs")
+  return parser.parse_args(argv)
+
+
+def main(argv):
+  logging.getLogger().setLevel(logging.INFO)
+  try:
+    args = parseArguments(argv)
+  except SystemExit as e:
+    return EXIT_ERROR if e.code else EXIT_OK
+  options = {"slowdownPath": args.slowdown, "workers": args.workers if args.workers > 0 else None,
+             "modelPath": args.model}
+  results = runSuite(args.only, args.sizes, args.repeat, options)
+  status = EXIT_OK
+  if any(entry["status"] == "failed" for entry in results["results"].values()):
+    status = EXIT_ERROR
+
+  if args.baseline:
+    with open(args.baseline) as fp:
+      comparison = compareToBaseline(results, json.load(fp), args.tolerance)
+    results["comparison"] = comparison
+    for change in comparison["regressions"]:
+      logging.warning(f"{change['benchmark']} regressed: {change['seconds']:.3f} s, "
+                      f"baseline {change['baselineSeconds']:.3f} s")
+    if comparison["environmentChanges"]:
+      logging.warning(f"Baseline was measured in a different environment: {comparison['environmentChanges']}")
+    if comparison["regressions"] and status == EXIT_OK:
+      status = EXIT_REGRESSION
+  results["status"] = status
+
+  resultsText = json.dumps(results, indent=2)
+  for path in [args.output, args.save_baseline]:
+    if path:
+      with open(path, "w") as fp:
+        fp.write(resultsText)
+  if not args.output:
+    print(resultsText)
+  return status
+
+
+if __name__ == "__main__":
+  # make CovictoryLib importable when run as a script
+  modulePath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  if modulePath not in sys.path:
+    sys.path.insert(0, modulePath)
+  status = main(sys.argv[1:])
+  if "slicer" in sys.modules:
+    import slicer
+    slicer.util.exit(status)
+  sys.exit(status)
@@ -0,0 +1,179 @@
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+import numpy
+import slicer
+
+from CovictoryLib import Volumes
+from CovictoryLib.SyntheticData import syntheticRadiograph
+from CovictoryLib.WebPage import openStandInPage, waitFor
+
+#
+# Benchmarks for the Covictory processing steps
+#
+
+
+def currentMemory():
+  """Resident set size of this process in bytes (0 if it cannot be determined).
+  """
+  try:
+    import psutil
+    return psutil.Process().memory_info().rss
+  except ImportError:
+    pass
+  try:
+    with open("/proc/self/statm") as statm:
+      return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, AttributeError):
+    return 0
+
+
+class MemoryPeak:
+  """Context manager recording the peak memory used while it is active.
+  Python/numpy allocations are tracked exactly with tracemalloc, allocations
+  in VTK/ITK are only seen by sampling the resident set size.
+  """
+
+  def __init__(self, interval=0.002):
+    self.interval = interval
+    self.tracedPeak = 0
+    self.residentPeak = 0
+
+  def _sample(self):
+    while not self._done.wait(self.interval):
+      self._residentPeak = max(self._residentPeak, currentMemory())
+
+  def __enter__(self):
+    self._done = threading.Event()
+    self._residentStart = currentMemory()
+    self._residentPeak = self._residentStart
+    self._wasTracing = tracemalloc.is_tracing()
+    if not self._wasTracing:
+      tracemalloc.start()
+    tracemalloc.reset_peak()
+    self._tracedStart = tracemalloc.get_traced_memory()[0]
+    self._sampler = threading.Thread(target=self._sample, daemon=True)
+    self._sampler.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.tracedPeak = tracemalloc.get_traced_memory()[1] - self._tracedStart
+    if not self._wasTracing:
+      tracemalloc.stop()
+    self._done.set()
+    self._sampler.join()
+    self._residentPeak = max(self._residentPeak, currentMemory())
+    self.residentPeak = self._residentPeak - self._residentStart
+    return False
+
+
+def _summary(latencies, peaks):
+  return {
+    "meanLatencySeconds": float(numpy.mean(latencies)),
+    "maxLatencySeconds": float(numpy.max(latencies)),
+    "peakTracedBytes": int(max(peak.tracedPeak for peak in peaks)),
+    "peakResidentBytes": int(max(peak.residentPeak for peak in peaks)),
+  }
+
+
+def benchmarkVolumeCreation(imageCount=5, rows=2048, columns=2048):
+  """Compare creating the Original and Equalized volumes through temporary PNG files
+  (what loadAndEqualize does by default) with creating them from the arrays.
+  Returns a dictionary with per image latency and peak memory for both paths.
+  """
+  import skimage.io
+
+  loadProperties = {'singleFile': True}
+  results = {}
+  for method in ["png", "inMemory"]:
+    latencies = []
+    peaks = []
+    for index in range(imageCount):
+      image = syntheticRadiograph(rows, columns, seed=index)
+      equalized = (image[:, :, 0] / 255.).astype('float32')
+      imagePath = os.path.join(slicer.app.temporaryPath, f"CovictoryBenchmark-{index}.png")
+      equalizedPath = os.path.join(slicer.app.temporaryPath, f"CovictoryBenchmark-{index}-equalized.png")
+      skimage.io.imsave(imagePath, image, check_contrast=False)
+
+      with MemoryPeak() as peak:
+        startTime = time.perf_counter()
+        if method == "png":
+          skimage.io.imsave(equalizedPath, equalized, check_contrast=False)
+          nodes = [slicer.util.loadVolume(imagePath, properties=loadProperties),
+                   slicer.util.loadVolume(equalizedPath, properties=loadProperties)]
+        else:
+          nodes = [Volumes.volumeNodeFromImageArray(image, "Original"),
+                   Volumes.volumeNodeFromImageArray(equalized, "Equalized")]
+        latencies.append(time.perf_counter() - startTime)
+      peaks.append(peak)
+
+      for node in nodes:
+        slicer.mrmlScene.RemoveNode(node)
+      for path in [imagePath, equalizedPath]:
+        if os.path.exists(path):
+          os.remove(path)
+    results[method] = _summary(latencies, peaks)
+    logging.info(f"Volume creation ({method}): {results[method]}")
+  return results
+
+
+def benchmarkPixelTransfer(imageCount=5, rows=3000, columns=3000, chunkSize=1 << 20):
+  """Compare sending images to the predictor as base64 inside evalJS source
+  (what loadAndEqualize does by default) with the binary PixelBridge transfer,
+  using the local stand-in page.  Memory is measured in the Slicer process only;
+  the web engine renderer runs in a separate process.
+  """
+  import base64
+  import json
+  from CovictoryLib.PixelBridge import PixelBridge, pageOrigin
+
+  webWidget = openStandInPage()
+  notified = []
+  bridge = PixelBridge(webWidget.evalJS, pageOrigin(webWidget.url), chunkSize=chunkSize,
+    onEvent=lambda kind, tag, body: notified.append(tag))
+  bridge.start()
+  webWidget.evalJS(bridge.shimScript())
+
+  imageArrays = [syntheticRadiograph(rows, columns, channels=1, seed=index)[numpy.newaxis] for index in range(imageCount)]
+  imageBytes = sum(imageArray.nbytes for imageArray in imageArrays)
+  results = {}
+  for method in ["evalJS", "bridge"]:
+    notified.clear()
+    completed = []
+    with MemoryPeak() as peak:
+      startTime = time.perf_counter()
+      for index, imageArray in enumerate(imageArrays):
+        name = f"image{index}"
+        if method == "evalJS":
+          imageString = str(base64.b64encode(imageArray))[2:-1]
+          webWidget.evalJS(f"""
+            predictFromBase64Image({json.dumps(name)}, {rows}, {columns}, "{imageString}");
+          """)
+        else:
+          bridge.send(name, imageArray, completed.append)
+      if method == "evalJS":
+        # the page's notifications arrive through the bridge's poll()
+        def evalJSDone():
+          bridge.poll()
+          return len(notified) == imageCount
+        waitFor(evalJSDone, timeout=600)
+      else:
+        def bridgeDone():
+          bridge.poll()
+          return len(completed) == imageCount
+        waitFor(bridgeDone, timeout=600)
+      elapsed = time.perf_counter() - startTime
+    results[method] = {
+      "seconds": elapsed,
+      "megabytesPerSecond": imageBytes / elapsed / 1e6,
+      "peakTracedBytes": peak.tracedPeak,
+      "peakResidentBytes": peak.residentPeak,
+    }
+    logging.info(f"Pixel transfer ({method}): {results[method]}")
+
+  bridge.stop()
+  webWidget.deleteLater()
+  return results
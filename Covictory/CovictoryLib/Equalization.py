@@ -0,0 +1,268 @@
+import collections
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+
+#
+# Batch equalization of chest X ray images
+#
+# Everything in this file must be importable without slicer, since
+# the functions are executed in worker processes.
+#
+
+from .EqualizationCache import EqualizationCache
+from .ImageHeaders import decodeImage, scanFiles, toGray
+from .Instrumentation import NULL_RECORDER, StageRecorder
+from .Manifest import contentHash
+from .Pyramid import PYRAMID_SUFFIX, pyramidIsCurrent, thumbnailOf, writePyramid
+from .SharedArrays import SharedArrayReceiver, shareArray
+
+__all__ = ['EqualizationResult', 'BatchEqualizer', 'importEqualization', 'equalizeFile', 'equalizedArray', 'pythonExecutable']
+
+EqualizationResult = collections.namedtuple('EqualizationResult',
+  ['fileName', 'name', 'path', 'equalizedPath', 'image', 'equalizedImage', 'equalizedCachePath', 'stages', 'pyramidPath',
+   'thumbnails'], defaults=[None])
+
+
+def importEqualization(slowdownPath):
+  """Return the equalization module of a https://github.com/acil-bwh/slowdown-covid19 checkout.
+  """
+  codePath = slowdownPath+"/equalization"
+  if codePath not in sys.path:
+    sys.path.append(codePath)
+  import equlize_cxr
+  return equlize_cxr
+
+
+def equalizeFile(slowdownPath, dataPath, fileName, outputPath, cache=None, recorder=None, pyramidPath=None, header=None,
+                 thumbnailsOnly=False):
+  """Decode, convert to gray and equalize one file, writing the result to outputPath.
+  The file is decoded once, by the decoder for its format (see ImageHeaders,
+  header is the file's ImageHeader if it was already read).
+  If outputPath is None nothing is written and the decoded and equalized arrays
+  are returned in the result instead.
+  With an EqualizationCache, a file whose contents were equalized before is
+  not equalized again, and in memory results refer to the cache file
+  (equalizedCachePath) instead of carrying the array.
+  With an enabled StageRecorder the timing records of the steps are
+  returned in the result's stages.
+  With a pyramidPath folder, review previews of the gray original and the
+  equalized image (see Pyramid) are written there unless they are current.
+  With thumbnailsOnly, in memory results carry no arrays but thumbnails:
+  {"original": (shape, thumbnail, step), "equalized": (...)} (see thumbnailOf),
+  for placeholders that load the image later; the equalized image is then
+  only kept in the cache.
+  Returns an EqualizationResult, or None if the file cannot be read as an image.
+  """
+  eq = importEqualization(slowdownPath)
+
+  recorder = StageRecorder(True, recorder.traceMemory) if recorder and recorder.enabled else NULL_RECORDER
+  path = eq.join(dataPath, fileName)
+  name = os.path.splitext(fileName)[0]
+  pyramidFile = os.path.join(pyramidPath, name + PYRAMID_SUFFIX) if pyramidPath else None
+  pyramidNeeded = pyramidFile is not None and not pyramidIsCurrent(pyramidFile, path)
+  result = lambda *arrays, thumbnails=None: EqualizationResult(fileName, name, path, *arrays, recorder.records,
+    pyramidFile, thumbnails)
+
+  def inMemory(img, imgeq, cachedPath):
+    if not thumbnailsOnly:
+      return result(None, img, None if cachedPath else imgeq, cachedPath)
+    with recorder.stage(fileName, "thumbnails"):
+      if imgeq is None:
+        imgeq = cache.loadArray(cachedPath)
+      thumbnails = {kind: (image.shape, *thumbnailOf(image)) for kind, image in [("original", img), ("equalized", imgeq)]}
+    return result(None, None, None, cachedPath, thumbnails=thumbnails)
+
+  def decode():
+    with recorder.stage(fileName, "decode"):
+      try:
+        return decodeImage(path, header)
+      except Exception:
+        return None
+
+  def gray(img):
+    with recorder.stage(fileName, "toGray"):
+      return toGray(img)
+
+  def pyramid(imggray, imgeq):
+    if pyramidNeeded:
+      with recorder.stage(fileName, "pyramid"):
+        writePyramid(pyramidFile, {"original": imggray, "equalized": imgeq}, path)
+
+  cacheKey = cachedPath = None
+  if cache:
+    with recorder.stage(fileName, "cacheLookup"):
+      try:
+        cacheKey = cache.key(contentHash(path))
+      except OSError:
+        return None
+      cachedPath = cache.get(cacheKey)
+    if cachedPath and outputPath is not None:
+      eqPath = eq.join(outputPath, name+".png")
+      imgeq = cache.loadArray(cachedPath)
+      with recorder.stage(fileName, "imsave"):
+        eq.io.imsave(eqPath, imgeq)
+      if pyramidNeeded:
+        img = decode()
+        if img is not None:
+          pyramid(gray(img), imgeq)
+      return result(eqPath, None, None, None)
+
+  img = decode()
+  if img is None:
+    return None
+
+  if cachedPath:
+    if pyramidNeeded:
+      pyramid(gray(img), cache.loadArray(cachedPath))
+    return inMemory(img, None, cachedPath)
+
+  imggray = gray(img)
+  with recorder.stage(fileName, "equalize"):
+    imgeq = eq.equalize(imggray)
+  pyramid(imggray, imgeq)
+  if cache:
+    with recorder.stage(fileName, "cacheStore"):
+      cachedPath = cache.put(cacheKey, imgeq)
+  if outputPath is None:
+    return inMemory(img, imgeq, cachedPath)
+  eqPath = eq.join(outputPath, name+".png")
+  with recorder.stage(fileName, "imsave"):
+    eq.io.imsave(eqPath, imgeq)
+  return result(eqPath, None, None, None)
+
+
+def equalizedArray(result):
+  """The equalized array of an in memory result, memory mapped if it comes from the cache.
+  """
+  if result.equalizedImage is None and result.equalizedCachePath:
+    return EqualizationCache.loadArray(result.equalizedCachePath)
+  return result.equalizedImage
+
+
+def _equalizeFileTask(arguments):
+  return equalizeFile(*arguments)
+
+
+def _equalizeFileSharedTask(arguments):
+  """Worker side of equalizeFile that hands the arrays over in shared memory.
+  """
+  result = equalizeFile(*arguments)
+  if result is None or (result.image is None and result.equalizedImage is None):
+    return result
+  recorder = StageRecorder(bool(result.stages))
+  recorder.records = result.stages
+  with recorder.stage(result.fileName, "shareArrays"):
+    return result._replace(
+      image=shareArray(result.image) if result.image is not None else None,
+      equalizedImage=shareArray(result.equalizedImage) if result.equalizedImage is not None else None)
+
+
+def pythonExecutable():
+  """Interpreter for worker processes.
+  Inside the application sys.executable is the Slicer launcher, so use the
+  PythonSlicer launcher which sets up the same environment without a GUI.
+  """
+  executable = shutil.which("PythonSlicer")
+  return executable if executable else sys.executable
+
+
+class BatchEqualizer:
+  """Equalizes a batch of files in a pool of worker processes.
+  With a workerCount of 1 everything runs in the calling process,
+  which is convenient for debugging. With an outputPath of None the
+  arrays are returned to the caller instead of being written as files.
+  An optional EqualizationCache is shared by all workers and trimmed to
+  its size limit after each batch.  With an enabled StageRecorder the
+  workers time their steps and return the records with each result.
+  With a pyramidPath the workers also write review previews there.
+  With thumbnailsOnly the in memory results only carry thumbnails (see
+  equalizeFile), e.g. for lazy loading.
+  In memory results of worker processes come back through shared memory
+  (see SharedArrays) unless shareArrays is False; handoffStatistics()
+  tells how much was handed over that way.
+  """
+
+  def __init__(self, slowdownPath, outputPath, workerCount=None, cache=None, recorder=None, pyramidPath=None):
+    self.slowdownPath = slowdownPath
+    self.outputPath = outputPath
+    self.workerCount = workerCount if workerCount else (os.cpu_count() or 1)
+    self.cache = cache
+    self.recorder = recorder
+    self.pyramidPath = pyramidPath
+    self.shareArrays = True
+    self.thumbnailsOnly = False
+    self.receiver = SharedArrayReceiver()
+
+  def equalize(self, dataPath, fileNames):
+    """Generator of (fileName, result) pairs in the order of fileNames.
+    The result is None for files that could not be read.
+    """
+    try:
+      for fileName, result in self._equalize(dataPath, fileNames):
+        if result is not None and self.recorder:
+          self.recorder.merge(result.stages)
+        yield fileName, result
+    finally:
+      if self.cache:
+        self.cache.evict()
+
+  def _equalize(self, dataPath, fileNames):
+    # files that are not images are rejected from their headers, without decoding
+    with (self.recorder if self.recorder else NULL_RECORDER).stage("", "scanHeaders"):
+      scanned = list(scanFiles(dataPath, fileNames))
+    for fileName, header, reason in scanned:
+      if header is None:
+        logging.info(f"Not an image: {fileName} ({reason})")
+    # only the settings of the recorder are sent to the workers
+    recorder = StageRecorder(True, self.recorder.traceMemory) if self.recorder and self.recorder.enabled else None
+    tasks = [(self.slowdownPath, dataPath, fileName, self.outputPath, self.cache, recorder, self.pyramidPath, header,
+              self.thumbnailsOnly)
+             for fileName, header, reason in scanned if header is not None]
+    workerCount = min(self.workerCount, len(tasks))
+    if workerCount <= 1:
+      results = map(_equalizeFileTask, tasks)
+    else:
+      results = self._equalizeInPool(tasks, workerCount)
+    for fileName, header, reason in scanned:
+      yield fileName, next(results) if header is not None else None
+
+  def _equalizeInPool(self, tasks, workerCount):
+    context = multiprocessing.get_context("spawn")
+    context.set_executable(pythonExecutable())
+    logging.info(f"Equalizing {len(tasks)} files with {workerCount} workers")
+    task = _equalizeFileSharedTask if self.shareArrays and self.outputPath is None else _equalizeFileTask
+    with context.Pool(workerCount) as pool:
+      results = pool.imap(task, tasks)
+      try:
+        for result in results:
+          if result is not None:
+            result = result._replace(image=self.receiver.attach(result.image),
+                                     equalizedImage=self.receiver.attach(result.equalizedImage))
+          yield result
+      finally:
+        # when the caller stops early (e.g. a cancelled background load) the
+        # workers are stopped and results that already arrived are released
+        pool.terminate()
+        self._releaseArrived(results)
+    self.receiver.collect()
+
+  def _releaseArrived(self, results):
+    while True:
+      try:
+        result = results.next(timeout=0)
+      except (StopIteration, multiprocessing.TimeoutError):
+        break
+      if result is not None:
+        # attaching removes the block's name, the block goes with the array
+        self.receiver.attach(result.image)
+        self.receiver.attach(result.equalizedImage)
+    self.receiver.collect()
+
+  def handoffStatistics(self):
+    """Arrays received from the workers through shared memory, see SharedArrayReceiver.statistics.
+    """
+    self.receiver.collect()
+    return self.receiver.statistics()
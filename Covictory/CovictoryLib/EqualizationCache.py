@@ -0,0 +1,106 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy
+
+#
+# Content addressed cache of equalized images
+#
+# Used from the equalization worker processes, so no slicer imports here.
+#
+
+__all__ = ['EqualizationCache', 'equalizationCodeVersion']
+
+# everything besides the code and the input that determines the equalized array
+EQUALIZATION_PARAMETERS = {"gray": "ImageHeaders.toGray", "dtype": "float32"}
+
+
+def equalizationCodeVersion(slowdownPath):
+  """Hash of the equalization sources of a slowdown-covid19 checkout,
+  so that cached results are not reused after the code changed.
+  """
+  digest = hashlib.sha256()
+  for sourcePath in sorted(glob.glob(os.path.join(slowdownPath, "equalization", "*.py"))):
+    digest.update(os.path.basename(sourcePath).encode("utf-8"))
+    with open(sourcePath, "rb") as fp:
+      digest.update(fp.read())
+  return digest.hexdigest()
+
+
+class EqualizationCache:
+  """Equalized arrays stored as .npy files named by a hash of the input
+  file's contents, the equalization code version and the parameters.
+
+  Hits are memory mapped, so nothing is decoded or copied up front.
+  Every hit or store refreshes the file's modification time and evict()
+  removes the least recently used files until the cache fits in maxBytes.
+  Writes are atomic, so several worker processes can share one cache.
+  """
+
+  def __init__(self, cachePath, maxBytes=4 << 30, codeVersion="", parameters=EQUALIZATION_PARAMETERS):
+    self.cachePath = cachePath
+    self.maxBytes = maxBytes
+    self.keyPrefix = codeVersion + json.dumps(parameters, sort_keys=True)
+    os.makedirs(cachePath, exist_ok=True)
+
+  def key(self, fileHash):
+    return hashlib.sha256((self.keyPrefix + fileHash).encode("utf-8")).hexdigest()
+
+  def path(self, key):
+    return os.path.join(self.cachePath, key + ".npy")
+
+  def get(self, key):
+    """Path of the cached array for key, or None.  Load it with loadArray.
+    """
+    path = self.path(key)
+    try:
+      os.utime(path)
+    except OSError:
+      return None
+    return path
+
+  @staticmethod
+  def loadArray(path):
+    # copy-on-write mapping: pages are read lazily and the array is writable
+    # without ever changing the cache file
+    return numpy.load(path, mmap_mode="c")
+
+  def put(self, key, array):
+    path = self.path(key)
+    temporaryPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    # saved through a file object, so numpy does not append .npy and evict()
+    # of another process does not take the unfinished file for an entry
+    with open(temporaryPath, "wb") as fp:
+      numpy.save(fp, numpy.ascontiguousarray(array))
+    os.replace(temporaryPath, path)
+    return path
+
+  def evict(self):
+    """Remove least recently used entries until the cache fits in maxBytes.
+    Returns the number of removed entries.  Files being written (*.tmp) are not entries.
+    """
+    entries = []
+    for path in glob.glob(os.path.join(self.cachePath, "*.npy")):
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, path))
+    totalBytes = sum(entry[1] for entry in entries)
+    removedCount = 0
+    for mtime, size, path in sorted(entries):
+      if totalBytes <= self.maxBytes:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      totalBytes -= size
+      removedCount += 1
+    if removedCount:
+      logging.info(f"Evicted {removedCount} equalized images from {self.cachePath}")
+    return removedCount
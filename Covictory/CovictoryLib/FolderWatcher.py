@@ -0,0 +1,40 @@
+import qt
+
+#
+# Notification about new files in a data folder
+#
+
+__all__ = ['FolderWatcher']
+
+
+class FolderWatcher:
+  """Calls onChange() when files appear in or change in a folder.
+
+  File system notifications are collected until the folder has been quiet
+  for settleMsec, so a burst of files from the scanner feed is handled as
+  one batch.  Since not every platform reports changes to the contents of
+  existing files, the folder is also rescanned every pollMsec.
+  """
+
+  def __init__(self, dataPath, onChange, settleMsec=2000, pollMsec=30000):
+    self.dataPath = dataPath
+    self.onChange = onChange
+
+    self.settleTimer = qt.QTimer()
+    self.settleTimer.singleShot = True
+    self.settleTimer.interval = settleMsec
+    self.settleTimer.connect('timeout()', self.onChange)
+
+    self.pollTimer = qt.QTimer()
+    self.pollTimer.interval = pollMsec
+    self.pollTimer.connect('timeout()', self.onChange)
+    self.pollTimer.start()
+
+    self.watcher = qt.QFileSystemWatcher()
+    self.watcher.addPath(dataPath)
+    self.watcher.connect('directoryChanged(QString)', lambda path: self.settleTimer.start())
+
+  def stop(self):
+    self.pollTimer.stop()
+    self.settleTimer.stop()
+    self.watcher.removePath(self.dataPath)
@@ -0,0 +1,160 @@
+import collections
+import os
+import struct
+
+import numpy
+
+#
+# Image format sniffing, header-only metadata and single pass decoding
+#
+# Used from the equalization worker processes, so no slicer imports here.
+#
+
+__all__ = ['ImageHeader', 'readHeader', 'scanFiles', 'decodeImage', 'toGray']
+
+ImageHeader = collections.namedtuple('ImageHeader', ['format', 'rows', 'columns', 'channels', 'bitDepth'])
+
+# luminance weights of skimage.color.rgb2gray
+GRAY_WEIGHTS = (0.2125, 0.7154, 0.0721)
+
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+# start of frame markers, all but DHT (C4), JPG (C8) and DAC (CC)
+_JPEG_FRAME_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _pngHeader(fp):
+  data = fp.read(33)
+  if len(data) < 33 or data[12:16] != b"IHDR":
+    raise ValueError("truncated PNG header")
+  columns, rows, bitDepth, colorType = struct.unpack(">IIBB", data[16:26])
+  if colorType not in _PNG_CHANNELS:
+    raise ValueError(f"unknown PNG color type {colorType}")
+  return ImageHeader("png", rows, columns, _PNG_CHANNELS[colorType], bitDepth)
+
+
+def _jpegHeader(fp):
+  fp.seek(2)
+  while True:
+    marker = fp.read(2)
+    while marker == b"\xff\xff":
+      # fill bytes before the marker
+      marker = b"\xff" + fp.read(1)
+    if len(marker) < 2 or marker[0] != 0xFF:
+      raise ValueError("no JPEG frame header")
+    if 0xD0 <= marker[1] <= 0xD9 or marker[1] == 0x01:
+      # markers without a segment
+      continue
+    lengthBytes = fp.read(2)
+    if len(lengthBytes) < 2:
+      raise ValueError("truncated JPEG segment")
+    length = struct.unpack(">H", lengthBytes)[0]
+    if marker[1] in _JPEG_FRAME_MARKERS:
+      data = fp.read(6)
+      if len(data) < 6:
+        raise ValueError("truncated JPEG frame header")
+      bitDepth, rows, columns, channels = struct.unpack(">BHHB", data)
+      return ImageHeader("jpeg", rows, columns, channels, bitDepth)
+    fp.seek(length - 2, os.SEEK_CUR)
+
+
+def _bmpHeader(fp):
+  data = fp.read(30)
+  if len(data) < 26:
+    raise ValueError("truncated BMP header")
+  headerSize = struct.unpack("<I", data[14:18])[0]
+  if headerSize == 12:
+    columns, rows, planes, bitCount = struct.unpack("<HHHH", data[18:26])
+  else:
+    columns, rows, planes, bitCount = struct.unpack("<iiHH", data[18:30])
+  # indexed and 16 bit images are decoded to RGB
+  channels = 4 if bitCount == 32 else 3
+  return ImageHeader("bmp", abs(rows), columns, channels, 8)
+
+
+def _dicomHeader(path):
+  try:
+    import pydicom
+  except ImportError:
+    raise ValueError("DICOM needs pydicom, which is not installed")
+  dataset = pydicom.dcmread(path, stop_before_pixels=True)
+  if "Rows" not in dataset or "Columns" not in dataset:
+    raise ValueError("DICOM file without an image")
+  return ImageHeader("dicom", int(dataset.Rows), int(dataset.Columns),
+                     int(dataset.get("SamplesPerPixel", 1)), int(dataset.get("BitsStored", dataset.get("BitsAllocated", 16))))
+
+
+def readHeader(path):
+  """Format, size, channels and bit depth of a PNG, JPEG, BMP or DICOM file,
+  from its first bytes only.  Raises ValueError for anything else and OSError
+  for files that cannot be read.
+  """
+  with open(path, "rb") as fp:
+    magic = fp.read(8)
+    fp.seek(0)
+    if magic == b"\x89PNG\r\n\x1a\n":
+      header = _pngHeader(fp)
+    elif magic[:3] == b"\xff\xd8\xff":
+      header = _jpegHeader(fp)
+    elif magic[:2] == b"BM":
+      header = _bmpHeader(fp)
+    else:
+      fp.seek(128)
+      if fp.read(4) != b"DICM":
+        raise ValueError("not a PNG, JPEG, BMP or DICOM file")
+      header = None
+  if header is None:
+    header = _dicomHeader(path)
+  if header.rows <= 0 or header.columns <= 0:
+    raise ValueError(f"empty {header.format} image")
+  return header
+
+
+def scanFiles(dataPath, fileNames):
+  """Generator of (fileName, header, reason) for the files of a folder, with
+  header None and the reason it was rejected for files that are not images.
+  """
+  for fileName in fileNames:
+    try:
+      yield fileName, readHeader(os.path.join(dataPath, fileName)), None
+    except (OSError, ValueError, struct.error) as e:
+      yield fileName, None, str(e)
+
+
+def decodeImage(path, header=None):
+  """Decode an image file once, with the decoder for its format: Pillow for
+  PNG, JPEG and BMP, pydicom for DICOM.  Returns (rows, columns) or (rows,
+  columns, channels) arrays like skimage.io.imread, palette images as RGB.
+  """
+  header = header if header else readHeader(path)
+  if header.format == "dicom":
+    import pydicom
+    return pydicom.dcmread(path).pixel_array
+  from PIL import Image
+  with Image.open(path) as image:
+    if image.mode == "P":
+      image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    elif image.mode == "CMYK":
+      image = image.convert("RGB")
+    elif image.mode == "1":
+      image = image.convert("L")
+    return numpy.asarray(image)
+
+
+def toGray(image):
+  """float32 gray image in [0, 1], the same as skimage.color.rgb2gray of the
+  image converted to float, without a float64 copy of the color channels.
+  Images whose color channels are equal (e.g. gray radiographs saved as RGB)
+  take the first channel without weighting.  Alpha is ignored.
+  """
+  scale = numpy.float32(1. / numpy.iinfo(image.dtype).max) if numpy.issubdtype(image.dtype, numpy.integer) else numpy.float32(1)
+  if image.ndim == 2:
+    return numpy.multiply(image, scale, dtype=numpy.float32)
+  if image.shape[2] < 3:
+    return numpy.multiply(image[..., 0], scale, dtype=numpy.float32)
+  red, green, blue = image[..., 0], image[..., 1], image[..., 2]
+  if numpy.array_equal(red, green) and numpy.array_equal(red, blue):
+    return numpy.multiply(red, scale, dtype=numpy.float32)
+  gray = numpy.multiply(red, numpy.float32(GRAY_WEIGHTS[0]) * scale, dtype=numpy.float32)
+  gray += numpy.multiply(green, numpy.float32(GRAY_WEIGHTS[1]) * scale, dtype=numpy.float32)
+  gray += numpy.multiply(blue, numpy.float32(GRAY_WEIGHTS[2]) * scale, dtype=numpy.float32)
+  return gray
@@ -0,0 +1,144 @@
+import contextlib
+import cProfile
+import csv
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+
+#
+# Per image, per stage timing of the Covictory processing
+#
+# No slicer imports, the recorder is also used in the equalization workers.
+#
+
+__all__ = ['StageRecorder', 'NULL_RECORDER']
+
+_nullContext = contextlib.nullcontext()
+
+
+class _Stage:
+
+  def __init__(self, recorder, image, name):
+    self.recorder = recorder
+    self.image = image
+    self.name = name
+
+  def __enter__(self):
+    if self.recorder.traceMemory:
+      tracemalloc.reset_peak()
+      self.memoryStart = tracemalloc.get_traced_memory()[0]
+    self.cpuStart = time.thread_time()
+    self.wallStart = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    wall = time.perf_counter() - self.wallStart
+    cpu = time.thread_time() - self.cpuStart
+    peak = tracemalloc.get_traced_memory()[1] - self.memoryStart if self.recorder.traceMemory else None
+    self.recorder.records.append({
+      "image": self.image, "stage": self.name, "process": os.getpid(),
+      "wall": wall, "cpu": cpu, "peakBytes": peak,
+    })
+    return False
+
+
+class StageRecorder:
+  """Records wall time, CPU time (of the calling thread) and, with
+  traceMemory, the peak of Python/numpy allocations for stages of the
+  processing of each image:
+
+    with recorder.stage(fileName, "equalize"):
+      ...
+
+  The memory peak is that of the whole process during the stage (tracemalloc
+  is process wide), not of the stage alone: stages of the background load
+  also count what the main thread allocates meanwhile, and the other way
+  round.  Only in the worker processes, where one stage runs at a time, is it
+  the peak of the stage itself.
+
+  Stages are not meant to be nested.  A disabled recorder hands out a
+  shared no-op context manager, so instrumented code costs one method call
+  per stage.  Records from worker processes are added with merge().
+  """
+
+  def __init__(self, enabled=False, traceMemory=False):
+    self.enabled = enabled
+    self.traceMemory = traceMemory
+    self.records = []
+    self.profileStats = None
+
+  def stage(self, image, name):
+    if not self.enabled:
+      return _nullContext
+    if self.traceMemory and not tracemalloc.is_tracing():
+      tracemalloc.start()
+    return _Stage(self, image, name)
+
+  def add(self, image, name, wall, cpu=0.):
+    """Record a stage measured elsewhere, e.g. the latency of an asynchronous prediction.
+    """
+    if self.enabled:
+      self.records.append({"image": image, "stage": name, "process": os.getpid(),
+                           "wall": wall, "cpu": cpu, "peakBytes": None})
+
+  def merge(self, records):
+    if self.enabled and records:
+      self.records.extend(records)
+
+  def clear(self):
+    self.records = []
+    self.profileStats = None
+
+  def summary(self):
+    """Per stage count, total and mean wall and CPU seconds, and the largest peak.
+    """
+    stages = {}
+    for record in self.records:
+      entry = stages.setdefault(record["stage"], {"count": 0, "wall": 0., "cpu": 0., "peakBytes": None})
+      entry["count"] += 1
+      entry["wall"] += record["wall"]
+      entry["cpu"] += record["cpu"]
+      if record["peakBytes"] is not None:
+        entry["peakBytes"] = max(entry["peakBytes"] or 0, record["peakBytes"])
+    for entry in stages.values():
+      entry["meanWall"] = entry["wall"] / entry["count"]
+      entry["meanCpu"] = entry["cpu"] / entry["count"]
+    return stages
+
+  columns = ["image", "stage", "process", "wall", "cpu", "peakBytes"]
+
+  def writeJSON(self, path):
+    """Records, summary and profile as JSON; peakBytes is the process peak, see the class documentation.
+    """
+    with open(path, "w") as fp:
+      json.dump({"records": self.records, "summary": self.summary(), "profile": self.profileStats}, fp, indent=2)
+
+  def writeCSV(self, path):
+    with open(path, "w", newline="") as fp:
+      writer = csv.DictWriter(fp, fieldnames=self.columns)
+      writer.writeheader()
+      writer.writerows(self.records)
+
+  @contextlib.contextmanager
+  def profile(self, path=None, top=30):
+    """Capture a cProfile of the enclosed code (e.g. one batch).  The stats
+    are written to path (for snakeviz, pstats, ...) if given and the top
+    functions by cumulative time are kept in profileStats as text.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+      yield profiler
+    finally:
+      profiler.disable()
+      if path:
+        profiler.dump_stats(path)
+      text = io.StringIO()
+      pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(top)
+      self.profileStats = text.getvalue()
+
+
+NULL_RECORDER = StageRecorder(enabled=False)
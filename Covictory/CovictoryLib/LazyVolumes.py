@@ -0,0 +1,166 @@
+import collections
+import json
+import logging
+
+import vtk
+import slicer
+
+from CovictoryLib import Volumes
+from CovictoryLib.Instrumentation import NULL_RECORDER
+# made by the equalization workers, so it lives in a module without slicer
+from CovictoryLib.Pyramid import thumbnailOf
+
+#
+# Volume nodes whose pixels are loaded when they are needed
+#
+
+__all__ = ['LazyVolumes', 'thumbnailOf']
+
+LAZY_ATTRIBUTE = "Covictory.Lazy"
+SOURCE_ATTRIBUTE = "Covictory.Source"
+SHAPE_ATTRIBUTE = "Covictory.Shape"
+
+
+_Entry = collections.namedtuple('_Entry', ['load', 'thumbnail', 'step'])
+
+
+class LazyVolumes:
+  """Placeholder volume nodes that only hold a thumbnail until the pixels are needed.
+
+  A placeholder is a normal volume node with the geometry of the full
+  image, so it is listed, selected and shown like any other volume.  Its
+  pixels are loaded (by calling the load function given for it) when it is
+  shown in a slice view, or when materialize() is called, e.g. before it is
+  sent for prediction.  Loaded volumes that were not used recently and are
+  not shown go back to their thumbnail when the loaded pixels exceed
+  memoryBudgetBytes.
+  """
+
+  def __init__(self, memoryBudgetBytes=2 << 30, scene=None):
+    self.memoryBudgetBytes = memoryBudgetBytes
+    self.scene = scene if scene else slicer.mrmlScene
+    self.recorder = NULL_RECORDER
+    self._entries = {}
+    # node ID -> loaded bytes, least recently used first
+    self._loaded = collections.OrderedDict()
+    self.loadCount = 0
+    self.evictionCount = 0
+    self._observations = []
+
+  @property
+  def loadedBytes(self):
+    return sum(self._loaded.values())
+
+  def addPlaceholder(self, name, imageShape, thumbnail, step, load, source=None):
+    """Add a volume node for an image of imageShape (rows, columns[, channels])
+    that shows thumbnail, subsampled by step (see thumbnailOf), until load()
+    is called to get the full image array.  source is kept as metadata.
+    """
+    volumeNode = Volumes.volumeNodeFromImageArray(thumbnail, name, self.scene)
+    volumeNode.SetSpacing(step, step, 1.)
+    volumeNode.SetAttribute(LAZY_ATTRIBUTE, "placeholder")
+    volumeNode.SetAttribute(SHAPE_ATTRIBUTE, json.dumps(list(imageShape)))
+    if source:
+      volumeNode.SetAttribute(SOURCE_ATTRIBUTE, source)
+    self._entries[volumeNode.GetID()] = _Entry(load, thumbnail, step)
+    return volumeNode
+
+  def isPlaceholder(self, volumeNode):
+    return volumeNode.GetID() in self._entries and volumeNode.GetID() not in self._loaded
+
+  def materialize(self, volumeNode):
+    """Load the full pixels of a placeholder (nothing to do for other volumes)
+    and mark it as most recently used.  Returns the node.
+    """
+    nodeID = volumeNode.GetID()
+    entry = self._entries.get(nodeID)
+    if entry is None:
+      return volumeNode
+    if nodeID in self._loaded:
+      self._loaded.move_to_end(nodeID)
+      return volumeNode
+    with self.recorder.stage(volumeNode.GetName(), "materialize"):
+      imageArray = entry.load()
+      Volumes.setVolumeImageArray(volumeNode, imageArray)
+    volumeNode.SetAttribute(LAZY_ATTRIBUTE, "loaded")
+    self._loaded[nodeID] = imageArray.nbytes
+    self.loadCount += 1
+    self.trim()
+    return volumeNode
+
+  def evict(self, volumeNode):
+    """Drop the full pixels of a loaded placeholder, showing its thumbnail again.
+    """
+    nodeID = volumeNode.GetID()
+    if self._loaded.pop(nodeID, None) is None:
+      return
+    entry = self._entries[nodeID]
+    Volumes.setVolumeImageArray(volumeNode, entry.thumbnail, entry.step)
+    volumeNode.SetAttribute(LAZY_ATTRIBUTE, "placeholder")
+    self.evictionCount += 1
+
+  def trim(self):
+    """Evict least recently used volumes that are not shown until the loaded
+    pixels fit in the memory budget.
+    """
+    if self.loadedBytes <= self.memoryBudgetBytes:
+      return
+    shownIDs = self.shownVolumeIDs()
+    for nodeID in list(self._loaded):
+      if self.loadedBytes <= self.memoryBudgetBytes:
+        break
+      if nodeID in shownIDs:
+        continue
+      volumeNode = self.scene.GetNodeByID(nodeID)
+      if volumeNode:
+        self.evict(volumeNode)
+      else:
+        del self._loaded[nodeID]
+
+  def shownVolumeIDs(self):
+    """IDs of the volumes shown in any slice view."""
+    shownIDs = set()
+    for compositeNode in slicer.util.getNodesByClass("vtkMRMLSliceCompositeNode", self.scene):
+      shownIDs.update([compositeNode.GetBackgroundVolumeID(), compositeNode.GetForegroundVolumeID(),
+                       compositeNode.GetLabelVolumeID()])
+    shownIDs.discard(None)
+    return shownIDs
+
+  def startObserving(self):
+    """Materialize placeholders as soon as they are shown in a slice view.
+    """
+    if self._observations:
+      return
+    for compositeNode in slicer.util.getNodesByClass("vtkMRMLSliceCompositeNode", self.scene):
+      self._observe(compositeNode)
+    self._observations.append((self.scene, self.scene.AddObserver(slicer.vtkMRMLScene.NodeAddedEvent, self._onNodeAdded)))
+    self._observations.append((self.scene, self.scene.AddObserver(slicer.vtkMRMLScene.NodeRemovedEvent, self._onNodeRemoved)))
+
+  def stopObserving(self):
+    for observed, tag in self._observations:
+      observed.RemoveObserver(tag)
+    self._observations = []
+
+  def _observe(self, compositeNode):
+    self._observations.append((compositeNode, compositeNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self._onCompositeModified)))
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def _onNodeAdded(self, caller, event, node):
+    if node.IsA("vtkMRMLSliceCompositeNode"):
+      self._observe(node)
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def _onNodeRemoved(self, caller, event, node):
+    nodeID = node.GetID()
+    self._entries.pop(nodeID, None)
+    self._loaded.pop(nodeID, None)
+    self._observations = [(observed, tag) for observed, tag in self._observations if observed is not node]
+
+  def _onCompositeModified(self, compositeNode, event):
+    for volumeID in [compositeNode.GetBackgroundVolumeID(), compositeNode.GetForegroundVolumeID()]:
+      if volumeID in self._entries:
+        volumeNode = self.scene.GetNodeByID(volumeID)
+        try:
+          self.materialize(volumeNode)
+        except Exception as e:
+          logging.error(f"Could not load {volumeNode.GetName()}: {e}")
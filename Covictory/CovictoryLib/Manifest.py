@@ -0,0 +1,96 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+#
+# Persistent record of processed input files
+#
+
+__all__ = ['IngestManifest', 'contentHash']
+
+
+def contentHash(path, blockSize=1 << 20):
+  """SHA-256 hex digest of the file's contents.
+  """
+  digest = hashlib.sha256()
+  with open(path, "rb") as fp:
+    for block in iter(lambda: fp.read(blockSize), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+class IngestManifest:
+  """Remembers which files of a data folder have been processed.
+
+  Entries are keyed by path and store size, modification time and content
+  hash.  A file counts as changed when it is new or its contents differ;
+  if only size or mtime differ the hash is compared before deciding, so a
+  touched but identical file is not processed again.  The manifest is a
+  JSON file written atomically, so an interrupted run resumes where it stopped.
+  """
+
+  version = 1
+
+  def __init__(self, manifestPath):
+    self.manifestPath = manifestPath
+    self.entries = {}
+    self._hashes = {}
+    self._unsavedCount = 0
+    if os.path.exists(manifestPath):
+      try:
+        with open(manifestPath) as fp:
+          manifest = json.load(fp)
+        if manifest.get("version") == self.version:
+          self.entries = manifest["files"]
+      except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"Ignoring unreadable manifest {manifestPath}: {e}")
+
+  def changedFiles(self, dataPath, fileNames, minimumAge=0):
+    """Return the file names in dataPath that are new or changed since recorded.
+    Files modified less than minimumAge seconds ago are left for a later call,
+    since they may still be being written.
+    """
+    changed = []
+    now = time.time()
+    for fileName in fileNames:
+      path = os.path.abspath(os.path.join(dataPath, fileName))
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      if not os.path.isfile(path) or now - stat.st_mtime < minimumAge:
+        continue
+      entry = self.entries.get(path)
+      if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+        continue
+      fileHash = contentHash(path)
+      if entry and entry["hash"] == fileHash:
+        entry["size"], entry["mtime"] = stat.st_size, stat.st_mtime
+        continue
+      self._hashes[path] = (fileHash, stat.st_size, stat.st_mtime)
+      changed.append(fileName)
+    return changed
+
+  def record(self, dataPath, fileName, status, saveEvery=50):
+    """Mark a file as handled ("processed" or "skipped") with its current state.
+    """
+    path = os.path.abspath(os.path.join(dataPath, fileName))
+    if path in self._hashes:
+      fileHash, size, mtime = self._hashes.pop(path)
+    else:
+      stat = os.stat(path)
+      fileHash, size, mtime = contentHash(path), stat.st_size, stat.st_mtime
+    self.entries[path] = {"size": size, "mtime": mtime, "hash": fileHash, "status": status}
+    self._unsavedCount += 1
+    if self._unsavedCount >= saveEvery:
+      self.save()
+
+  def save(self):
+    os.makedirs(os.path.dirname(os.path.abspath(self.manifestPath)), exist_ok=True)
+    temporaryPath = self.manifestPath + ".tmp"
+    with open(temporaryPath, "w") as fp:
+      json.dump({"version": self.version, "files": self.entries}, fp)
+    os.replace(temporaryPath, self.manifestPath)
+    self._unsavedCount = 0
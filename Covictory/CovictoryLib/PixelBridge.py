@@ -0,0 +1,325 @@
+import base64
+import collections
+import http.server
+import json
+import logging
+import queue
+import secrets
+import threading
+import time
+import urllib.parse
+
+from .Instrumentation import NULL_RECORDER
+
+#
+# Binary transfer of pixel data to the Covictory web page
+#
+# Arrays are served in fixed size chunks by a local HTTP server and the page
+# pulls them into a typed array, so no base64 text or JavaScript source is
+# generated for the pixels.  The page reports each finished image back to
+# the server.  All bookkeeping and callbacks happen in poll(), which must be
+# called regularly from the main thread (e.g. by a QTimer); the server
+# threads only read published buffers and queue events.
+#
+# Every request must carry the random token of the bridge (the first path
+# segment of its url, only given to the page in the shim script) and come
+# from the page's origin, so other local pages can neither read the pixels
+# nor post results.
+#
+
+__all__ = ['PixelBridge', 'PixelTransfer', 'pageOrigin']
+
+
+def pageOrigin(url):
+  """Origin the browser sends in requests of the page at url: scheme, host
+  and port for http(s) pages, "null" for others (e.g. local files).
+  """
+  parts = urllib.parse.urlsplit(str(url))
+  if parts.scheme not in ("http", "https") or not parts.hostname:
+    return "null"
+  defaultPort = 80 if parts.scheme == "http" else 443
+  port = f":{parts.port}" if parts.port and parts.port != defaultPort else ""
+  return f"{parts.scheme}://{parts.hostname}{port}"
+
+
+# Installed in the page once; receive() is called for every published image.
+# Uses predictFromImageArray(name, rows, columns, typedArray) when the page
+# provides it and falls back to predictFromBase64Image with base64 made in
+# the page from the received bytes.  receiveBase64() is the classic path
+# with the base64 string in the script source, only adding the report back.
+SHIM_SCRIPT = """
+if (window.slicerPixelBridge === undefined || window.slicerPixelBridge.url !== "%(url)s") {
+  window.slicerPixelBridge = {
+    url: "%(url)s",
+    typedArrays: {
+      uint8: Uint8Array, int8: Int8Array, uint16: Uint16Array, int16: Int16Array,
+      uint32: Uint32Array, int32: Int32Array, float32: Float32Array, float64: Float64Array,
+    },
+    toBase64: function(bytes) {
+      let binary = "";
+      for (let offset = 0; offset < bytes.length; offset += 0x8000) {
+        binary += String.fromCharCode.apply(null, bytes.subarray(offset, offset + 0x8000));
+      }
+      return btoa(binary);
+    },
+    notify: function(kind, id, body) {
+      return fetch(this.url + "/" + kind + "/" + id, {method: "POST", body: JSON.stringify(body)});
+    },
+    receiveBase64: async function(id, name, rows, columns, imageString) {
+      const startTime = performance.now();
+      try {
+        const result = await predictFromBase64Image(name, rows, columns, imageString);
+        await this.notify("done", id, {result: result === undefined ? null : result, milliseconds: performance.now() - startTime});
+      } catch (error) {
+        await this.notify("done", id, {error: String(error)});
+      }
+    },
+    receive: async function(id, name, rows, columns, dtype, byteCount, chunkCount) {
+      const startTime = performance.now();
+      let result = null;
+      try {
+        const bytes = new Uint8Array(byteCount);
+        let offset = 0;
+        for (let chunk = 0; chunk < chunkCount; chunk++) {
+          const response = await fetch(this.url + "/pixels/" + id + "/" + chunk);
+          if (!response.ok) {
+            throw new Error("chunk " + chunk + ": " + response.status);
+          }
+          const data = new Uint8Array(await response.arrayBuffer());
+          bytes.set(data, offset);
+          offset += data.length;
+        }
+        if (window.predictFromImageArray !== undefined) {
+          const pixels = new this.typedArrays[dtype](bytes.buffer);
+          result = await predictFromImageArray(name, rows, columns, pixels);
+        } else {
+          result = await predictFromBase64Image(name, rows, columns, this.toBase64(bytes));
+        }
+        await this.notify("done", id, {result: result === undefined ? null : result, milliseconds: performance.now() - startTime});
+      } catch (error) {
+        await this.notify("done", id, {error: String(error)});
+      }
+    },
+  };
+}
+"""
+
+
+class PixelTransfer:
+  """One image on its way to the page.
+  """
+
+  def __init__(self, transferId, name, imageArray, chunkSize, onComplete, encoding="binary"):
+    self.id = transferId
+    self.encoding = encoding
+    self.name = name
+    self.array = imageArray
+    # arrays from arrayFromVolume are (slices, rows, columns[, channels])
+    self.rows = imageArray.shape[-3] if imageArray.ndim == 4 else imageArray.shape[-2]
+    self.columns = imageArray.shape[-2] if imageArray.ndim == 4 else imageArray.shape[-1]
+    self.dtype = imageArray.dtype.name
+    self.bytes = memoryview(imageArray).cast('B')
+    self.chunkSize = chunkSize
+    self.chunkCount = max(1, -(-len(self.bytes) // chunkSize))
+    self.onComplete = onComplete
+    self.submitTime = time.perf_counter()
+    self.startTime = None
+    self.completeTime = None
+    self.response = None
+
+  def chunk(self, index):
+    return self.bytes[index*self.chunkSize:(index+1)*self.chunkSize]
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+  def _corsHeaders(self):
+    self.send_header("Access-Control-Allow-Origin", self.server.bridge.origin)
+    self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+    self.send_header("Access-Control-Allow-Headers", "Content-Type")
+    self.send_header("Vary", "Origin")
+
+  def _authorizedParts(self):
+    """Path segments after the token, or None (and a 403 answer) if the
+    request does not have the token or comes from another origin."""
+    bridge = self.server.bridge
+    parts = self.path.strip("/").split("/")
+    if (self.headers.get("Origin") != bridge.origin
+        or not secrets.compare_digest(parts[0].encode("utf-8"), bridge.token.encode("utf-8"))):
+      self.send_response(403)
+      self.end_headers()
+      return None
+    return parts[1:]
+
+  def do_OPTIONS(self):
+    if self._authorizedParts() is None:
+      return
+    self.send_response(204)
+    self._corsHeaders()
+    self.end_headers()
+
+  def do_GET(self):
+    parts = self._authorizedParts()
+    if parts is None:
+      return
+    transfer = None
+    if len(parts) == 3 and parts[0] == "pixels":
+      transfer = self.server.bridge._published.get(parts[1])
+    if transfer is None or not parts[2].isdigit() or int(parts[2]) >= transfer.chunkCount:
+      self.send_response(404)
+      self._corsHeaders()
+      self.end_headers()
+      return
+    data = transfer.chunk(int(parts[2]))
+    self.send_response(200)
+    self._corsHeaders()
+    self.send_header("Content-Type", "application/octet-stream")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_POST(self):
+    parts = self._authorizedParts()
+    if parts is None:
+      return
+    length = int(self.headers.get("Content-Length", 0))
+    body = self.rfile.read(length).decode("utf-8") if length else ""
+    if len(parts) == 2:
+      self.server.bridge._events.put((parts[0], parts[1], body))
+      self.send_response(204)
+    else:
+      self.send_response(404)
+    self._corsHeaders()
+    self.end_headers()
+
+  def log_message(self, format, *args):
+    logging.debug("PixelBridge: " + format % args)
+
+
+class PixelBridge:
+  """Sends image arrays to the Covictory page in binary chunks.
+
+  evalJS is called with short scripts telling the page to fetch an image.
+  At most maxInFlight images are published to the page at a time, the others
+  wait in submission order, holding only a reference to their array.
+  onComplete(transfer) is called from poll() once the page is done with an
+  image; transfer.response holds the decoded JSON the page reported, with
+  an "error" entry if the page failed or did not answer within timeout seconds.
+  With the "base64" encoding the pixels are sent inside the evalJS source as
+  before, but still with the in flight limit and the report back.
+  Other events posted by the page (e.g. /notify/tag) are passed to onEvent(kind, tag, body).
+  origin is the origin of the page (see pageOrigin), the only one answered.
+  """
+
+  def __init__(self, evalJS, origin, chunkSize=1 << 20, maxInFlight=2, onEvent=None, timeout=None):
+    self.evalJS = evalJS
+    self.origin = origin
+    self.token = secrets.token_urlsafe(16)
+    self.chunkSize = chunkSize
+    self.maxInFlight = maxInFlight
+    self.timeout = timeout
+    self.onEvent = onEvent
+    # StageRecorder for the encoding and evalJS time of each image
+    self.recorder = NULL_RECORDER
+    self._waiting = collections.deque()
+    self._published = {}
+    self._events = queue.Queue()
+    self._nextId = 0
+    self._server = None
+    self._thread = None
+    self.bytesSent = 0
+
+  @property
+  def url(self):
+    host, port = self._server.server_address[:2]
+    return f"http://{host}:{port}/{self.token}"
+
+  def start(self):
+    if self._server:
+      return
+    self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    self._server.daemon_threads = True
+    self._server.bridge = self
+    self._thread = threading.Thread(target=self._server.serve_forever, name="PixelBridge", daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    if not self._server:
+      return
+    self._server.shutdown()
+    self._server.server_close()
+    self._thread.join()
+    self._server = None
+    self._thread = None
+
+  def shimScript(self):
+    """JavaScript defining window.slicerPixelBridge in the page.
+    """
+    return SHIM_SCRIPT % {"url": self.url}
+
+  def send(self, name, imageArray, onComplete=None, encoding="binary"):
+    """Queue an array for transfer.  The array must be C contiguous and must
+    not be modified until the transfer completed.
+    """
+    self.start()
+    transfer = PixelTransfer(str(self._nextId), name, imageArray, self.chunkSize, onComplete, encoding)
+    self._nextId += 1
+    self._waiting.append(transfer)
+    self._publish()
+    return transfer
+
+  @property
+  def pendingCount(self):
+    return len(self._waiting) + len(self._published)
+
+  def poll(self):
+    """Process events from the page and publish waiting images.  Main thread only.
+    """
+    while True:
+      try:
+        kind, tag, body = self._events.get_nowait()
+      except queue.Empty:
+        break
+      if kind == "done":
+        # reports for transfers that already timed out are dropped
+        if tag in self._published:
+          self._complete(self._published.pop(tag), json.loads(body) if body else {})
+      elif self.onEvent:
+        self.onEvent(kind, tag, body)
+    if self.timeout is not None:
+      now = time.perf_counter()
+      for transfer in list(self._published.values()):
+        if now - transfer.startTime > self.timeout:
+          del self._published[transfer.id]
+          self._complete(transfer, {"error": f"no answer after {self.timeout} seconds"})
+    self._publish()
+
+  def _complete(self, transfer, response):
+    transfer.completeTime = time.perf_counter()
+    transfer.response = response
+    if "error" in response:
+      logging.error(f"Transfer of {transfer.name} failed: {response['error']}")
+    else:
+      self.bytesSent += len(transfer.bytes)
+    if transfer.onComplete:
+      transfer.onComplete(transfer)
+
+  def _publish(self):
+    while self._waiting and len(self._published) < self.maxInFlight:
+      transfer = self._waiting.popleft()
+      transfer.startTime = time.perf_counter()
+      self._published[transfer.id] = transfer
+      if transfer.encoding == "base64":
+        with self.recorder.stage(transfer.name, "base64"):
+          imageString = str(base64.b64encode(transfer.array))[2:-1]
+        with self.recorder.stage(transfer.name, "evalJS"):
+          self.evalJS(self.shimScript() + f"""
+            window.slicerPixelBridge.receiveBase64({json.dumps(transfer.id)}, {json.dumps(transfer.name)},
+              {transfer.rows}, {transfer.columns}, "{imageString}");
+          """)
+        continue
+      with self.recorder.stage(transfer.name, "evalJS"):
+        self.evalJS(self.shimScript() + f"""
+          window.slicerPixelBridge.receive({json.dumps(transfer.id)}, {json.dumps(transfer.name)},
+            {transfer.rows}, {transfer.columns}, {json.dumps(transfer.dtype)}, {len(transfer.bytes)}, {transfer.chunkCount});
+        """)
@@ -0,0 +1,141 @@
+import collections
+import json
+import logging
+import time
+
+import numpy
+import slicer
+
+from .Instrumentation import NULL_RECORDER
+
+#
+# Prediction queue for the Covictory web page or a local model
+#
+
+__all__ = ['PredictionQueue']
+
+PREDICTION_ATTRIBUTE = "Covictory.Prediction"
+# node reference from an original volume to its equalized volume
+EQUALIZED_REFERENCE = "Covictory.Equalized"
+
+
+class PredictionQueue:
+  """Sends volume nodes to a prediction backend and collects the results.
+
+  The backend is a PixelBridge to the Covictory page, which bounds the
+  number of images in flight and times out images the page does not answer,
+  or a LocalPredictor running a model in process (see Predictors).  With
+  inputReference set, the pixels of the volume referenced with that role
+  (e.g. EQUALIZED_REFERENCE) are predicted instead of the submitted
+  volume's, and the result is still stored with the submitted volume.  Each result is
+  stored as JSON in the volume node's "Covictory.Prediction" attribute and as
+  a row of the "Covictory Predictions" table node, together with the latency.
+  onPrediction(volumeNode, response) is called for every finished image.
+
+  Nodes wait in the queue until the bridge has room for them, and their
+  pixels are only read then, after calling prepare(volumeNode) if set (e.g.
+  to load a lazy volume), so a large batch does not hold all images at once.
+  """
+
+  columnNames = ["Name", "Volume", "Status", "Latency (ms)", "Page time (ms)", "Prediction"]
+
+  def __init__(self, predictor, encoding="binary", onPrediction=None):
+    self.predictor = predictor
+    self.encoding = encoding
+    self.inputReference = None
+    self.onPrediction = onPrediction
+    self.recorder = NULL_RECORDER
+    self.prepare = None
+    # (node ID, submit time) of the nodes not yet handed to the bridge
+    self._waitingNodes = collections.deque()
+    self.tableNode = None
+    self.latencies = []
+    self.failedCount = 0
+    self.submittedCount = 0
+    self.startTime = None
+    self.endTime = None
+
+  def _predictionTable(self):
+    if self.tableNode and slicer.mrmlScene.IsNodePresent(self.tableNode):
+      return self.tableNode
+    self.tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", "Covictory Predictions")
+    for columnName in self.columnNames:
+      self.tableNode.AddColumn().SetName(columnName)
+    return self.tableNode
+
+  def submit(self, volumeNode):
+    """Queue a volume node for prediction.
+    """
+    if self.startTime is None:
+      self.startTime = time.perf_counter()
+    self.submittedCount += 1
+    self._waitingNodes.append((volumeNode.GetID(), time.perf_counter()))
+    self._sendWaiting()
+
+  @property
+  def pendingCount(self):
+    return len(self._waitingNodes) + self.predictor.pendingCount
+
+  def _sendWaiting(self):
+    while self._waitingNodes and self.predictor.pendingCount < self.predictor.maxInFlight:
+      nodeID, submitTime = self._waitingNodes.popleft()
+      volumeNode = slicer.mrmlScene.GetNodeByID(nodeID)
+      try:
+        if volumeNode is None:
+          raise ValueError("the volume was removed")
+        inputNode = volumeNode.GetNodeReference(self.inputReference) if self.inputReference else volumeNode
+        if inputNode is None:
+          raise ValueError(f"{volumeNode.GetName()} has no {self.inputReference} volume")
+        if self.prepare:
+          self.prepare(inputNode)
+        imageArray = slicer.util.arrayFromVolume(inputNode)
+      except Exception as e:
+        self.failedCount += 1
+        logging.error(f"Cannot predict {nodeID}: {e}")
+        continue
+      onComplete = lambda transfer, nodeID=nodeID, submitTime=submitTime: self._onComplete(nodeID, submitTime, transfer)
+      self.predictor.send(volumeNode.GetName(), imageArray, onComplete, self.encoding)
+
+  def _onComplete(self, nodeID, submitTime, transfer):
+    self.endTime = transfer.completeTime
+    latency = transfer.completeTime - submitTime
+    response = transfer.response
+    error = response.get("error")
+    if error:
+      self.failedCount += 1
+    else:
+      self.latencies.append(latency)
+      self.recorder.add(transfer.name, "prediction", transfer.completeTime - transfer.startTime)
+
+    volumeNode = slicer.mrmlScene.GetNodeByID(nodeID)
+    if volumeNode and not error:
+      volumeNode.SetAttribute(PREDICTION_ATTRIBUTE, json.dumps(response.get("result")))
+
+    tableNode = self._predictionTable()
+    row = tableNode.AddEmptyRow()
+    tableNode.SetCellText(row, 0, transfer.name)
+    tableNode.SetCellText(row, 1, nodeID)
+    tableNode.SetCellText(row, 2, f"failed: {error}" if error else "ok")
+    tableNode.SetCellText(row, 3, f"{latency * 1000:.1f}")
+    tableNode.SetCellText(row, 4, f"{response.get('milliseconds', 0):.1f}")
+    tableNode.SetCellText(row, 5, "" if error else json.dumps(response.get("result")))
+
+    if self.onPrediction:
+      self.onPrediction(volumeNode, response)
+    self._sendWaiting()
+    if self.pendingCount == 0:
+      logging.info(f"Predictions completed: {self.statistics()}")
+
+  def statistics(self):
+    """Throughput (images per second) and latency (seconds) of the completed predictions.
+    """
+    completedCount = len(self.latencies) + self.failedCount
+    elapsed = (self.endTime - self.startTime) if self.endTime and self.startTime else 0
+    return {
+      "submitted": self.submittedCount,
+      "completed": len(self.latencies),
+      "failed": self.failedCount,
+      "imagesPerSecond": completedCount / elapsed if elapsed > 0 else 0,
+      "meanLatency": float(numpy.mean(self.latencies)) if self.latencies else 0,
+      "maxLatency": float(numpy.max(self.latencies)) if self.latencies else 0,
+    }
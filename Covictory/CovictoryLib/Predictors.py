@@ -0,0 +1,271 @@
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy
+
+from .ImageHeaders import toGray
+from .Instrumentation import NULL_RECORDER
+
+#
+# Prediction backends
+#
+# A backend takes images with send(name, imageArray, onComplete), has room
+# for maxInFlight of them at a time (pendingCount), and calls
+# onComplete(transfer) from poll() on the main thread, with the response
+# dictionary ("result" or "error", and "milliseconds") in transfer.response.
+# The PixelBridge to the Covictory web page is one backend, LocalPredictor
+# running an exported model in this process is the other.
+#
+# No slicer imports here, so the benchmarks run with plain python.
+#
+
+__all__ = ['LocalPredictor', 'LocalPrediction', 'OnnxModel', 'TFLiteModel', 'loadModel']
+
+
+class OnnxModel:
+  """Exported model run with ONNX Runtime on the CPU.  threadCount is the
+  number of threads used within each inference, None for one per core.
+  """
+
+  def __init__(self, path, threadCount=None):
+    try:
+      import onnxruntime
+    except ImportError:
+      raise ImportError("ONNX models need the onnxruntime package (pip_install('onnxruntime'))")
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threadCount if threadCount else 0
+    self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+    modelInput = self.session.get_inputs()[0]
+    self.inputName = modelInput.name
+    # batch and possibly other dimensions are names or None when they are dynamic
+    self.inputShape = tuple(size if isinstance(size, int) else None for size in modelInput.shape)
+
+  def run(self, batch):
+    return self.session.run(None, {self.inputName: batch})[0]
+
+
+class TFLiteModel:
+  """Exported model run with the TensorFlow Lite interpreter, from the
+  tflite_runtime package or from TensorFlow.
+  """
+
+  def __init__(self, path, threadCount=None):
+    try:
+      from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+      try:
+        from tensorflow.lite import Interpreter
+      except ImportError:
+        raise ImportError("TF-Lite models need the tflite-runtime or tensorflow package (pip_install('tflite-runtime'))")
+    self.interpreter = Interpreter(model_path=path, num_threads=threadCount)
+    self.interpreter.allocate_tensors()
+    self._input = self.interpreter.get_input_details()[0]
+    self._output = self.interpreter.get_output_details()[0]
+    shape = self._input.get("shape_signature", self._input["shape"])
+    self.inputShape = tuple(int(size) if size > 0 else None for size in shape)
+    self._batchSize = int(self._input["shape"][0])
+
+  def run(self, batch):
+    if batch.shape[0] != self._batchSize:
+      self.interpreter.resize_tensor_input(self._input["index"], batch.shape)
+      self.interpreter.allocate_tensors()
+      self._batchSize = batch.shape[0]
+    self.interpreter.set_tensor(self._input["index"], batch.astype(self._input["dtype"], copy=False))
+    self.interpreter.invoke()
+    return self.interpreter.get_tensor(self._output["index"])
+
+
+def loadModel(path, threadCount=None):
+  """OnnxModel or TFLiteModel for an exported model file, by its extension.
+  """
+  extension = os.path.splitext(path)[1].lower()
+  if extension == ".onnx":
+    return OnnxModel(path, threadCount)
+  if extension == ".tflite":
+    return TFLiteModel(path, threadCount)
+  raise ValueError(f"{path} is not an .onnx or .tflite model")
+
+
+class LocalPrediction:
+  """One image on its way through the local model, with the same fields as
+  a PixelTransfer for the callbacks.
+  """
+
+  def __init__(self, name, imageArray, onComplete):
+    self.name = name
+    self.array = imageArray
+    self.onComplete = onComplete
+    self.startTime = time.perf_counter()
+    self.completeTime = None
+    self.response = None
+
+
+class LocalPredictor:
+  """Runs an exported model (see loadModel) in this process on batches of
+  images, instead of sending them one by one to the web page.
+
+  Images are converted to gray in [0, 1] (equalized images already are),
+  resized to the model input and stacked into batches of up to batchSize,
+  in a background thread.  The images of a batch are preprocessed by
+  preprocessThreads threads (default one per core, at most batchSize) and
+  the model uses its own threads within each batch.  Both release the GIL,
+  so the application stays responsive.
+
+  Single channel models (channels first or last) and three channel models
+  (the gray image repeated) are supported; mean and std normalize the input
+  as (image - mean) / std.
+
+  The first model output is the result of each image: its values keyed by
+  labels if given, or as "scores".
+  """
+
+  def __init__(self, model, batchSize=8, labels=None, mean=0., std=1., maxInFlight=None, preprocessThreads=None):
+    self.model = model
+    self.batchSize = batchSize
+    self.labels = labels
+    self.mean = mean
+    self.std = std
+    # enough images to fill the next batch while one is running
+    self.maxInFlight = maxInFlight if maxInFlight else 2 * batchSize
+    self.recorder = NULL_RECORDER
+    self.batchCount = 0
+    self._inputs = queue.Queue()
+    self._done = queue.Queue()
+    self._pendingCount = 0
+    self._thread = None
+    preprocessThreads = preprocessThreads if preprocessThreads else min(batchSize, os.cpu_count() or 1)
+    self._preprocessPool = concurrent.futures.ThreadPoolExecutor(preprocessThreads) if preprocessThreads > 1 else None
+
+    shape = model.inputShape
+    if len(shape) != 4:
+      raise ValueError(f"expected a model with a (batch, rows, columns, channels) or (batch, channels, rows, columns) input, not {shape}")
+    self.channelsFirst = shape[1] in (1, 3) and shape[3] not in (1, 3)
+    self.channels, self.rows, self.columns = (shape[1], shape[2], shape[3]) if self.channelsFirst else (shape[3], shape[1], shape[2])
+    if self.channels not in (1, 3):
+      raise ValueError(f"expected a model with 1 or 3 input channels, not {shape}")
+
+  def start(self):
+    if self._thread is None:
+      self._thread = threading.Thread(target=self._run, name="LocalPredictor", daemon=True)
+      self._thread.start()
+
+  def stop(self):
+    if self._thread is not None:
+      self._inputs.put(None)
+      self._thread.join()
+      self._thread = None
+    if self._preprocessPool:
+      self._preprocessPool.shutdown()
+      self._preprocessPool = None
+
+  def send(self, name, imageArray, onComplete=None, encoding=None):
+    """Queue an image for prediction (encoding is only used by the web page).
+    The array must not be modified until the prediction completed.
+    """
+    self.start()
+    prediction = LocalPrediction(name, imageArray, onComplete)
+    self._pendingCount += 1
+    self._inputs.put(prediction)
+    return prediction
+
+  @property
+  def pendingCount(self):
+    return self._pendingCount
+
+  def poll(self):
+    """Call the callbacks of the finished predictions.  Main thread only.
+    """
+    while True:
+      try:
+        prediction = self._done.get_nowait()
+      except queue.Empty:
+        break
+      self._pendingCount -= 1
+      if "error" in prediction.response:
+        logging.error(f"Prediction of {prediction.name} failed: {prediction.response['error']}")
+      if prediction.onComplete:
+        prediction.onComplete(prediction)
+
+  def preprocess(self, imageArray):
+    """Model input of one image, without the batch axis.
+    """
+    from PIL import Image
+    imageArray = numpy.asarray(imageArray)
+    # volume arrays have a slice axis
+    if imageArray.ndim == 4 or (imageArray.ndim == 3 and imageArray.shape[0] == 1):
+      imageArray = imageArray[0]
+    # equalized images are used as they are, without a copy
+    gray = imageArray if imageArray.ndim == 2 and imageArray.dtype == numpy.float32 else toGray(imageArray)
+    if gray.shape != (self.rows, self.columns):
+      # box reduction by an integer factor before the bilinear resampling,
+      # about twice as fast as resampling the full image
+      gray = numpy.asarray(Image.fromarray(gray).resize((self.columns, self.rows), Image.BILINEAR, reducing_gap=2.))
+    if self.mean or self.std != 1.:
+      gray = (gray - numpy.float32(self.mean)) / numpy.float32(self.std)
+    channelAxis = 0 if self.channelsFirst else 2
+    return numpy.repeat(numpy.expand_dims(gray, channelAxis), self.channels, axis=channelAxis)
+
+  def results(self, output):
+    """Result dictionaries from the first model output of a batch.
+    """
+    results = []
+    for scores in output.reshape(len(output), -1).tolist():
+      results.append(dict(zip(self.labels, scores)) if self.labels else {"scores": scores})
+    return results
+
+  def predictBatch(self, imageArrays):
+    """Results of a list of images, computed in one model run, in the calling thread.
+    """
+    return self.results(self.model.run(self._batch(list(self._map(self.preprocess, imageArrays)))))
+
+  def _map(self, function, items):
+    return self._preprocessPool.map(function, items) if self._preprocessPool and len(items) > 1 else map(function, items)
+
+  @staticmethod
+  def _batch(inputs):
+    return numpy.stack(inputs).astype(numpy.float32, copy=False)
+
+  def _preprocessOrError(self, imageArray):
+    try:
+      return self.preprocess(imageArray), None
+    except Exception as e:
+      return None, f"cannot prepare the image: {e}"
+
+  def _run(self):
+    while True:
+      predictions = [self._inputs.get()]
+      while len(predictions) < self.batchSize:
+        try:
+          predictions.append(self._inputs.get_nowait())
+        except queue.Empty:
+          break
+      stopping = predictions[-1] is None
+      predictions = [prediction for prediction in predictions if prediction is not None]
+      if predictions:
+        self._predict(predictions)
+      if stopping:
+        break
+
+  def _predict(self, predictions):
+    startTime = time.perf_counter()
+    # an image that cannot be prepared fails alone, not with its batch
+    prepared = list(self._map(self._preprocessOrError, [prediction.array for prediction in predictions]))
+    responses = [{"error": error} if error else None for modelInput, error in prepared]
+    inputs = [modelInput for modelInput, error in prepared if not error]
+    if inputs:
+      try:
+        with self.recorder.stage("", "inference"):
+          results = iter(self.results(self.model.run(self._batch(inputs))))
+        responses = [response if response else {"result": next(results)} for response in responses]
+      except Exception as e:
+        responses = [response if response else {"error": str(e)} for response in responses]
+    milliseconds = (time.perf_counter() - startTime) * 1000 / len(predictions)
+    self.batchCount += 1
+    for prediction, response in zip(predictions, responses):
+      prediction.response = dict(response, milliseconds=milliseconds)
+      prediction.completeTime = time.perf_counter()
+      self._done.put(prediction)
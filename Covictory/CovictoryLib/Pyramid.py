@@ -0,0 +1,102 @@
+import os
+
+import numpy
+
+#
+# Multi-resolution previews of chest X rays for review
+#
+# Written by the equalization workers, so no slicer imports here.
+#
+
+__all__ = ['buildPyramid', 'writePyramid', 'readPyramid', 'pyramidIsCurrent', 'thumbnailOf', 'PYRAMID_SUFFIX']
+
+PYRAMID_SUFFIX = ".pyramid.npz"
+
+
+def _toUint8(image):
+  """uint8 gray image from a float image in [0, 1] or an integer image."""
+  if image.dtype == numpy.uint8:
+    return image
+  if numpy.issubdtype(image.dtype, numpy.floating):
+    return (numpy.clip(image, 0, 1) * 255 + 0.5).astype(numpy.uint8)
+  return (image.astype(numpy.float32) * (255. / max(1, image.max()))).astype(numpy.uint8)
+
+
+def _halve(level):
+  """2x2 block means, dropping an odd last row or column."""
+  rows, columns = level.shape[0] // 2 * 2, level.shape[1] // 2 * 2
+  return (level[0:rows:2, 0:columns:2] + level[1:rows:2, 0:columns:2]
+          + level[0:rows:2, 1:columns:2] + level[1:rows:2, 1:columns:2]) * 0.25
+
+
+def thumbnailOf(imageArray, size=128):
+  """Subsampled copy of a 2D image array of at most size pixels along each
+  axis, and the subsampling factor.  Works on memory maps without reading
+  more than the subsampled pixels.
+  """
+  step = max(1, -(-max(imageArray.shape[:2]) // size))
+  return numpy.array(imageArray[::step, ::step]), step
+
+
+def buildPyramid(image, thumbnailSize=128, largestSize=512):
+  """Levels of a 2D image, each half the size of the previous one (2x2 block
+  means), from the first level that fits in largestSize pixels down to the
+  first that fits in thumbnailSize.  Returns a list of (factor, level) with
+  the subsampling factor of each uint8 level; float images are taken to be
+  in [0, 1].
+  """
+  levels = []
+  level = numpy.asarray(image, dtype=numpy.float32)
+  if not numpy.issubdtype(numpy.asarray(image).dtype, numpy.floating):
+    level = level / max(1, level.max())
+  factor = 1
+  while max(level.shape) > thumbnailSize and min(level.shape) >= 2:
+    level = _halve(level)
+    factor *= 2
+    if max(level.shape) <= largestSize:
+      levels.append((factor, _toUint8(level)))
+  return levels if levels else [(factor, _toUint8(level))]
+
+
+def writePyramid(path, images, source="", thumbnailSize=128, largestSize=512):
+  """Write the pyramids of a dictionary of named 2D images (e.g. "original" and
+  "equalized") to a compressed .npz file, together with the source file path
+  and the full resolution shapes.  The file is replaced atomically.
+  """
+  arrays = {"source": numpy.array(source)}
+  for kind, image in images.items():
+    levels = buildPyramid(image, thumbnailSize, largestSize)
+    arrays[f"{kind}_shape"] = numpy.array(image.shape[:2])
+    arrays[f"{kind}_factors"] = numpy.array([factor for factor, level in levels])
+    for index, (factor, level) in enumerate(levels):
+      arrays[f"{kind}_{index}"] = level
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  temporaryPath = f"{path}.{os.getpid()}.tmp.npz"
+  numpy.savez_compressed(temporaryPath, **arrays)
+  os.replace(temporaryPath, path)
+
+
+def readPyramid(path, kind="equalized", maxSize=None):
+  """The largest level of a pyramid that fits in maxSize pixels (the
+  thumbnail without maxSize or if no level fits), and the source path.
+  Only that level is decompressed.
+  """
+  with numpy.load(path) as pyramid:
+    if f"{kind}_factors" not in pyramid.files:
+      raise KeyError(f"{path} has no {kind} pyramid")
+    factors = pyramid[f"{kind}_factors"]
+    chosen = len(factors) - 1
+    if maxSize:
+      fullSize = max(pyramid[f"{kind}_shape"])
+      # levels are stored largest first, so the first that fits is the largest
+      fitting = [index for index, factor in enumerate(factors) if fullSize // factor <= maxSize]
+      chosen = fitting[0] if fitting else chosen
+    return pyramid[f"{kind}_{chosen}"], str(pyramid["source"])
+
+
+def pyramidIsCurrent(pyramidPath, sourcePath):
+  """True if the pyramid file exists and is not older than its source file."""
+  try:
+    return os.path.getmtime(pyramidPath) >= os.path.getmtime(sourcePath)
+  except OSError:
+    return False
@@ -0,0 +1,147 @@
+import glob
+import logging
+import os
+
+import numpy
+import vtk
+import slicer
+
+from CovictoryLib import Volumes
+from CovictoryLib.Pyramid import PYRAMID_SUFFIX, readPyramid
+
+#
+# Mosaic review of many chest X rays at once
+#
+
+__all__ = ['MosaicReview', 'reviewEntriesInFolder']
+
+MOSAIC_NAME = "Covictory Review"
+
+
+def reviewEntriesInFolder(pyramidFolder):
+  """Review entries for all pyramid files of a folder, e.g. from an earlier session.
+  """
+  return [{"name": os.path.basename(path)[:-len(PYRAMID_SUFFIX)], "pyramidPath": path}
+          for path in sorted(glob.glob(os.path.join(pyramidFolder, "*" + PYRAMID_SUFFIX)))]
+
+
+class MosaicReview:
+  """Shows pages of preview images from the pyramid files (see Pyramid) as
+  one mosaic volume in a slice view, rows x columns tiles of tileSize pixels.
+  Only the pyramid level that fits a tile is read, so a page of dozens of
+  images is built in a fraction of a second whatever the image size.
+
+  Entries are dictionaries with at least "name" and "pyramidPath".  Clicking
+  a tile calls onSelect(entry), which typically shows the full resolution
+  image in another view.
+  """
+
+  def __init__(self, entries, onSelect=None, kind="equalized", rows=4, columns=6, tileSize=256, viewName="Red"):
+    self.entries = entries
+    self.onSelect = onSelect
+    self.kind = kind
+    self.rows = rows
+    self.columns = columns
+    self.tileSize = tileSize
+    self.viewName = viewName
+    self.page = 0
+    self.volumeNode = None
+    self._observations = []
+    self._pressPosition = None
+
+  @property
+  def tilesPerPage(self):
+    return self.rows * self.columns
+
+  @property
+  def pageCount(self):
+    return max(1, -(-len(self.entries) // self.tilesPerPage))
+
+  def pageEntries(self, page):
+    return self.entries[page * self.tilesPerPage:(page + 1) * self.tilesPerPage]
+
+  def mosaic(self, page):
+    """(rows*tileSize, columns*tileSize) uint8 mosaic of the previews of a page,
+    each centered in its tile.  Entries whose pyramid cannot be read stay black.
+    """
+    mosaic = numpy.zeros((self.rows * self.tileSize, self.columns * self.tileSize), dtype=numpy.uint8)
+    for index, entry in enumerate(self.pageEntries(page)):
+      try:
+        preview, source = readPyramid(entry["pyramidPath"], self.kind, self.tileSize)
+      except (OSError, KeyError, ValueError) as e:
+        logging.warning(f"No preview for {entry['name']}: {e}")
+        continue
+      step = max(1, -(-max(preview.shape) // self.tileSize))
+      preview = preview[::step, ::step]
+      row, column = divmod(index, self.columns)
+      top = row * self.tileSize + (self.tileSize - preview.shape[0]) // 2
+      left = column * self.tileSize + (self.tileSize - preview.shape[1]) // 2
+      mosaic[top:top + preview.shape[0], left:left + preview.shape[1]] = preview
+    return mosaic
+
+  def show(self, page=None):
+    """Show a page (default the current one) in the review slice view.
+    """
+    self.page = min(max(0, self.page if page is None else page), self.pageCount - 1)
+    mosaic = self.mosaic(self.page)
+    if self.volumeNode and slicer.mrmlScene.IsNodePresent(self.volumeNode):
+      Volumes.setVolumeImageArray(self.volumeNode, mosaic)
+    else:
+      self.volumeNode = Volumes.volumeNodeFromImageArray(mosaic, MOSAIC_NAME)
+    self.volumeNode.SetAttribute("Covictory.ReviewPage", f"{self.page + 1}/{self.pageCount}")
+    sliceWidget = slicer.app.layoutManager().sliceWidget(self.viewName)
+    sliceWidget.mrmlSliceCompositeNode().SetBackgroundVolumeID(self.volumeNode.GetID())
+    sliceWidget.mrmlSliceNode().SetOrientationToAxial()
+    sliceWidget.sliceLogic().FitSliceToAll()
+    return self.volumeNode
+
+  def nextPage(self):
+    return self.show(self.page + 1)
+
+  def previousPage(self):
+    return self.show(self.page - 1)
+
+  def entryAt(self, ras):
+    """Entry shown at a RAS position of the mosaic, or None.
+    """
+    if not self.volumeNode:
+      return None
+    rasToIJK = vtk.vtkMatrix4x4()
+    self.volumeNode.GetRASToIJKMatrix(rasToIJK)
+    i, j, k, _ = rasToIJK.MultiplyPoint(list(ras[:3]) + [1])
+    column, row = int(numpy.floor(i + 0.5)) // self.tileSize, int(numpy.floor(j + 0.5)) // self.tileSize
+    if not (0 <= column < self.columns and 0 <= row < self.rows):
+      return None
+    entries = self.pageEntries(self.page)
+    index = row * self.columns + column
+    return entries[index] if index < len(entries) else None
+
+  def startObserving(self):
+    """Select the entry of a tile when it is clicked (without dragging) in the review view.
+    """
+    if self._observations:
+      return
+    interactor = slicer.app.layoutManager().sliceWidget(self.viewName).sliceView().interactor()
+    for event, callback in [(vtk.vtkCommand.LeftButtonPressEvent, self._onPress),
+                            (vtk.vtkCommand.LeftButtonReleaseEvent, self._onRelease)]:
+      self._observations.append((interactor, interactor.AddObserver(event, callback)))
+
+  def stopObserving(self):
+    for observed, tag in self._observations:
+      observed.RemoveObserver(tag)
+    self._observations = []
+
+  def _onPress(self, interactor, event):
+    self._pressPosition = interactor.GetEventPosition()
+
+  def _onRelease(self, interactor, event):
+    if interactor.GetEventPosition() != self._pressPosition or not self.onSelect:
+      return
+    sliceWidget = slicer.app.layoutManager().sliceWidget(self.viewName)
+    if sliceWidget.mrmlSliceCompositeNode().GetBackgroundVolumeID() != (self.volumeNode.GetID() if self.volumeNode else None):
+      return
+    sliceView = sliceWidget.sliceView()
+    ras = sliceView.convertXYZToRAS(sliceView.convertDeviceToXYZ(interactor.GetEventPosition()))
+    entry = self.entryAt(ras)
+    if entry:
+      self.onSelect(entry)
@@ -0,0 +1,93 @@
+import time
+
+import slicer
+
+#
+# Grouped MRML scene updates for bulk imports
+#
+
+__all__ = ['SceneBatch', 'parentItem']
+
+
+def parentItem(dataNode, parentID, shNode=None):
+  """Put the subject hierarchy item of a data node under parentID, creating
+  the item if the subject hierarchy has not added it yet (it may wait for
+  the end of a batch process to do so).
+  """
+  shNode = shNode if shNode else slicer.mrmlScene.GetSubjectHierarchyNode()
+  itemID = shNode.GetItemByDataNode(dataNode)
+  if itemID:
+    shNode.SetItemParent(itemID, parentID)
+  else:
+    itemID = shNode.CreateItem(parentID, dataNode)
+  return itemID
+
+
+class SceneBatch:
+  """Context manager that adds nodes and changes the subject hierarchy as
+  one batch process of the scene.  Observers such as the data and subject
+  hierarchy trees and the views ignore the individual events until the
+  batch ends and then update once.  Rendering of the views is paused for
+  the same time.
+
+  Batches can be nested, the scene is only updated when the outermost one
+  ends.  After the batch, seconds, flushSeconds (the update at the end) and
+  addedNodeCount give its cost, see costPerNode.
+  """
+
+  def __init__(self, scene=None, pauseRender=True):
+    self.scene = scene if scene else slicer.mrmlScene
+    self.pauseRender = pauseRender
+    self.startNodeCount = 0
+    self.addedNodeCount = 0
+    self.seconds = 0.
+    self.flushSeconds = 0.
+    self._pausedViews = []
+    self._startTime = None
+
+  def _views(self):
+    layoutManager = slicer.app.layoutManager() if hasattr(slicer.app, "layoutManager") else None
+    if not layoutManager:
+      return []
+    views = [layoutManager.sliceWidget(name).sliceView() for name in layoutManager.sliceViewNames()]
+    views += [layoutManager.threeDWidget(index).threeDView() for index in range(layoutManager.threeDViewCount)]
+    return views
+
+  def __enter__(self):
+    self.startNodeCount = self.scene.GetNumberOfNodes()
+    self._startTime = time.perf_counter()
+    if self.pauseRender:
+      self._pausedViews = self._views()
+      for view in self._pausedViews:
+        view.pauseRender()
+    self.scene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+    return self
+
+  def __exit__(self, *exc):
+    flushStartTime = time.perf_counter()
+    try:
+      self.scene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+    finally:
+      for view in self._pausedViews:
+        view.resumeRender()
+      self._pausedViews = []
+    endTime = time.perf_counter()
+    self.flushSeconds = endTime - flushStartTime
+    self.seconds = endTime - self._startTime
+    self.addedNodeCount = self.scene.GetNumberOfNodes() - self.startNodeCount
+    return False
+
+  @property
+  def costPerNode(self):
+    """Seconds per added node, including the update at the end of the batch."""
+    return self.seconds / self.addedNodeCount if self.addedNodeCount else 0.
+
+  def cost(self):
+    """Cost of the batch as a dictionary, to follow it as the scene grows."""
+    return {
+      "sceneNodes": self.startNodeCount,
+      "addedNodes": self.addedNodeCount,
+      "seconds": self.seconds,
+      "flushSeconds": self.flushSeconds,
+      "msPerNode": self.costPerNode * 1000,
+    }
@@ -0,0 +1,98 @@
+import collections
+import weakref
+from multiprocessing import shared_memory
+
+import numpy
+
+#
+# Hand-off of arrays from worker processes through shared memory
+#
+# Used from the equalization worker processes, so no slicer imports here.
+#
+
+__all__ = ['SharedArray', 'shareArray', 'SharedArrayReceiver']
+
+# what is sent through the pool instead of the pixels
+SharedArray = collections.namedtuple('SharedArray', ['name', 'shape', 'dtype'])
+
+
+def shareArray(array):
+  """Copy an array into a new shared memory block (the only copy the hand-off
+  makes) and return its picklable SharedArray description.  The block
+  outlives this process until the receiving process attaches it.
+  """
+  array = numpy.asarray(array)
+  block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+  numpy.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+  block.close()
+  return SharedArray(block.name, array.shape, array.dtype.str)
+
+
+class SharedArrayReceiver:
+  """Turns SharedArray descriptions back into numpy arrays that use the
+  shared memory as their storage, so the pixels are neither pickled by the
+  worker nor unpickled into a new array here.  A volume node made from such
+  an array (see Volumes.volumeNodeFromImageArray) keeps using the block.
+
+  The block's name is removed as soon as it is attached, and the block is
+  released once the last array using it is gone: arrays are reference
+  counted by Python and the block is closed by the next attach() or
+  collect() after its array was freed.
+  """
+
+  def __init__(self):
+    self._blocks = {}
+    self._freed = []
+    self.attachedCount = 0
+    self.attachedBytes = 0
+    self.releasedCount = 0
+
+  def attach(self, shared):
+    """The array of a SharedArray description (other values are returned unchanged).
+    """
+    if not isinstance(shared, SharedArray):
+      return shared
+    self.collect()
+    block = shared_memory.SharedMemory(name=shared.name)
+    array = numpy.ndarray(shared.shape, numpy.dtype(shared.dtype), buffer=block.buf)
+    # the mapping stays valid without the name (on Windows the block lives
+    # as long as a handle is open, unlink does nothing there)
+    block.unlink()
+    self._blocks[block.name] = block
+    # the block cannot be closed while the array still exports its buffer,
+    # so it is only marked here and closed later
+    weakref.finalize(array, self._freed.append, block.name)
+    self.attachedCount += 1
+    self.attachedBytes += array.nbytes
+    return array
+
+  def collect(self):
+    """Close the blocks whose arrays were freed.  Returns how many were closed.
+    """
+    closedCount = 0
+    while self._freed:
+      block = self._blocks.pop(self._freed.pop(), None)
+      if block is not None:
+        block.close()
+        closedCount += 1
+    self.releasedCount += closedCount
+    return closedCount
+
+  @property
+  def liveCount(self):
+    """Number of attached blocks still in use."""
+    return len(self._blocks) - len(self._freed)
+
+  def statistics(self):
+    """Arrays and bytes received through shared memory.  Each of them saved
+    two full copies compared to returning the array from the worker: the
+    pickling in the worker and the unpickling here (plus the pipe transfer).
+    """
+    return {
+      "arrays": self.attachedCount,
+      "bytes": self.attachedBytes,
+      "copiesAvoided": 2 * self.attachedCount,
+      "bytesNotCopied": 2 * self.attachedBytes,
+      "liveBlocks": self.liveCount,
+      "releasedBlocks": self.releasedCount,
+    }
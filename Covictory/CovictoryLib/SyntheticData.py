@@ -0,0 +1,94 @@
+import os
+
+import numpy
+
+#
+# Synthetic chest X ray images and volumes for tests and benchmarks
+#
+# Generated locally from a seed, so runs are reproducible and need no network.
+# No slicer imports, so the data can also be made outside the application.
+#
+
+__all__ = ['syntheticRadiograph', 'syntheticVolume', 'writeRadiographs', 'writeClassifierModel']
+
+
+def syntheticRadiograph(rows=2048, columns=2048, channels=3, seed=0):
+  """A smooth uint8 image with chest X ray like size and structure.
+  """
+  rng = numpy.random.default_rng(seed)
+  y, x = numpy.mgrid[0:rows, 0:columns].astype('float32')
+  y /= rows
+  x /= columns
+  image = 0.5 + 0.3 * numpy.sin(6 * x) * numpy.cos(4 * y) - 0.4 * ((x - 0.5)**2 + (y - 0.5)**2)
+  image += 0.05 * rng.standard_normal((rows, columns), dtype='float32')
+  image = (numpy.clip(image, 0, 1) * 255).astype('uint8')
+  if channels > 1:
+    image = numpy.repeat(image[:, :, numpy.newaxis], channels, axis=2)
+  return image
+
+
+def syntheticVolume(shape=(130, 256, 256), seed=0):
+  """An int16 (slices, rows, columns) volume with MR head like value range:
+  a noisy ellipsoid of varying intensity on a dark background.
+  """
+  rng = numpy.random.default_rng(seed)
+  k, j, i = numpy.ogrid[0:shape[0], 0:shape[1], 0:shape[2]]
+  radius = ((k / shape[0] - 0.5)**2 + (j / shape[1] - 0.5)**2 + (i / shape[2] - 0.5)**2) * 4
+  volume = numpy.where(radius < 1, 150 + 100 * numpy.cos(8 * radius), 0).astype('float32')
+  volume += 10 * rng.standard_normal(shape, dtype='float32')
+  return numpy.clip(volume, 0, 279).astype('int16')
+
+
+def writeRadiographs(folder, count, rows=2048, columns=2048, seed=0):
+  """Write count synthetic radiographs as PNG files to folder, returning the file names.
+  """
+  import skimage.io
+
+  os.makedirs(folder, exist_ok=True)
+  fileNames = []
+  for index in range(count):
+    fileName = f"synthetic-{seed + index:04d}.png"
+    skimage.io.imsave(os.path.join(folder, fileName), syntheticRadiograph(rows, columns, seed=seed + index), check_contrast=False)
+    fileNames.append(fileName)
+  return fileNames
+
+
+def writeClassifierModel(path, size=224, classCount=2, seed=0):
+  """Write a small random convolutional classifier of 1 channel size x size
+  images to an ONNX file, with the batch size left open.  It has about the
+  cost per pixel of a light chest X ray model, for benchmarking the local
+  predictor without an exported model.  Needs the onnx package.
+  """
+  import onnx
+  from onnx import TensorProto, helper, numpy_helper
+
+  rng = numpy.random.default_rng(seed)
+  weights = {
+    "conv1": rng.standard_normal((16, 1, 3, 3), dtype='float32') * 0.3,
+    "conv2": rng.standard_normal((32, 16, 3, 3), dtype='float32') * 0.1,
+    "conv3": rng.standard_normal((64, 32, 3, 3), dtype='float32') * 0.1,
+    "dense": rng.standard_normal((64, classCount), dtype='float32') * 0.1,
+    "bias": numpy.zeros(classCount, dtype='float32'),
+  }
+  nodes = []
+  layerInput = "image"
+  for index, name in enumerate(["conv1", "conv2", "conv3"]):
+    nodes.append(helper.make_node("Conv", [layerInput, name], [f"{name}Out"], kernel_shape=[3, 3], strides=[2, 2], pads=[1, 1, 1, 1]))
+    nodes.append(helper.make_node("Relu", [f"{name}Out"], [f"{name}Relu"]))
+    layerInput = f"{name}Relu"
+  nodes += [
+    helper.make_node("GlobalAveragePool", [layerInput], ["pooled"]),
+    helper.make_node("Flatten", ["pooled"], ["features"]),
+    helper.make_node("Gemm", ["features", "dense", "bias"], ["logits"]),
+    helper.make_node("Softmax", ["logits"], ["probabilities"], axis=1),
+  ]
+  graph = helper.make_graph(nodes, "SyntheticClassifier",
+    [helper.make_tensor_value_info("image", TensorProto.FLOAT, ["batch", 1, size, size])],
+    [helper.make_tensor_value_info("probabilities", TensorProto.FLOAT, ["batch", classCount])],
+    [numpy_helper.from_array(value, name) for name, value in weights.items()])
+  model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+  model.ir_version = 8
+  onnx.checker.check_model(model)
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  onnx.save(model, path)
+  return path
@@ -0,0 +1,62 @@
+import numpy
+import vtk
+import vtk.util.numpy_support
+import slicer
+
+#
+# Volume nodes backed by numpy arrays
+#
+
+__all__ = ['imageDataFromImageArray', 'volumeNodeFromImageArray', 'setVolumeImageArray']
+
+
+def imageDataFromImageArray(imageArray):
+  """vtkImageData sharing memory with a 2D image array (rows x columns, optionally
+  x channels), and the volume node class to show it with.
+  """
+  imageArray = numpy.ascontiguousarray(imageArray)
+  if imageArray.ndim == 2:
+    rows, columns = imageArray.shape
+    scalars = imageArray.reshape(-1)
+    className = "vtkMRMLScalarVolumeNode"
+  elif imageArray.ndim == 3:
+    rows, columns, components = imageArray.shape
+    scalars = imageArray.reshape(-1, components)
+    className = "vtkMRMLVectorVolumeNode"
+  else:
+    raise ValueError(f"Expected a 2D image array, got shape {imageArray.shape}")
+
+  # deep=False keeps a reference to the array in the vtk array
+  vtkScalars = vtk.util.numpy_support.numpy_to_vtk(scalars, deep=False)
+  imageData = vtk.vtkImageData()
+  imageData.SetDimensions(columns, rows, 1)
+  imageData.GetPointData().SetScalars(vtkScalars)
+  return imageData, className
+
+
+def volumeNodeFromImageArray(imageArray, name, scene=None):
+  """Create a volume node for a 2D image array (rows x columns, optionally x channels).
+  The node's image data shares memory with the array when it is contiguous,
+  so pixel values are exactly those of the array and no copy is made.
+  Multi-channel arrays become vector volumes.
+  The geometry matches what slicer.util.loadVolume produces for a 2D image file.
+  """
+  scene = scene if scene else slicer.mrmlScene
+  imageData, className = imageDataFromImageArray(imageArray)
+  volumeNode = scene.AddNewNodeByClass(className, name)
+  volumeNode.SetIJKToRASDirections(-1, 0, 0, 0, -1, 0, 0, 0, 1)
+  volumeNode.SetAndObserveImageData(imageData)
+  volumeNode.CreateDefaultDisplayNodes()
+  return volumeNode
+
+
+def setVolumeImageArray(volumeNode, imageArray, pixelSpacing=1.):
+  """Replace the pixels of a volume node created by volumeNodeFromImageArray,
+  e.g. by a subsampled or full resolution version of the image.  With
+  pixelSpacing set to the subsampling factor the image keeps its extent.
+  """
+  imageData, className = imageDataFromImageArray(imageArray)
+  if volumeNode.GetClassName() != className:
+    raise ValueError(f"{volumeNode.GetName()} is not a {className}")
+  volumeNode.SetSpacing(pixelSpacing, pixelSpacing, 1.)
+  volumeNode.SetAndObserveImageData(imageData)
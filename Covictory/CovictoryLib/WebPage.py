@@ -0,0 +1,47 @@
+import os
+import time
+
+import qt
+import slicer
+
+#
+# Helpers for the Covictory web page
+#
+
+__all__ = ['waitFor', 'standInPageURL', 'openWebWidget', 'openStandInPage']
+
+
+def waitFor(condition, timeout=60.):
+  """Process events until condition() is true, raising TimeoutError after timeout seconds.
+  """
+  endTime = time.perf_counter() + timeout
+  while not condition():
+    if time.perf_counter() > endTime:
+      raise TimeoutError("Timed out waiting for the web page")
+    slicer.app.processEvents(qt.QEventLoop.AllEvents, 10)
+
+
+def standInPageURL():
+  """URL of the local predictor stand-in page shipped with the module.
+  """
+  modulePath = os.path.dirname(slicer.modules.covictory.path)
+  return qt.QUrl.fromLocalFile(os.path.join(modulePath, "Resources", "Web", "PredictorStandIn.html")).toString()
+
+
+def openWebWidget(url, timeout=60.):
+  """Load url in a new web widget (not added to any layout) and wait until it is ready.
+  """
+  webWidget = slicer.qSlicerWebWidget()
+  loaded = []
+  webWidget.webView().connect('loadFinished(bool)', loaded.append)
+  webWidget.url = url
+  waitFor(lambda: loaded, timeout)
+  if not loaded[0]:
+    raise RuntimeError(f"Failed to load {url}")
+  return webWidget
+
+
+def openStandInPage():
+  """Load the predictor stand-in page in a new web widget and wait until it is ready.
+  """
+  return openWebWidget(standInPageURL())
@@ -0,0 +1,14 @@
+# Only modules that can be imported without slicer are re-exported here,
+# since the package is also imported by the equalization worker processes.
+# Modules that need the application (Volumes, Benchmarks, ...) are imported
+# explicitly, e.g. "from CovictoryLib import Volumes".
+from .Equalization import *
+from .PixelBridge import *
+from .Manifest import *
+from .EqualizationCache import *
+from .Instrumentation import *
+from .ImageHeaders import *
+from .Pyramid import *
+from .SharedArrays import *
+from .Predictors import *
+from .BackgroundTasks import *
@@ -15,33 +15,64 @@ except slicer.util.MRMLNodeNotFoundException:
 
 
 import numpy
+import os
 import random
+import shutil
+import sys
 
-def sliceTiles(volume, tileSize):
+try:
+    experimentsPath = os.path.dirname(path)
+except NameError:
+    experimentsPath = os.path.dirname(os.path.abspath(__file__))
+if experimentsPath not in sys.path:
+    sys.path.append(experimentsPath)
+import latent
+import modelstore
+import pipeline
+import sampling
+import tiles
+import tilestore
+
+def sliceTiles(volume, tileSize, stride=None, dtype=numpy.float32, pad=False):
+    """Tile matrix (tileCount, tileSize*tileSize) and slice labels of a volume, see tiles.sliceTiles"""
     array = slicer.util.array(volume.GetID())
-    labels = []
-    slices, height, width = array.shape
-    rows = int(height/tileSize)
-    columns = int(width/tileSize)
-    tiles = numpy.zeros([slices*rows*columns, tileSize*tileSize])
-    tileIndex = 0
-    for slice in range(slices):
-        for row in range(rows):
-            for column in range(columns):
-                rowOffset = row*tileSize
-                columnOffset = column*tileSize
-                tiles[tileIndex] = array[slice, rowOffset:rowOffset+tileSize, columnOffset:columnOffset+tileSize].flatten()
-                tileIndex += 1
-                labels.append(slice)
-    return tiles,labels
+    return tiles.sliceTiles(array, tileSize, stride=stride, dtype=dtype, pad=pad)
+
+
 
+def writeTileStore(volumes, storePath, tileSize, overwrite=True):
+    """Tile the volumes into an on disk tile store, a few slices at a time, see tilestore.TileStoreWriter"""
+    with tilestore.TileStoreWriter(storePath, tileSize, overwrite=overwrite) as writer:
+        for volume in volumes:
+            writer.addArray(slicer.util.arrayFromVolume(volume), volume.GetName())
+    return tilestore.TileStore(storePath)
+
+
+def volumeSources(volumes, folder):
+    """Tile pipeline sources for volumes, saved to folder for the sampling workers, see pipeline.saveVolumeSource"""
+    shutil.rmtree(folder, ignore_errors=True)
+    sources = []
+    for volume in volumes:
+        rasToIJK = vtk.vtkMatrix4x4()
+        volume.GetRASToIJKMatrix(rasToIJK)
+        bounds = [0]*6
+        volume.GetRASBounds(bounds)
+        sources.append(pipeline.saveVolumeSource(slicer.util.arrayFromVolume(volume), slicer.util.arrayFromVTKMatrix(rasToIJK),
+                                                 bounds, volume.GetName(), folder))
+    return sources
 
 
 print("generate X")
 # X = randomSlices(mrHead, 70 * 1000, [32,32])
 # labels = list(map(str, list(numpy.random.random_integers(0,10,len(z)))))
 tileSize = 32
-X, labels = sliceTiles(mrHead, tileSize)
+trainingVolumes = [mrHead]
+# CompressionVAE is created with an in memory array, which gives its validation
+# set and normalization; the training tiles come from the tile pipeline
+maxTrainingTiles = 200 * 1000
+tileStore = writeTileStore(trainingVolumes, os.path.join(slicer.app.temporaryPath, "cvae-tiles"), tileSize)
+X, tileIndices = tileStore.sample(maxTrainingTiles, seed=0)
+labels = tileStore.locations(tileIndices)[:, 1]
 # print(X, labels)
 
 tileArray = X.reshape([X.shape[0], tileSize, tileSize])
@@ -56,31 +87,73 @@ except NameError:
 import importlib
 importlib.reload(cvae)
 
-embedder = cvae.CompressionVAE(
-    X,
-    train_valid_split=0.99,
-    dim_latent=50,
-    #iaf_flow_length=10,
-    # cells_encoder=[512, 256, 128],
-    #initializer='lecun_normal',
-    #batch_size=32,
-    #batch_size_test=128,
-    #logdir='~/mnist_16d',
-    #feature_normalization=False,
-    tb_logging=True)
-embedder.train(
-    learning_rate=1e-4,
-    num_steps=int(10e4),
-    #dropout_keep_prob=0.6,
-    test_every=50,
-    lr_scheduling=False)
+# sampling workers draw augmented grid and oblique tiles from all training
+# volumes; a restored model continues with the tiles after its checkpoint
+tilePipeline = pipeline.TilePipeline(
+    volumeSources(trainingVolumes, os.path.join(slicer.app.temporaryPath, "cvae-volumes")),
+    tileSize, seed=0)
+trainingParameters = {
+    "dim_latent": 50,
+    "train_valid_split": 0.99,
+    "learning_rate": 1e-4,
+    "num_steps": int(10e4),
+    "pipeline": tilePipeline.config,
+}
+# models trained before on the same volumes with the same parameters are
+# reused; the least recently used ones are removed above the disk budget
+modelStore = modelstore.ModelStore(os.path.join(slicer.app.temporaryPath, "cvae-models"), diskBudget=20 << 30)
+modelEntry = modelStore.entry(modelstore.sourcesFingerprint(tilePipeline.sources), trainingParameters)
+
+
+def createEmbedder(logdir):
+    """CompressionVAE in logdir, restored from its last checkpoint if there is one"""
+    return cvae.CompressionVAE(
+        X,
+        train_valid_split=trainingParameters["train_valid_split"],
+        dim_latent=trainingParameters["dim_latent"],
+        #iaf_flow_length=10,
+        # cells_encoder=[512, 256, 128],
+        #initializer='lecun_normal',
+        #batch_size=32,
+        #batch_size_test=128,
+        logdir=logdir,
+        #feature_normalization=False,
+        tb_logging=True)
+
+
+if modelEntry.trained:
+    print(f"using the model trained in {modelEntry.path}")
+else:
+    embedder = modelEntry.embedder(createEmbedder)
+    pipeline.feedCompressionVAE(embedder, tilePipeline)
+    try:
+        embedder.train(
+            learning_rate=trainingParameters["learning_rate"],
+            num_steps=trainingParameters["num_steps"],
+            #dropout_keep_prob=0.6,
+            test_every=50,
+            lr_scheduling=False,
+            # continue an interrupted training instead of stopping
+            overwrite=True)
+    finally:
+        # stops the feed thread and its sampling workers
+        pipeline.stopFeeding(embedder)
+    print(f"trained on {tilePipeline.tilesProduced} tiles, {tilePipeline.waitSeconds:.1f} s waiting for the sampling workers")
+    if embedder.saved_global_step + 1 >= trainingParameters["num_steps"]:
+        modelEntry.markTrained(steps=embedder.saved_global_step + 1)
 
 print("embed X")
-z = embedder.embed(X)
+# latent codes of every tile in the store, kept with the model for retrieval;
+# the model is only loaded if they have to be computed
+zAll = modelEntry.latent(f"tiles{tileSize}", lambda latentPath: latent.embedStore(modelEntry.embedder(createEmbedder), tileStore, latentPath))
+modelStore.evict(keep=[modelEntry.key])
+latentIndex = latent.LatentIndex(zAll)
+z = zAll[tileIndices]
 
 #embedder.visualize(z, labels=labels, filename="/tmp/embedding.png")
+# print(latentIndex.similarTiles(tileStore, 1000))
 
-X_reconstructed = embedder.decode(z)
+X_reconstructed = latent.decode(modelEntry.embedder(createEmbedder), z)
 
 recontstructedTileArray = X_reconstructed.reshape(tileArray.shape)
 recontstructedTileVolume = slicer.util.addVolumeFromArray(recontstructedTileArray)
@@ -101,38 +174,11 @@ yellowComposite.SetHotLinkedControl(True)
 yellowWidget.mrmlSliceNode().SetOrientationToAxial()
 
 # not used, but maybe handy some day
-def randomSlices(volume, sliceCount, sliceShape):
-    layoutManager = slicer.app.layoutManager()
-    redWidget = layoutManager.sliceWidget('Red')
-    sliceNode = redWidget.mrmlSliceNode()
-    sliceNode.SetDimensions(*sliceShape, 1)
-    sliceNode.SetFieldOfView(*sliceShape, 1)
+def randomSlices(volume, sliceCount, sliceShape, seed=None, workers=None):
+    """Random oblique slices through the volume, sampled from the array without any view, see sampling.randomObliqueSlices"""
+    rasToIJK = vtk.vtkMatrix4x4()
+    volume.GetRASToIJKMatrix(rasToIJK)
     bounds = [0]*6
     volume.GetRASBounds(bounds)
-    imageReslice = redWidget.sliceLogic().GetBackgroundLayer().GetReslice()
-
-    sliceSize = sliceShape[0] * sliceShape[1]
-    X = numpy.zeros([sliceCount, sliceSize])
-
-    for sliceIndex in range(sliceCount):
-        position = numpy.random.rand(3) * 2 - 1
-        position = [bounds[0] + bounds[1]-bounds[0] * position[0],
-                    bounds[2] + bounds[3]-bounds[2] * position[1],
-                    bounds[4] + bounds[5]-bounds[4] * position[2]]
-        normal = numpy.random.rand(3) * 2 - 1
-        normal = normal / numpy.linalg.norm(normal)
-        transverse = numpy.cross(normal, [0,0,1])
-        orientation = 0
-        sliceNode.SetSliceToRASByNTP( normal[0], normal[1], normal[2], 
-                                      transverse[0], transverse[1], transverse[2], 
-                                      position[0], position[1], position[2],
-                                      orientation) 
-        if sliceIndex % 100 == 0:
-            slicer.app.processEvents()
-        imageReslice.Update()
-        imageData = imageReslice.GetOutputDataObject(0)
-        array = vtk.util.numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
-        X[sliceIndex] = array
-    return X
-
-
+    return sampling.randomObliqueSlices(slicer.util.arrayFromVolume(volume), slicer.util.arrayFromVTKMatrix(rasToIJK),
+                                        bounds, sliceCount, sliceShape, seed=seed, workers=workers)
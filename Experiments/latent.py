@@ -0,0 +1,118 @@
+"""
+Streaming embedding and latent space retrieval for the cvae experiment.
+
+embedStore runs a trained CompressionVAE over a tile store in fixed size
+batches and writes the latent codes to a memory mapped .npy file, so the
+codes are kept and the data set is not limited by memory.  LatentIndex
+answers "find similar tiles" queries on those codes:
+
+import latent
+z = latent.embedStore(embedder, store, "/tmp/latent.npy")
+index = latent.LatentIndex(z)
+neighbors, distances = index.query(z[[1234]], k=10)
+store.locations(neighbors[0])
+"""
+
+import time
+
+import numpy
+
+
+def embedStore(embedder, store, latentPath, batchSize=4096):
+    """Latent codes of all tiles of a tilestore.TileStore, written batch by
+    batch to latentPath.  Returns the (tileCount, dimLatent) memory map."""
+    z = None
+    for tileBatch, indices in store.batches(batchSize):
+        codes = numpy.asarray(embedder.embed(tileBatch), dtype=numpy.float32)
+        if z is None:
+            z = numpy.lib.format.open_memmap(latentPath, mode="w+", dtype=numpy.float32,
+                                             shape=(len(store), codes.shape[1]))
+        z[indices[0]:indices[0] + len(codes)] = codes
+    if z is None:
+        raise ValueError("The tile store is empty")
+    z.flush()
+    return z
+
+
+def decodeBatches(embedder, z, batchSize=4096):
+    """Generator of (start, reconstructed tiles) for consecutive batches of latent codes."""
+    for start in range(0, len(z), batchSize):
+        yield start, embedder.decode(numpy.asarray(z[start:start + batchSize]))
+
+
+def decode(embedder, z, batchSize=4096, out=None):
+    """Reconstructed tiles of latent codes z, decoded batchSize at a time into out
+    (e.g. a memory map), or a new array."""
+    for start, tileBatch in decodeBatches(embedder, z, batchSize):
+        if out is None:
+            out = numpy.empty((len(z), tileBatch.shape[1]), dtype=numpy.float32)
+        out[start:start + len(tileBatch)] = tileBatch
+    return out
+
+
+class LatentIndex:
+    """Exact k nearest neighbor search (euclidean) over latent codes.
+
+    The codes are scanned in blocks with one matrix product per block, so a
+    memory mapped code array of any size can be searched, and a query over
+    a few hundred thousand 50 dimensional codes takes milliseconds when the
+    codes fit in memory (pass inMemory=True to load them once).
+    """
+
+    def __init__(self, z, blockSize=1 << 16, inMemory=False):
+        self.z = numpy.array(z, dtype=numpy.float32) if inMemory else z
+        self.blockSize = blockSize
+        self.squaredNorms = numpy.empty(len(z), dtype=numpy.float32)
+        for start in range(0, len(z), blockSize):
+            block = numpy.asarray(self.z[start:start + blockSize], dtype=numpy.float32)
+            self.squaredNorms[start:start + blockSize] = numpy.einsum("ij,ij->i", block, block)
+
+    def __len__(self):
+        return len(self.z)
+
+    def query(self, vectors, k=10, exclude=None):
+        """Indices and distances, both (queryCount, k), of the k codes closest
+        to each of the (queryCount, dimLatent) vectors, nearest first.
+        Indices listed in exclude (e.g. the query tiles themselves) are skipped."""
+        vectors = numpy.atleast_2d(numpy.asarray(vectors, dtype=numpy.float32))
+        k = min(k, len(self))
+        queryNorms = numpy.einsum("ij,ij->i", vectors, vectors)[:, numpy.newaxis]
+        bestDistances = numpy.full((len(vectors), 0), numpy.inf, dtype=numpy.float32)
+        bestIndices = numpy.empty((len(vectors), 0), dtype=numpy.int64)
+        for start in range(0, len(self), self.blockSize):
+            block = numpy.asarray(self.z[start:start + self.blockSize], dtype=numpy.float32)
+            distances = queryNorms - 2 * vectors @ block.T + self.squaredNorms[start:start + len(block)]
+            if exclude is not None:
+                excluded = numpy.asarray(exclude)
+                excluded = excluded[(excluded >= start) & (excluded < start + len(block))] - start
+                distances[:, excluded] = numpy.inf
+            blockK = min(k, len(block))
+            candidates = numpy.argpartition(distances, blockK - 1, axis=1)[:, :blockK]
+            bestDistances = numpy.concatenate([bestDistances, numpy.take_along_axis(distances, candidates, 1)], axis=1)
+            bestIndices = numpy.concatenate([bestIndices, candidates + start], axis=1)
+            if bestDistances.shape[1] > k:
+                keep = numpy.argpartition(bestDistances, k - 1, axis=1)[:, :k]
+                bestDistances = numpy.take_along_axis(bestDistances, keep, 1)
+                bestIndices = numpy.take_along_axis(bestIndices, keep, 1)
+        order = numpy.argsort(bestDistances, axis=1)
+        distances = numpy.sqrt(numpy.maximum(numpy.take_along_axis(bestDistances, order, 1), 0))
+        return numpy.take_along_axis(bestIndices, order, 1), distances
+
+    def similarTiles(self, store, tileIndex, k=10):
+        """The k tiles most similar to a tile of the store, as a list of
+        (tileIndex, distance, volumeName, slice, row, column)."""
+        neighbors, distances = self.query(self.z[[tileIndex]], k, exclude=[tileIndex])
+        locations = store.locations(neighbors[0])
+        return [(int(neighbor), float(distance), store.volumes[location[0]], *map(int, location[1:]))
+                for neighbor, distance, location in zip(neighbors[0], distances[0], locations)]
+
+
+if __name__ == "__main__":
+    z = numpy.random.default_rng(0).standard_normal((200 * 1000, 50), dtype=numpy.float32)
+    for inMemory in [False, True]:
+        index = LatentIndex(z, inMemory=inMemory)
+        startTime = time.perf_counter()
+        for tileIndex in range(0, 20000, 1000):
+            index.query(z[[tileIndex]], 10, exclude=[tileIndex])
+        elapsed = time.perf_counter() - startTime
+        print(f"inMemory={inMemory}: {elapsed / 20 * 1000:.1f} ms per similar tiles query over {len(z)} codes")
@@ -0,0 +1,257 @@
+"""
+Trained models and their latent codes for the cvae experiment, kept across runs.
+
+A model store is a directory of entries, one per combination of training
+data and hyperparameters.  The entry key is a hash of a fingerprint of the
+data (see fingerprint) and of the parameters, so training on the same
+volumes with the same settings finds the model trained before.  Each entry
+directory is the CompressionVAE logdir of its model, holding its
+checkpoints, plus metadata.json and the latent codes computed with it as
+.npy files, which are memory mapped when used.  Entries not used recently
+are removed when the store grows over its disk budget:
+
+import modelstore
+store = modelstore.ModelStore(path, diskBudget=20 << 30)
+entry = store.entry(modelstore.sourcesFingerprint(sources), {"dim_latent": 50, "tileSize": 32})
+embedder = entry.embedder(lambda logdir: cvae.CompressionVAE(X, logdir=logdir, ...))
+if not entry.trained:
+    embedder.train(...)
+    entry.markTrained(steps=embedder.saved_global_step + 1)
+z = entry.latent("MRHead", lambda latentPath: latent.embedStore(embedder, tileStore, latentPath))
+store.evict(keep=[entry.key])
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy
+
+
+METADATA_FILE = "metadata.json"
+VERSION = 1
+
+
+def _writeJson(path, value):
+    temporaryPath = path + ".tmp"
+    with open(temporaryPath, "w") as fp:
+        json.dump(value, fp, indent=2)
+    os.replace(temporaryPath, path)
+
+
+def _hashArray(digest, array, blockBytes=1 << 24):
+    array = numpy.asarray(array)
+    digest.update(f"{array.dtype.str}{array.shape}".encode())
+    flat = array.reshape(-1)
+    step = max(1, blockBytes // max(1, array.itemsize))
+    # block by block, so memory mapped volumes are not read into memory at once
+    for start in range(0, len(flat), step):
+        digest.update(numpy.ascontiguousarray(flat[start:start + step]).data)
+
+
+def fingerprint(values):
+    """Hex digest of a list of arrays (shape, dtype and values) and JSON
+    serializable values."""
+    digest = hashlib.blake2b(digest_size=16)
+    for value in values:
+        if isinstance(value, numpy.ndarray):
+            _hashArray(digest, value)
+        else:
+            digest.update(json.dumps(value, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def sourcesFingerprint(sources):
+    """fingerprint of the voxels and geometry of pipeline.VolumeSources, not
+    of their names or file locations."""
+    values = []
+    for source in sources:
+        array = numpy.load(source.path, mmap_mode="r") if source.path else source.array
+        values += [array, source.rasToIJK, source.rasBounds]
+    return fingerprint(values)
+
+
+def _directorySize(path):
+    size = 0
+    for directory, _, fileNames in os.walk(path):
+        for fileName in fileNames:
+            try:
+                size += os.path.getsize(os.path.join(directory, fileName))
+            except OSError:
+                pass
+    return size
+
+
+class ModelEntry:
+    """A model of the store.  path is its CompressionVAE logdir, trained
+    tells whether its training was completed (markTrained), otherwise it may
+    hold the checkpoints of an interrupted training.
+    """
+
+    def __init__(self, path, metadata):
+        self.path = path
+        self.key = os.path.basename(path)
+        self.metadata = metadata
+        self._embedder = None
+
+    @property
+    def trained(self):
+        return self.metadata["trained"]
+
+    @property
+    def parameters(self):
+        return self.metadata["parameters"]
+
+    def _save(self):
+        _writeJson(os.path.join(self.path, METADATA_FILE), self.metadata)
+
+    def touch(self):
+        """Mark the entry as used now, the least recently used ones are evicted first."""
+        self.metadata["lastUsed"] = time.time()
+        self._save()
+
+    def markTrained(self, **info):
+        """Record the completed training, with e.g. its step count, so later
+        runs use the model as it is."""
+        self.metadata["trained"] = True
+        self.metadata["training"] = info
+        self.touch()
+
+    def embedder(self, create):
+        """The model, created on first use with create(logdir), which restores
+        the last checkpoint of the entry (e.g. a cvae.CompressionVAE with
+        logdir=logdir).  Nothing is loaded for runs that only use latent codes."""
+        if self._embedder is None:
+            self._embedder = create(self.path)
+        return self._embedder
+
+    def latentPath(self, name):
+        return os.path.join(self.path, f"latent-{name}.npy")
+
+    def hasLatent(self, name):
+        return name in self.metadata["latents"]
+
+    def latent(self, name, compute=None):
+        """Memory mapped latent codes stored under name.  If there are none
+        yet, compute(latentPath) writes them (e.g. latent.embedStore), and
+        they are kept with the model once it is trained (codes of a model
+        whose training continues later are recomputed); without compute None
+        is returned."""
+        if not self.hasLatent(name):
+            if compute is None:
+                return None
+            compute(self.latentPath(name))
+            z = numpy.load(self.latentPath(name), mmap_mode="r")
+            if self.trained:
+                self.metadata["latents"][name] = {"shape": list(z.shape), "dtype": z.dtype.name}
+                self.touch()
+            return z
+        return numpy.load(self.latentPath(name), mmap_mode="r")
+
+    def size(self):
+        """Bytes on disk."""
+        return _directorySize(self.path)
+
+
+class ModelStore:
+    """Directory of ModelEntries, see the module documentation.  diskBudget
+    is the size in bytes evict() reduces the store to, None to keep all.
+    """
+
+    def __init__(self, path, diskBudget=None):
+        self.path = path
+        self.diskBudget = diskBudget
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(dataFingerprint, parameters):
+        return fingerprint([dataFingerprint, parameters])
+
+    def _load(self, entryPath):
+        try:
+            with open(os.path.join(entryPath, METADATA_FILE)) as fp:
+                metadata = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if metadata.get("version") != VERSION:
+            return None
+        return ModelEntry(entryPath, metadata)
+
+    def find(self, dataFingerprint, parameters):
+        """The entry for this data and these parameters, or None."""
+        entry = self._load(os.path.join(self.path, self.key(dataFingerprint, parameters)))
+        if entry:
+            entry.touch()
+        return entry
+
+    def entry(self, dataFingerprint, parameters):
+        """The entry for this data and these parameters, created untrained if
+        there is none.  The parameters must be JSON serializable."""
+        entry = self.find(dataFingerprint, parameters)
+        if entry is None:
+            entryPath = os.path.join(self.path, self.key(dataFingerprint, parameters))
+            # an entry of another version or with broken metadata is started over
+            shutil.rmtree(entryPath, ignore_errors=True)
+            os.makedirs(entryPath)
+            now = time.time()
+            entry = ModelEntry(entryPath, {"version": VERSION, "data": dataFingerprint,
+                                           "parameters": json.loads(json.dumps(parameters)),
+                                           "trained": False, "training": {}, "latents": {},
+                                           "created": now, "lastUsed": now})
+            entry._save()
+        return entry
+
+    def entries(self):
+        """All entries, least recently used first."""
+        entries = []
+        for name in os.listdir(self.path):
+            if os.path.isdir(os.path.join(self.path, name)):
+                entry = self._load(os.path.join(self.path, name))
+                if entry:
+                    entries.append(entry)
+        return sorted(entries, key=lambda entry: entry.metadata["lastUsed"])
+
+    def evict(self, diskBudget=None, keep=()):
+        """Remove the least recently used entries until the store fits in
+        diskBudget (default self.diskBudget) bytes; the keys in keep (e.g. the
+        entries in use) are never removed.  Returns the removed keys."""
+        diskBudget = self.diskBudget if diskBudget is None else diskBudget
+        if diskBudget is None:
+            return []
+        entries = self.entries()
+        sizes = {entry.key: entry.size() for entry in entries}
+        total = sum(sizes.values())
+        removed = []
+        for entry in entries:
+            if total <= diskBudget:
+                break
+            if entry.key in keep:
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+            total -= sizes[entry.key]
+            removed.append(entry.key)
+        return removed
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    rng = numpy.random.default_rng(0)
+    volume = rng.integers(0, 1000, (130, 256, 256), dtype=numpy.int16)
+    startTime = time.perf_counter()
+    dataFingerprint = fingerprint([volume, numpy.eye(4).tolist()])
+    print(f"fingerprint of a {volume.nbytes >> 20} MB volume: {(time.perf_counter() - startTime) * 1000:.1f} ms")
+    with tempfile.TemporaryDirectory() as path:
+        store = ModelStore(path, diskBudget=3 * 200 * 50 * 4 * 1000 + (1 << 16))
+        for dimLatent in [10, 20, 30, 40, 50]:
+            entry = store.entry(dataFingerprint, {"dim_latent": dimLatent, "tileSize": 32})
+            entry.markTrained(steps=0)
+            entry.latent("volume", lambda latentPath: numpy.save(latentPath, numpy.zeros((200 * 1000, 50), numpy.float32)))
+            print(f"dim_latent {dimLatent}: evicted {len(store.evict(keep=[entry.key]))}")
+        startTime = time.perf_counter()
+        entry = store.find(dataFingerprint, {"tileSize": 32, "dim_latent": 50})
+        z = entry.latent("volume")
+        print(f"hit: {entry is not None}, latent codes {z.shape} mapped in {(time.perf_counter() - startTime) * 1000:.1f} ms")
+        print("evicted entry found:", store.find(dataFingerprint, {"dim_latent": 10, "tileSize": 32}) is not None)
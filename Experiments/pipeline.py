@@ -0,0 +1,310 @@
+"""
+Parallel tile sampling and augmentation feeding the cvae trainer.
+
+Worker processes draw batches of tiles from many volumes at once, a mix of
+grid aligned tiles of random slices and randomly oriented oblique planes,
+and augment them with flips and intensity jitter.  A bounded queue of
+batches is kept in flight, so the trainer does not wait for data.  Every
+batch only depends on the seed and its number, so the tile stream is the
+same whatever the number of workers and can be resumed at any tile:
+
+import pipeline
+sources = [pipeline.saveVolumeSource(array, rasToIJK, rasBounds, "MRHead", folder)]
+tilePipeline = pipeline.TilePipeline(sources, 32, batchSize=256, seed=0)
+pipeline.feedCompressionVAE(embedder, tilePipeline)
+try:
+    embedder.train(...)
+finally:
+    pipeline.stopFeeding(embedder)
+
+Run "python pipeline.py" for a throughput measurement.
+"""
+
+import collections
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+import numpy
+
+import sampling
+
+
+STATE_FILE = "pipeline.json"
+
+# a volume to draw tiles from; the array is memory mapped from path in the
+# workers if path is set, otherwise it is sent to every worker
+VolumeSource = collections.namedtuple("VolumeSource", ["name", "path", "array", "rasToIJK", "rasBounds", "intensityScale"])
+
+
+def volumeSource(array, rasToIJK, rasBounds, name):
+    """VolumeSource of an in memory (k, j, i) indexed volume array."""
+    return VolumeSource(name, None, array, numpy.asarray(rasToIJK, dtype=numpy.float64).tolist(),
+                        list(rasBounds), float(numpy.max(numpy.abs(array))))
+
+
+def saveVolumeSource(array, rasToIJK, rasBounds, name, folder):
+    """VolumeSource of a volume array saved as a .npy file in folder, which
+    the workers memory map, so many volumes do not have to be copied into
+    every worker process."""
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{len(os.listdir(folder)):05d}-{name}.npy")
+    numpy.save(path, numpy.ascontiguousarray(array))
+    return volumeSource(array, rasToIJK, rasBounds, name)._replace(path=path, array=None)
+
+
+def gridTiles(array, count, tileSize, rng):
+    """(count, tileSize, tileSize) tiles at random positions of random slices of a (k, j, i) array."""
+    slices, rows, columns = array.shape
+    if rows < tileSize or columns < tileSize:
+        raise ValueError(f"Slices of {rows}x{columns} are smaller than the {tileSize} pixel tiles")
+    k = rng.integers(0, slices, count)
+    j = rng.integers(0, rows - tileSize + 1, count)
+    i = rng.integers(0, columns - tileSize + 1, count)
+    offsets = numpy.arange(tileSize)
+    return array[k[:, numpy.newaxis, numpy.newaxis],
+                 (j[:, numpy.newaxis] + offsets)[:, :, numpy.newaxis],
+                 (i[:, numpy.newaxis] + offsets)[:, numpy.newaxis, :]]
+
+
+def augment(tiles, rng, flips=True, intensityJitter=0.1, intensityScales=1.0):
+    """Augment (n, tileSize, tileSize) tiles in place: random flips of rows
+    and columns and transposition (the 8 symmetries of the square) and a
+    random gain of 1 +- intensityJitter and offset of +- intensityJitter
+    times the intensity scale of each tile's volume."""
+    count = len(tiles)
+    if flips:
+        for axis, mask in [(1, rng.random(count) < 0.5), (2, rng.random(count) < 0.5)]:
+            tiles[mask] = numpy.flip(tiles[mask], axis=axis)
+        mask = rng.random(count) < 0.5
+        tiles[mask] = tiles[mask].transpose(0, 2, 1)
+    if intensityJitter:
+        gains = 1 + intensityJitter * rng.uniform(-1, 1, count).astype(numpy.float32)
+        offsets = intensityJitter * rng.uniform(-1, 1, count).astype(numpy.float32) * intensityScales
+        tiles *= gains[:, numpy.newaxis, numpy.newaxis]
+        tiles += offsets[:, numpy.newaxis, numpy.newaxis]
+    return tiles
+
+
+def sampleBatch(sources, config, batchNumber, arrays=None):
+    """Batch batchNumber of the tile stream described by config (see
+    TilePipeline.config), a (batchSize, tileSize*tileSize) float32 array.
+    Volumes are picked in proportion to their voxel counts, so tiles of all
+    volumes are shuffled together."""
+    arrays = arrays if arrays is not None else _loadArrays(sources)
+    rng = numpy.random.default_rng(numpy.random.SeedSequence([config["seed"], batchNumber]))
+    batchSize, tileSize = config["batchSize"], config["tileSize"]
+    sizes = numpy.array([array.size for array in arrays], dtype=numpy.float64)
+    volumeNumbers = rng.choice(len(arrays), batchSize, p=sizes / sizes.sum())
+    oblique = rng.random(batchSize) < config["obliqueFraction"]
+    tiles = numpy.empty((batchSize, tileSize, tileSize), dtype=numpy.float32)
+    for volumeNumber in numpy.unique(volumeNumbers):
+        source, array = sources[volumeNumber], arrays[volumeNumber]
+        selected = volumeNumbers == volumeNumber
+        obliqueSelected = selected & oblique
+        gridSelected = selected & ~oblique
+        if obliqueSelected.any():
+            tiles[obliqueSelected] = sampling.sampleSlices(array, numpy.array(source.rasToIJK), source.rasBounds,
+                                                           int(obliqueSelected.sum()), (tileSize, tileSize),
+                                                           config["spacing"], rng).reshape(-1, tileSize, tileSize)
+        if gridSelected.any():
+            tiles[gridSelected] = gridTiles(array, int(gridSelected.sum()), tileSize, rng)
+    scales = numpy.array([source.intensityScale for source in sources], dtype=numpy.float32)[volumeNumbers]
+    augment(tiles, rng, config["flips"], config["intensityJitter"], scales)
+    return tiles.reshape(batchSize, tileSize * tileSize)
+
+
+def _loadArrays(sources):
+    return [numpy.load(source.path, mmap_mode="r") if source.path else source.array for source in sources]
+
+
+_workerState = None
+
+
+def _initializeWorker(sources, config):
+    global _workerState
+    _workerState = (sources, config, _loadArrays(sources))
+
+
+def _sampleBatch(batchNumber):
+    sources, config, arrays = _workerState
+    return sampleBatch(sources, config, batchNumber, arrays)
+
+
+class TilePipeline:
+    """Endless stream of augmented training tiles from VolumeSources.
+
+    Batches are sampled by workers processes (default one per core, 1 to
+    sample in this process) and prefetch batches (default two per worker)
+    are requested ahead of the consumer.  startTile skips the tiles a
+    trainer already consumed, e.g. before its last checkpoint, so the first
+    batch can be shorter than batchSize.
+    """
+
+    def __init__(self, sources, tileSize, batchSize=256, seed=0, obliqueFraction=0.5, spacing=1.0,
+                 flips=True, intensityJitter=0.1, workers=None, prefetch=None, startTile=0):
+        if not sources:
+            raise ValueError("The tile pipeline needs at least one volume")
+        self.sources = list(sources)
+        self.config = {"tileSize": tileSize, "batchSize": batchSize, "seed": seed, "obliqueFraction": obliqueFraction,
+                       "spacing": spacing, "flips": flips, "intensityJitter": intensityJitter,
+                       "volumes": [source.name for source in self.sources]}
+        self.workers = workers if workers else (os.cpu_count() or 1)
+        self.prefetch = prefetch if prefetch else 2 * self.workers
+        self.startTile = startTile
+        self.tilesProduced = startTile
+        self.waitSeconds = 0.
+
+    def batches(self, batchCount=None):
+        """Generator of (n, tileSize*tileSize) float32 batches, endless
+        without batchCount.  tilesProduced counts the tiles handed out and
+        waitSeconds the time spent waiting for the workers."""
+        batchSize = self.config["batchSize"]
+        firstBatch, skip = divmod(self.startTile, batchSize)
+        batchNumbers = range(firstBatch, firstBatch + batchCount) if batchCount else _count(firstBatch)
+        if self.workers <= 1:
+            arrays = _loadArrays(self.sources)
+            results = (sampleBatch(self.sources, self.config, batchNumber, arrays) for batchNumber in batchNumbers)
+            yield from self._handOut(results, skip)
+            return
+        context = multiprocessing.get_context("spawn")
+        context.set_executable(sampling._pythonExecutable())
+        pool = context.Pool(self.workers, initializer=_initializeWorker, initargs=(self.sources, self.config))
+        try:
+            yield from self._handOut(self._prefetched(pool, iter(batchNumbers)), skip)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _prefetched(self, pool, batchNumbers):
+        pending = collections.deque()
+        while True:
+            while len(pending) < self.prefetch:
+                batchNumber = next(batchNumbers, None)
+                if batchNumber is None:
+                    break
+                pending.append(pool.apply_async(_sampleBatch, (batchNumber,)))
+            if not pending:
+                return
+            startTime = time.perf_counter()
+            batch = pending.popleft().get()
+            self.waitSeconds += time.perf_counter() - startTime
+            yield batch
+
+    def _handOut(self, results, skip):
+        for batch in results:
+            batch = batch[skip:]
+            skip = 0
+            self.tilesProduced += len(batch)
+            yield batch
+
+    def saveState(self, path):
+        """Write the configuration that determines the tile stream to path."""
+        temporaryPath = path + ".tmp"
+        with open(temporaryPath, "w") as fp:
+            json.dump(self.config, fp, indent=2)
+        os.replace(temporaryPath, path)
+
+    def checkState(self, path):
+        """Raise ValueError if the stream saved at path differs from this one,
+        so a resumed training does not silently continue on other tiles."""
+        if os.path.exists(path):
+            with open(path) as fp:
+                savedConfig = json.load(fp)
+            if savedConfig != json.loads(json.dumps(self.config)):
+                raise ValueError(f"Training at {os.path.dirname(path)} used a different tile pipeline: {savedConfig}")
+
+
+def _count(start):
+    while True:
+        yield start
+        start += 1
+
+
+def feedCompressionVAE(embedder, tilePipeline):
+    """Make a cvae.CompressionVAE train on the tiles of the pipeline instead
+    of the rows of the X it was created with (which it still uses for the
+    validation set and the normalization factors).  Call before train(),
+    and stopFeeding after it.
+
+    CompressionVAE fills its training queue one row per session run from a
+    reader thread; this replaces that thread's loop with one that enqueues
+    whole pipeline batches.  The pipeline state is kept in the model's
+    logdir: a model restored from a checkpoint continues with the tile after
+    the last one of its last checkpointed step, the same tile it would have
+    got without the interruption.
+    """
+    reader = embedder.reader
+    statePath = os.path.join(embedder.logdir, STATE_FILE)
+    tilePipeline.checkState(statePath)
+    tilePipeline.saveState(statePath)
+    # steps 0 to saved_global_step were trained, each on one batch_size batch
+    tilePipeline.startTile = (embedder.saved_global_step + 1) * embedder.batch_size
+    tilePipeline.tilesProduced = tilePipeline.startTile
+    import tensorflow as tf
+    with embedder.graph.as_default():
+        enqueueMany = reader.feature_queue.enqueue_many([reader.feature_placeholder])
+        reader.closeFeatureQueue = reader.feature_queue.close(cancel_pending_enqueues=True)
+    reader.feedThreads = []
+    mean = norm = None
+    if reader.normalize:
+        from cvae.lib import data_reader_array
+        mean, norm = data_reader_array.load_norm(os.path.join(reader.logdir, "norm.pkl"))
+
+    def feed(sess):
+        reader.feedThreads.append(threading.current_thread())
+        batches = tilePipeline.batches()
+        try:
+            for batch in batches:
+                if embedder.coord.should_stop():
+                    break
+                if mean is not None:
+                    # same normalization as the reader, zero for features without variance
+                    batch = numpy.divide(batch - mean, norm, out=numpy.zeros_like(batch), where=norm != 0)
+                sess.run(enqueueMany, feed_dict={reader.feature_placeholder: batch})
+        except tf.errors.CancelledError:
+            # the queue was closed by stopFeeding
+            pass
+        finally:
+            # stops the worker processes
+            batches.close()
+
+    reader.thread_main = feed
+    return tilePipeline
+
+
+def stopFeeding(embedder):
+    """Stop the feed thread of feedCompressionVAE once training is over.
+    CompressionVAE never stops its reader, which would keep the sampling
+    workers running and wait blocked on the full queue forever.  Returns
+    when the thread has closed the pipeline's batches.
+    """
+    reader = embedder.reader
+    embedder.coord.request_stop()
+    # wakes the thread if it waits for room in the queue
+    embedder.sess.run(reader.closeFeatureQueue)
+    for thread in reader.feedThreads:
+        thread.join()
+    reader.feedThreads = []
+
+
+if __name__ == "__main__":
+    rng = numpy.random.default_rng(0)
+    sources = [volumeSource(rng.integers(0, 1000, (130, 256, 256), dtype=numpy.int16), numpy.eye(4),
+                            [0, 255, 0, 255, 0, 129], f"volume{index}") for index in range(4)]
+    reference = None
+    for workers in [1, None]:
+        tilePipeline = TilePipeline(sources, 32, batchSize=1024, seed=1, workers=workers)
+        startTime = time.perf_counter()
+        batches = list(tilePipeline.batches(40))
+        elapsed = time.perf_counter() - startTime
+        print(f"workers={workers}: {tilePipeline.tilesProduced / elapsed:.0f} tiles/s, "
+              f"{tilePipeline.waitSeconds:.2f} s waiting")
+        if reference is None:
+            reference = numpy.concatenate(batches)
+        else:
+            print("same tiles:", numpy.array_equal(reference, numpy.concatenate(batches)))
+    resumed = TilePipeline(sources, 32, batchSize=1024, seed=1, workers=1, startTile=5000)
+    print("resumed:", numpy.array_equal(numpy.concatenate(list(resumed.batches(3))), reference[5000:7 * 1024]))
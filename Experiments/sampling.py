@@ -0,0 +1,165 @@
+"""
+Random oblique slice sampling from volume arrays for the cvae experiment.
+
+Pure numpy and independent of any view or render pipeline, so it runs on
+headless training nodes as well as in Slicer:
+
+import sampling
+X = sampling.randomObliqueSlices(array, rasToIJK, rasBounds, 70 * 1000, [32,32], seed=1)
+
+Run "python sampling.py" for a quick throughput measurement.
+"""
+
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+import numpy
+
+
+def planeAxes(normals):
+    """Two unit vectors spanning the planes with the given (n, 3) unit normals."""
+    reference = numpy.zeros_like(normals)
+    # cross with the S axis like the slice view does, or with R for planes
+    # that are close to axial where that is degenerate
+    nearAxial = numpy.abs(normals[:, 2]) > 0.9
+    reference[~nearAxial, 2] = 1
+    reference[nearAxial, 0] = 1
+    transverse = numpy.cross(normals, reference)
+    transverse /= numpy.linalg.norm(transverse, axis=1, keepdims=True)
+    return transverse, numpy.cross(normals, transverse)
+
+
+def interpolate(array, ijk, background=0):
+    """Trilinear interpolation of a (k, j, i) indexed array at (..., 3) i, j, k
+    positions.  Positions outside the volume get the background value, like
+    vtkImageReslice.
+    """
+    array = numpy.ascontiguousarray(array)
+    flat = array.reshape(-1)
+    result = numpy.zeros(ijk.shape[:-1], dtype=numpy.float32)
+    lower = []
+    upper = []
+    fractions = []
+    inside = numpy.ones(ijk.shape[:-1], dtype=bool)
+    # axis 0 is i (fastest varying in the array), 2 is k
+    for axis, (size, stride) in enumerate(zip(array.shape[::-1], numpy.array(array.strides[::-1]) // array.itemsize)):
+        position = ijk[..., axis]
+        inside &= (position >= 0) & (position <= size - 1)
+        base = numpy.clip(numpy.floor(position), 0, size - 1)
+        fractions.append((position - base).astype(numpy.float32))
+        base = base.astype(numpy.int64)
+        lower.append(base * stride)
+        upper.append(numpy.minimum(base + 1, size - 1) * stride)
+    for corner in range(8):
+        index = 0
+        weight = 1
+        for axis in range(3):
+            if (corner >> axis) & 1:
+                index = index + upper[axis]
+                weight = weight * fractions[axis]
+            else:
+                index = index + lower[axis]
+                weight = weight * (1 - fractions[axis])
+        result += weight * flat[index]
+    result[~inside] = background
+    return result
+
+
+def sampleSlices(array, rasToIJK, rasBounds, sliceCount, sliceShape, spacing, rng):
+    """(sliceCount, rows*columns) float32 samples of random oblique planes,
+    centered uniformly in rasBounds with normals uniform on the sphere."""
+    rows, columns = sliceShape
+    low = numpy.array(rasBounds[0::2])
+    high = numpy.array(rasBounds[1::2])
+    centers = low + rng.random((sliceCount, 3)) * (high - low)
+    normals = rng.standard_normal((sliceCount, 3))
+    normals /= numpy.linalg.norm(normals, axis=1, keepdims=True)
+    transverse, longitudinal = planeAxes(normals)
+
+    columnOffsets = (numpy.arange(columns) - (columns - 1) / 2) * spacing
+    rowOffsets = (numpy.arange(rows) - (rows - 1) / 2) * spacing
+    ras = (centers[:, numpy.newaxis, numpy.newaxis, :]
+           + columnOffsets[numpy.newaxis, numpy.newaxis, :, numpy.newaxis] * transverse[:, numpy.newaxis, numpy.newaxis, :]
+           + rowOffsets[numpy.newaxis, :, numpy.newaxis, numpy.newaxis] * longitudinal[:, numpy.newaxis, numpy.newaxis, :])
+    ijk = ras @ rasToIJK[:3, :3].T + rasToIJK[:3, 3]
+    return interpolate(array, ijk).reshape(sliceCount, rows * columns)
+
+
+_workerVolume = None
+
+
+def _initializeWorker(array, rasToIJK, rasBounds):
+    global _workerVolume
+    _workerVolume = (array, rasToIJK, rasBounds)
+
+
+def _sampleChunk(arguments):
+    sliceCount, sliceShape, spacing, seedSequence = arguments
+    array, rasToIJK, rasBounds = _workerVolume
+    return sampleSlices(array, rasToIJK, rasBounds, sliceCount, sliceShape, spacing, numpy.random.default_rng(seedSequence))
+
+
+def _pythonExecutable():
+    # inside Slicer sys.executable is the application launcher
+    if "slicer" in sys.modules:
+        return shutil.which("PythonSlicer") or sys.executable
+    return sys.executable
+
+
+def randomObliqueSlices(array, rasToIJK, rasBounds, sliceCount, sliceShape, spacing=1.0,
+                        seed=None, chunkSize=1024, workers=None):
+    """Sample sliceCount random oblique planes of sliceShape (rows, columns)
+    pixels of spacing mm from a (k, j, i) indexed volume array with the given
+    4x4 RAS to IJK matrix and RAS bounds [xmin, xmax, ymin, ymax, zmin, zmax].
+
+    Planes are computed chunkSize at a time and the chunks are spread over
+    workers processes (default one per core, 1 to stay in this process).
+    Every chunk has its own random stream derived from seed, so the result
+    only depends on seed and chunkSize, not on the number of workers.
+    Returns a (sliceCount, rows*columns) float32 array.
+    """
+    rasToIJK = numpy.asarray(rasToIJK, dtype=numpy.float64)
+    sliceShape = tuple(sliceShape[:2])
+    chunkCounts = [min(chunkSize, sliceCount - start) for start in range(0, sliceCount, chunkSize)]
+    seeds = numpy.random.SeedSequence(seed).spawn(len(chunkCounts))
+    chunks = [(count, sliceShape, spacing, chunkSeed) for count, chunkSeed in zip(chunkCounts, seeds)]
+    workers = min(workers if workers else (os.cpu_count() or 1), len(chunks))
+
+    slices = numpy.empty((sliceCount, sliceShape[0] * sliceShape[1]), dtype=numpy.float32)
+    if workers <= 1:
+        _initializeWorker(array, rasToIJK, rasBounds)
+        results = map(_sampleChunk, chunks)
+    else:
+        context = multiprocessing.get_context("spawn")
+        context.set_executable(_pythonExecutable())
+        pool = context.Pool(workers, initializer=_initializeWorker, initargs=(array, rasToIJK, rasBounds))
+        results = pool.imap(_sampleChunk, chunks)
+    try:
+        start = 0
+        for result in results:
+            slices[start:start + len(result)] = result
+            start += len(result)
+    except BaseException:
+        # a failed worker or an interrupt does not wait for the queued chunks
+        if workers > 1:
+            pool.terminate()
+            pool.join()
+        raise
+    if workers > 1:
+        pool.close()
+        pool.join()
+    return slices
+
+
+if __name__ == "__main__":
+    volume = numpy.random.default_rng(0).integers(0, 1000, (130, 256, 256), dtype=numpy.int16)
+    rasToIJK = numpy.eye(4)
+    bounds = [0, 255, 0, 255, 0, 129]
+    for workers in [1, None]:
+        startTime = time.perf_counter()
+        X = randomObliqueSlices(volume, rasToIJK, bounds, 70 * 1000, [32, 32], seed=1, workers=workers)
+        elapsed = time.perf_counter() - startTime
+        print(f"workers={workers}: {len(X) / elapsed:.0f} slices/s")
@@ -0,0 +1,107 @@
+"""
+Tiling of volume arrays for the cvae experiment.
+
+Pure numpy, so it can be used in and outside of Slicer:
+
+import tiles
+X, labels = tiles.sliceTiles(array, 32)
+
+Run "python tiles.py" for a microbenchmark against the original loop.
+"""
+
+import time
+
+import numpy
+
+
+def tileGrid(length, tileSize, stride, pad):
+    """Number of tiles along an axis and the padded length they need."""
+    if pad:
+        count = max(0, -(-(length - tileSize) // stride)) + 1
+    else:
+        count = (length - tileSize) // stride + 1 if length >= tileSize else 0
+    return count, (count - 1) * stride + tileSize if count else length
+
+
+def tileView(array, tileSize, stride=None, pad=False, padValue=0):
+    """Strided view of shape (slices, rows, columns, tileSize, tileSize) on a
+    (slices, height, width) array.  Tiles start every stride pixels (default
+    tileSize, i.e. no overlap), so a smaller stride gives overlapping tiles.
+    The remainder at the bottom and right is dropped, or with pad=True
+    filled with padValue to complete the last tiles; only padding copies data.
+    """
+    stride = stride if stride else tileSize
+    slices, height, width = array.shape
+    rows, paddedHeight = tileGrid(height, tileSize, stride, pad)
+    columns, paddedWidth = tileGrid(width, tileSize, stride, pad)
+    if pad and (paddedHeight, paddedWidth) != (height, width):
+        padding = ((0, 0), (0, paddedHeight - height), (0, paddedWidth - width))
+        array = numpy.pad(array, padding, constant_values=padValue)
+    sliceStride, rowStride, columnStride = array.strides
+    return numpy.lib.stride_tricks.as_strided(
+        array,
+        shape=(slices, rows, columns, tileSize, tileSize),
+        strides=(sliceStride, rowStride * stride, columnStride * stride, rowStride, columnStride),
+        writeable=False)
+
+
+def tileLocations(view):
+    """(tileCount, 3) array of slice, row and column indices of the tiles of a tileView."""
+    slices, rows, columns = view.shape[:3]
+    return numpy.indices((slices, rows, columns)).reshape(3, -1).T
+
+
+def sliceTiles(array, tileSize, stride=None, dtype=numpy.float32, pad=False, padValue=0, copy=True):
+    """Tile matrix of shape (tileCount, tileSize*tileSize) with the slice index
+    of every tile as labels.  The tiles are gathered in a single copy that
+    also converts to dtype.  With copy=False the tileView is returned instead
+    of the matrix, without copying anything.
+    """
+    view = tileView(array, tileSize, stride, pad, padValue)
+    labels = numpy.repeat(numpy.arange(view.shape[0]), view.shape[1] * view.shape[2])
+    if not copy:
+        return view, labels
+    tiles = numpy.empty(view.shape, dtype=dtype)
+    numpy.copyto(tiles, view, casting="unsafe")
+    return tiles.reshape(-1, tileSize * tileSize), labels
+
+
+def sliceTilesLoop(array, tileSize):
+    """The original per tile loop, kept as reference for tests and benchmarks."""
+    labels = []
+    slices, height, width = array.shape
+    rows = int(height/tileSize)
+    columns = int(width/tileSize)
+    tiles = numpy.zeros([slices*rows*columns, tileSize*tileSize])
+    tileIndex = 0
+    for slice in range(slices):
+        for row in range(rows):
+            for column in range(columns):
+                rowOffset = row*tileSize
+                columnOffset = column*tileSize
+                tiles[tileIndex] = array[slice, rowOffset:rowOffset+tileSize, columnOffset:columnOffset+tileSize].flatten()
+                tileIndex += 1
+                labels.append(slice)
+    return tiles,labels
+
+
+def benchmarkSliceTiles(shape=(130, 256, 256), tileSize=32, repeat=3):
+    """Seconds per call of the loop and the vectorized tiler on a random volume."""
+    array = numpy.random.default_rng(0).integers(0, 1000, shape, dtype=numpy.int16)
+    results = {}
+    for name, function in [("loop", sliceTilesLoop), ("vectorized", sliceTiles)]:
+        times = []
+        for _ in range(repeat):
+            startTime = time.perf_counter()
+            tiles, labels = function(array, tileSize)
+            times.append(time.perf_counter() - startTime)
+        results[name] = {"seconds": min(times), "bytes": tiles.nbytes}
+    reference, referenceLabels = sliceTilesLoop(array, tileSize)
+    tiles, labels = sliceTiles(array, tileSize)
+    assert numpy.array_equal(reference, tiles) and numpy.array_equal(referenceLabels, labels)
+    return results
+
+
+if __name__ == "__main__":
+    for shape in [(64, 128, 128), (130, 256, 256), (256, 512, 512)]:
+        print(shape, benchmarkSliceTiles(shape))
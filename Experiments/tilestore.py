@@ -0,0 +1,200 @@
+"""
+Out-of-core tile dataset for the cvae experiment.
+
+A tile store is a directory of memory mapped .npy shards holding the tiles
+(one row of tileSize*tileSize values per tile) and, for every shard, an
+index of int32 rows (volume, slice, row, column) locating each tile in its
+source volume.  metadata.json lists the shards, their fill counts and the
+volume names.  Tiles are written incrementally, a few slices at a time, so
+the full tile matrix never has to fit in memory:
+
+import tilestore
+with tilestore.TileStoreWriter(path, 32) as writer:
+    writer.addArray(slicer.util.arrayFromVolume(volume), volume.GetName())
+store = tilestore.TileStore(path)
+for batch, indices in store.batches(256, shuffle=True, seed=0):
+    ...
+"""
+
+import json
+import os
+import shutil
+
+import numpy
+
+import tiles
+
+
+METADATA_FILE = "metadata.json"
+VERSION = 1
+
+
+def _writeMetadata(path, metadata):
+    temporaryPath = os.path.join(path, METADATA_FILE + ".tmp")
+    with open(temporaryPath, "w") as fp:
+        json.dump(metadata, fp, indent=2)
+    os.replace(temporaryPath, os.path.join(path, METADATA_FILE))
+
+
+class TileStoreWriter:
+    """Appends tiles of volume arrays to a tile store, creating it if needed.
+    Opening an existing store continues it in a new shard; overwrite=True
+    starts from an empty store instead.  Metadata is written on close(), so
+    readers only ever see completed shards.
+    """
+
+    def __init__(self, path, tileSize, dtype=numpy.float32, shardSize=1 << 16, overwrite=False):
+        self.path = path
+        if overwrite and os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        metadataPath = os.path.join(path, METADATA_FILE)
+        if os.path.exists(metadataPath):
+            with open(metadataPath) as fp:
+                self.metadata = json.load(fp)
+            if self.metadata["tileSize"] != tileSize or self.metadata["dtype"] != numpy.dtype(dtype).name:
+                raise ValueError(f"Tile store {path} has tile size {self.metadata['tileSize']} and dtype {self.metadata['dtype']}")
+        else:
+            self.metadata = {"version": VERSION, "tileSize": tileSize, "dtype": numpy.dtype(dtype).name,
+                             "shards": [], "volumes": []}
+        self.tileSize = tileSize
+        self.dtype = numpy.dtype(dtype)
+        self.shardSize = shardSize
+        self._shard = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _newShard(self):
+        self._closeShard()
+        number = len(self.metadata["shards"])
+        shard = {"tiles": f"tiles-{number:05d}.npy", "index": f"index-{number:05d}.npy", "count": 0}
+        self.metadata["shards"].append(shard)
+        self._shard = shard
+        self._tiles = numpy.lib.format.open_memmap(os.path.join(self.path, shard["tiles"]), mode="w+",
+                                                   dtype=self.dtype, shape=(self.shardSize, self.tileSize * self.tileSize))
+        self._index = numpy.lib.format.open_memmap(os.path.join(self.path, shard["index"]), mode="w+",
+                                                   dtype=numpy.int32, shape=(self.shardSize, 4))
+
+    def _closeShard(self):
+        if self._shard is not None:
+            self._tiles.flush()
+            self._index.flush()
+            del self._tiles, self._index
+            self._shard = None
+
+    def _append(self, tileBlock, locations):
+        """Copy (n, tileSize, tileSize) tiles (any array like, e.g. a strided view) and their locations."""
+        start = 0
+        while start < len(locations):
+            if self._shard is None or self._shard["count"] == self.shardSize:
+                self._newShard()
+            count = self._shard["count"]
+            stop = min(len(locations), start + self.shardSize - count)
+            target = self._tiles[count:count + stop - start].reshape(-1, self.tileSize, self.tileSize)
+            numpy.copyto(target, tileBlock[start:stop], casting="unsafe")
+            self._index[count:count + stop - start] = locations[start:stop]
+            self._shard["count"] = count + stop - start
+            start = stop
+
+    def addArray(self, array, volumeName, stride=None, pad=False, slicesPerBlock=8):
+        """Tile a (slices, height, width) array, see tiles.tileView, and append
+        the tiles.  Returns the number of tiles added."""
+        volumeIndex = len(self.metadata["volumes"])
+        self.metadata["volumes"].append(volumeName)
+        stride = stride if stride else self.tileSize
+        view = tiles.tileView(array, self.tileSize, stride, pad)
+        slices, rows, columns = view.shape[:3]
+        for firstSlice in range(0, slices, slicesPerBlock):
+            block = view[firstSlice:firstSlice + slicesPerBlock]
+            locations = tiles.tileLocations(block)
+            locations[:, 0] += firstSlice
+            locations[:, 1:] *= stride
+            locations = numpy.concatenate([numpy.full((len(locations), 1), volumeIndex), locations], axis=1)
+            self._append(block.reshape(-1, self.tileSize, self.tileSize), locations)
+        return slices * rows * columns
+
+    def close(self):
+        self._closeShard()
+        _writeMetadata(self.path, self.metadata)
+
+
+class TileStore:
+    """Read access to a tile store.  Shards are memory mapped on first use,
+    so opening a store and reading a few tiles is cheap whatever its size.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, METADATA_FILE)) as fp:
+            self.metadata = json.load(fp)
+        self.tileSize = self.metadata["tileSize"]
+        self.dtype = numpy.dtype(self.metadata["dtype"])
+        self.volumes = self.metadata["volumes"]
+        counts = [shard["count"] for shard in self.metadata["shards"]]
+        self._offsets = numpy.concatenate([[0], numpy.cumsum(counts)]).astype(numpy.int64)
+        self._maps = {}
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def _shardArrays(self, shardNumber):
+        if shardNumber not in self._maps:
+            shard = self.metadata["shards"][shardNumber]
+            tileMap = numpy.load(os.path.join(self.path, shard["tiles"]), mmap_mode="r")
+            indexMap = numpy.load(os.path.join(self.path, shard["index"]), mmap_mode="r")
+            self._maps[shardNumber] = (tileMap[:shard["count"]], indexMap[:shard["count"]])
+        return self._maps[shardNumber]
+
+    def _gather(self, indices, part):
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        if len(indices) and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError(f"Tile index out of range for a store of {len(self)} tiles")
+        shardNumbers = numpy.searchsorted(self._offsets, indices, side="right") - 1
+        result = None
+        for shardNumber in numpy.unique(shardNumbers):
+            selected = shardNumbers == shardNumber
+            values = self._shardArrays(shardNumber)[part][indices[selected] - self._offsets[shardNumber]]
+            if result is None:
+                result = numpy.empty((len(indices),) + values.shape[1:], dtype=values.dtype)
+            result[selected] = values
+        if result is None:
+            width = self.tileSize * self.tileSize if part == 0 else 4
+            result = numpy.empty((0, width), dtype=self.dtype if part == 0 else numpy.int32)
+        return result
+
+    def tiles(self, indices):
+        """(len(indices), tileSize*tileSize) array of the given tiles."""
+        return self._gather(indices, 0)
+
+    def locations(self, indices):
+        """(len(indices), 4) int32 array of volume, slice, row and column
+        (pixel offset of the tile's first row and column) of the given tiles.
+        Volume numbers index self.volumes."""
+        return self._gather(indices, 1)
+
+    def batches(self, batchSize, shuffle=False, seed=None, start=0, stop=None):
+        """Generator of (tiles, indices) mini-batches over tiles start to stop.
+        Shuffled batches gather their tiles in shard order, so each batch
+        reads each shard sequentially."""
+        stop = len(self) if stop is None else stop
+        order = numpy.arange(start, stop)
+        if shuffle:
+            numpy.random.default_rng(seed).shuffle(order)
+        for batchStart in range(0, len(order), batchSize):
+            indices = order[batchStart:batchStart + batchSize]
+            yield self.tiles(indices), indices
+
+    def sample(self, count, seed=None):
+        """(tiles, indices) of count distinct random tiles in store order,
+        e.g. a training set for an in memory trainer, or all tiles if count
+        is at least the store size."""
+        if count >= len(self):
+            indices = numpy.arange(len(self))
+        else:
+            indices = numpy.sort(numpy.random.default_rng(seed).choice(len(self), count, replace=False))
+        return self.tiles(indices), indices